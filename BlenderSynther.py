@@ -12,18 +12,41 @@ bl_info = {
 
 
 import bpy
+import numpy
 import itertools
-import random
 import json
 import os
+import zlib
+import struct
+import hashlib
+import tempfile
+import shutil
+import collections
+import concurrent.futures
+import sys
+import argparse
+import subprocess
+import traceback
+import tarfile
+import threading
+import contextlib
+import io
+import time
 from os.path import exists as path_exists
 from os.path import join as join_path
-from math import radians, sin, cos, tan, sqrt, floor
-from mathutils import Vector
+from math import radians, sin, sqrt
 from bpy.types import (Panel, Operator, PropertyGroup) 
 from bpy.props import (PointerProperty, BoolProperty, StringProperty,
                        IntProperty, FloatProperty, EnumProperty)
 
+try:
+    import tomllib
+except ImportError:
+    try:
+        import toml as tomllib
+    except ImportError:
+        tomllib = None
+
 
 class BS_BlenderSyntherButtonsPanel(Panel):
     bl_space_type = 'VIEW_3D'
@@ -38,12 +61,55 @@ class BS_BlenderSyntherButtonsPanel(Panel):
 class BS_DatasetJSONGenerator:
     __slots__ = ("_dataset_info", "_dataset_info_json_name",
                  "_rendered_images_folder_path", "_dataset_with_segmentation_masks")
+    
+    _dataset_info_name = "dataset_info"
+    # Keys describing which items a dataset info covers, all the others must be equal between shards
+    _item_range_keys = ("first_item_index", "items_to_generate", "shards")
                  
-    def __init__(self, context, struct_labeled_objects):
-        self._dataset_info_json_name = "dataset_info.json"
+    def __init__(self, context, labeled_models, shard_id=None):
+        self._dataset_info_json_name = self.get_dataset_info_json_name(shard_id)
         self._rendered_images_folder_path = context.scene.rendered_images_folder
         self._dataset_with_segmentation_masks = context.scene.generate_segmentation_masks
-        self._dataset_info = self._compose_dataset_info(context, struct_labeled_objects)
+        self._dataset_info = self._compose_dataset_info(context, labeled_models)
+    
+    @classmethod
+    def get_dataset_info_json_name(cls, shard_id=None):
+        if shard_id is None:
+            return f"{cls._dataset_info_name}.json"
+        return f"{cls._dataset_info_name}.shard-{shard_id:04d}.json"
+    
+    @classmethod
+    def merge_shards(cls, rendered_images_folder_path, shard_ids):
+        shards_info = list()
+        for shard_id in shard_ids:
+            shard_json_path = join_path(rendered_images_folder_path, cls.get_dataset_info_json_name(shard_id))
+            with open(shard_json_path, "r") as sdij:
+                shards_info.append(json.load(sdij))
+        
+        dataset_info = dict([(key, value) for key, value in shards_info[0].items() 
+                             if key not in cls._item_range_keys])
+        for shard_info in shards_info[1:]:
+            shard_common_info = dict([(key, value) for key, value in shard_info.items() 
+                                      if key not in cls._item_range_keys])
+            if shard_common_info != dataset_info:
+                raise Exception("Dataset info of the shards differ, they cannot be merged")
+        
+        shards_info.sort(key=lambda shard_info: shard_info["first_item_index"])
+        dataset_info["first_item_index"] = shards_info[0]["first_item_index"]
+        dataset_info["items_to_generate"] = sum([shard_info["items_to_generate"] for shard_info in shards_info])
+        dataset_info["shards"] = [(shard_info["first_item_index"], shard_info["items_to_generate"]) 
+                                  for shard_info in shards_info]
+        
+        dataset_info_json_path = join_path(rendered_images_folder_path, cls.get_dataset_info_json_name())
+        with open(dataset_info_json_path, "w") as dij:
+            json.dump(dataset_info, dij, indent=1)
+        
+        for shard_id in shard_ids:
+            os.remove(join_path(rendered_images_folder_path, cls.get_dataset_info_json_name(shard_id)))
+    
+    @property
+    def json_exists(self):
+        return path_exists(join_path(self._rendered_images_folder_path, self._dataset_info_json_name))
     
     def generate_json(self):
         dataset_info_json_path = join_path(self._rendered_images_folder_path, self._dataset_info_json_name)
@@ -51,7 +117,7 @@ class BS_DatasetJSONGenerator:
         with open(dataset_info_json_path, "w") as dij:
             json.dump(self._dataset_info, dij, indent=1)
             
-    def _compose_dataset_info(self, context, struct_labeled_objects):
+    def _compose_dataset_info(self, context, labeled_models):
         dataset_info = dict()
         
         images_size = (context.scene.render.resolution_x, context.scene.render.resolution_y)
@@ -59,64 +125,491 @@ class BS_DatasetJSONGenerator:
         
         dataset_info["images_size"] = images_size
         dataset_info["rendered_images_format"] = rendered_images_format
+        dataset_info["first_item_index"] = context.scene.first_item_index
+        dataset_info["items_to_generate"] = context.scene.items_to_generate
+        dataset_info["random_seed"] = context.scene.random_seed
+        dataset_info["output_layout"] = BS_OutputLayout(context).get_layout_info()
+        if rendered_images_format == "OPEN_EXR_MULTILAYER":
+            dataset_info["rendered_images_layers"] = BS_Render.get_multilayer_exr_layout(context)
+        if context.scene.generate_bounding_boxes:
+            dataset_info["bounding_boxes"] = {"file": "bounding_boxes.jsonl", 
+                                              "format": "x_min, y_min, width, height in pixels from the top left"}
         
         if self._dataset_with_segmentation_masks:
-            labeled_objects_info = self._get_labeled_objects_info(struct_labeled_objects)
+            labeled_objects_info = self._get_labeled_objects_info(labeled_models)
             dataset_info["labeled_objects_info"] = labeled_objects_info
+            max_instance_id = BS_InstanceIDAllocator(context.scene.rendered_images_folder).max_instance_id
+            dataset_info["segmentation_masks_encoding"] = \
+                BS_Annotations.get_segmentation_masks_encoding_info(max_instance_id)
+            dataset_info["segmentation_masks_folder"] = os.path.abspath(context.scene.segmentation_masks_folder)
         
         return dataset_info
             
-    def _get_labeled_objects_info(self, struct_labeled_objects):
+    def _get_labeled_objects_info(self, labeled_models):
         labeled_objects_info = dict()
         
-        for label_name, label_objects in struct_labeled_objects.items():
-            labeled_objects_info[label_name] = list()
-            for label_object in label_objects:
-                object_parent_name = label_object[0]
-                label_object_pass_index = bpy.data.objects[object_parent_name].pass_index
-                labeled_objects_info[label_name].append(label_object_pass_index)
+        for label_name, label_models in labeled_models.items():
+            labeled_objects_info[label_name] = [model_objects[0].pass_index for model_objects in label_models]
 
         return labeled_objects_info
 
 
-class BS_CompositorNodesManager:
-    __slots__ = ("_render_layers_node", "_composite_node")
+class BS_ItemMetadataWriter:
+    __slots__ = ("_metadata_path", "_index_path", "_metadata_file", "_index_file",
+                 "_records_to_sync", "_records_per_sync", "_last_item_index", "_is_index_sorted")
     
-    def __init__(self, context):
-        self._add_basic_nodes(context)
-        self._connect_basic_nodes(context)
+    _metadata_name = "items_metadata"
+    # Sidecar index of (item index, byte offset of its line) pairs. Closing the writer sorts it by the item
+    # index and keeps the last pair of every item, so an item is found without reading the whole index
+    _index_record = struct.Struct("<QQ")
+    _index_dtype = numpy.dtype([("item_index", "<u8"), ("offset", "<u8")])
+    
+    @classmethod
+    def get_metadata_paths(cls, folder_path, shard_id=None, metadata_name=None):
+        metadata_name = metadata_name or cls._metadata_name
+        if shard_id is not None:
+            metadata_name = f"{metadata_name}.shard-{shard_id:04d}"
+        return (join_path(folder_path, f"{metadata_name}.jsonl"), join_path(folder_path, f"{metadata_name}.idx"))
+    
+    @classmethod
+    def read_item(cls, metadata_path, item_index):
+        index_path = f"{os.path.splitext(metadata_path)[0]}.idx"
+        if not os.path.getsize(index_path):
+            raise KeyError(f"Item {item_index} is not in '{metadata_path}'")
+        # Only the pages of the looked up records are read from the mapped index
+        index = numpy.memmap(index_path, dtype=cls._index_dtype, mode="r")
+        item_indices = index["item_index"]
+        # A dense index has the record of the item at its position, a sparse one is searched
+        record_num = item_index - int(item_indices[0])
+        if not (0 <= record_num < len(item_indices) and item_indices[record_num] == item_index):
+            record_num = int(numpy.searchsorted(item_indices, item_index, side="right")) - 1
+        if not (0 <= record_num < len(item_indices) and item_indices[record_num] == item_index):
+            # An index left unsorted by an interrupted run is searched through
+            item_records = numpy.flatnonzero(item_indices == item_index)
+            if not len(item_records):
+                raise KeyError(f"Item {item_index} is not in '{metadata_path}'")
+            record_num = item_records[-1]
         
-    @property
-    def render_layers_node(self):
-        return self._render_layers_node
+        with open(metadata_path, "rb") as metadata_file:
+            metadata_file.seek(int(index["offset"][record_num]))
+            return json.loads(metadata_file.readline())
     
-    def _connect_basic_nodes(self, context):
-        context.scene.use_nodes = True
+    @classmethod
+    def sort_index(cls, index_path):
+        index = numpy.fromfile(index_path, dtype=cls._index_dtype)
+        index = index[numpy.argsort(index["item_index"], kind="stable")]
+        # Records of the same item stay in the written order, the last one is kept
+        is_last_record = numpy.append(index["item_index"][1:] != index["item_index"][:-1], True)
+        temporary_path = f"{index_path}.{os.getpid()}.tmp"
+        index[is_last_record].tofile(temporary_path)
+        os.replace(temporary_path, index_path)
+    
+    @classmethod
+    def merge_shards(cls, folder_path, shard_ids, metadata_name=None):
+        metadata_path, index_path = cls.get_metadata_paths(folder_path, metadata_name=metadata_name)
+        if not any([path_exists(cls.get_metadata_paths(folder_path, shard_id, metadata_name)[0]) 
+                    for shard_id in shard_ids]):
+            return
         
-        context.scene.node_tree.links.new(self._render_layers_node.outputs["Image"], 
-                                          self._composite_node.inputs["Image"])
+        with open(metadata_path, "ab") as metadata_file, open(index_path, "ab") as index_file:
+            for shard_id in shard_ids:
+                shard_metadata_path, shard_index_path = cls.get_metadata_paths(folder_path, shard_id, metadata_name)
+                if not path_exists(shard_metadata_path):
+                    continue
+                
+                shard_offset = metadata_file.tell()
+                with open(shard_metadata_path, "rb") as shard_metadata_file:
+                    shutil.copyfileobj(shard_metadata_file, metadata_file)
+                shard_index = numpy.fromfile(shard_index_path, dtype=cls._index_dtype)
+                shard_index["offset"] += numpy.uint64(shard_offset)
+                index_file.write(shard_index.tobytes())
+                
+                os.remove(shard_metadata_path)
+                os.remove(shard_index_path)
+        cls.sort_index(index_path)
+    
+    def __init__(self, folder_path, shard_id=None, records_per_sync=1000, metadata_name=None):
+        self._metadata_path, self._index_path = self.get_metadata_paths(folder_path, shard_id, metadata_name)
+        self._metadata_file = None
+        self._index_file = None
+        self._records_to_sync = 0
+        self._records_per_sync = records_per_sync
+        self._last_item_index = -1
+        self._is_index_sorted = True
+    
+    def write_item(self, item_index, item_metadata):
+        if self._metadata_file is None:
+            self._metadata_file = open(self._metadata_path, "ab", buffering=2**20)
+            self._index_file = open(self._index_path, "ab", buffering=2**16)
+            self._last_item_index = self._read_last_item_index()
+        # Items written in increasing order keep the index sorted, others have it sorted on closing
+        self._is_index_sorted = self._is_index_sorted and item_index > self._last_item_index
+        self._last_item_index = max(self._last_item_index, item_index)
         
-    def _add_basic_nodes(self, context):
-        context.scene.use_nodes = True
+        item_record = dict(item=item_index)
+        item_record.update(item_metadata)
         
-        render_layers_node_name = "Render Layers"
-        composite_node_name = "Composite"
+        self._index_file.write(self._index_record.pack(item_index, self._metadata_file.tell()))
+        self._metadata_file.write(json.dumps(item_record, separators=(",", ":")).encode())
+        self._metadata_file.write(b"\n")
         
-        nodes = context.scene.node_tree.nodes
+        # Records are synced to the disk in batches, a crash loses at most one batch
+        self._records_to_sync += 1
+        if self._records_to_sync >= self._records_per_sync:
+            self.sync()
+    
+    def sync(self):
+        if self._metadata_file is None:
+            return
         
-        # Render Layers Node
-        if nodes.get(render_layers_node_name, None):
-             self._render_layers_node = nodes[render_layers_node_name]
-        else:
-            self._render_layers_node = nodes.new("CompositorNodeRLayers")
-        self._render_layers_node.location = (0, 0)
+        for opened_file in (self._metadata_file, self._index_file):
+            opened_file.flush()
+            os.fsync(opened_file.fileno())
+        self._records_to_sync = 0
+    
+    def _read_last_item_index(self):
+        index_size = os.path.getsize(self._index_path)
+        if index_size < self._index_record.size:
+            return -1
+        with open(self._index_path, "rb") as index_file:
+            index_file.seek(index_size - self._index_record.size)
+            return self._index_record.unpack(index_file.read(self._index_record.size))[0]
+    
+    def close(self):
+        if self._metadata_file is not None:
+            self.sync()
+            self._metadata_file.close()
+            self._index_file.close()
+            self._metadata_file = None
+            self._index_file = None
+            if not self._is_index_sorted:
+                self.sort_index(self._index_path)
+                self._is_index_sorted = True
+    
+    
+class BS_CompositorGraph:
+    __slots__ = ("_node_specs", "_link_specs")
+    
+    render_layers_node_name = "Render Layers"
+    composite_node_name = "Composite"
+    _spec_hash_key = "bs_spec_hash"
+    # Nodes of earlier setups which are not in the spec anymore are removed, they are recognized 
+    # by the stored spec hash or, for the nodes of older versions, by the name prefix
+    _managed_node_prefix = "BS "
+    
+    @classmethod
+    def get_render_layers_node(cls, scene):
+        scene.use_nodes = True
+        nodes = scene.node_tree.nodes
+        render_layers_node = nodes.get(cls.render_layers_node_name, None)
+        if render_layers_node is None:
+            render_layers_node = nodes.new("CompositorNodeRLayers")
+            render_layers_node.name = cls.render_layers_node_name
+            
+        return render_layers_node
+    
+    def __init__(self):
+        self._node_specs = collections.OrderedDict()
+        self._link_specs = list()
+        
+        self.add_node(self.render_layers_node_name, "CompositorNodeRLayers", (0, 0))
+        self.add_node(self.composite_node_name, "CompositorNodeComposite", (200, 200))
+        self.add_link(self.render_layers_node_name, "Image", self.composite_node_name, "Image")
+    
+    def add_node(self, name, node_type, location, properties=(), inputs=(), file_slots=None, layer_slots=None):
+        # Properties are (attribute path, value) pairs set in order, so e.g. the file format is set
+        # before the color depth it allows; inputs are (socket, default value) pairs
+        self._node_specs[name] = {"type": node_type, "location": tuple(location), 
+                                  "properties": tuple(properties), "inputs": tuple(inputs),
+                                  "file_slots": file_slots and tuple(file_slots), 
+                                  "layer_slots": layer_slots and tuple(layer_slots)}
+    
+    def add_link(self, from_node_name, from_socket, to_node_name, to_socket):
+        self._link_specs.append((from_node_name, from_socket, to_node_name, to_socket))
+    
+    def get_node_hash(self, node_name):
+        node_spec_json = json.dumps(self._node_specs[node_name], sort_keys=True, default=self._get_hashable_value)
+        return hashlib.sha1(node_spec_json.encode()).hexdigest()
+    
+    @staticmethod
+    def _get_hashable_value(value):
+        # Datablocks, e.g. the scene of a render layers node, are hashed by their type and name
+        return f"{type(value).__name__}:{getattr(value, 'name', value)}"
+    
+    def build(self, scene):
+        # Only the nodes which spec hash changed are set up again and only the missing links are added,
+        # so the graph stays free of duplicates and setting it up again costs next to nothing
+        scene.use_nodes = True
+        node_tree = scene.node_tree
+        spec_nodes = self._build_nodes(node_tree)
+        self._build_links(node_tree, spec_nodes)
+        
+        return spec_nodes
+    
+    def _build_nodes(self, node_tree):
+        nodes = node_tree.nodes
+        for node in tuple(nodes):
+            if node.name not in self._node_specs and (self._spec_hash_key in node 
+                                                      or node.name.startswith(self._managed_node_prefix)):
+                nodes.remove(node)
+        
+        spec_nodes = dict()
+        for node_name, node_spec in self._node_specs.items():
+            node = nodes.get(node_name, None)
+            if node is not None and node.bl_idname != node_spec["type"]:
+                nodes.remove(node)
+                node = None
+            if node is None:
+                node = nodes.new(node_spec["type"])
+                node.name = node_name
+                
+            node_hash = self.get_node_hash(node_name)
+            if node.get(self._spec_hash_key, None) != node_hash:
+                self._apply_node_spec(node, node_spec)
+                node[self._spec_hash_key] = node_hash
+            spec_nodes[node_name] = node
+            
+        return spec_nodes
+    
+    def _apply_node_spec(self, node, node_spec):
+        node.location = node_spec["location"]
+        for property_path, value in node_spec["properties"]:
+            *owner_names, property_name = property_path.split(".")
+            property_owner = node
+            for owner_name in owner_names:
+                property_owner = getattr(property_owner, owner_name)
+            setattr(property_owner, property_name, value)
+            
+        if node_spec["file_slots"] is not None:
+            node.file_slots.clear()
+            for slot_path in node_spec["file_slots"]:
+                node.file_slots.new(slot_path)
+        if node_spec["layer_slots"] is not None:
+            node.layer_slots.clear()
+            for layer_name in node_spec["layer_slots"]:
+                node.layer_slots.new(layer_name)
+                
+        for socket, default_value in node_spec["inputs"]:
+            node.inputs[socket].default_value = default_value
+    
+    def _build_links(self, node_tree, spec_nodes):
+        spec_links = dict()
+        for from_node_name, from_socket, to_node_name, to_socket in self._link_specs:
+            output_socket = spec_nodes[from_node_name].outputs[from_socket]
+            input_socket = spec_nodes[to_node_name].inputs[to_socket]
+            link_key = (from_node_name, output_socket.identifier, to_node_name, input_socket.identifier)
+            spec_links[link_key] = (output_socket, input_socket)
+        
+        # Links into the spec nodes which are not in the spec are stale, the others exist already
+        existing_links = set()
+        for link in tuple(node_tree.links):
+            link_key = (link.from_node.name, link.from_socket.identifier, 
+                        link.to_node.name, link.to_socket.identifier)
+            if link.to_node.name not in self._node_specs:
+                continue
+            if link_key in spec_links and link_key not in existing_links:
+                existing_links.add(link_key)
+            else:
+                node_tree.links.remove(link)
+        
+        for link_key, (output_socket, input_socket) in spec_links.items():
+            if link_key not in existing_links:
+                node_tree.links.new(output_socket, input_socket)
+     
+
+class BS_ItemRandomness:
+    __slots__ = ("_seed_key",)
+    
+    # Counter-based generator: every random number is a hash of (seed, stream, item index, slot),
+    # so the state of any item is reproducible on its own, in any order and in any process
+    _gamma = numpy.uint64(0x9E3779B97F4A7C15)
+    _mix_multipliers = (numpy.uint64(0xBF58476D1CE4E5B9), numpy.uint64(0x94D049BB133111EB))
+    _mix_shifts = (numpy.uint64(30), numpy.uint64(27), numpy.uint64(31))
+    _mantissa_shift = numpy.uint64(11)
+    
+    def __init__(self, seed):
+        with numpy.errstate(over="ignore"):
+            self._seed_key = self._mix(numpy.uint64(seed & 0xFFFFFFFFFFFFFFFF) + self._gamma)
+    
+    def uniform(self, item_indices, stream, low=0.0, high=1.0, size=1):
+        random_bits = self._get_random_bits(item_indices, stream, size)
+        unit_values = (random_bits >> self._mantissa_shift).astype(numpy.float64) * 2.0**-53
+        
+        return low + unit_values * (high - low)
+    
+    def integers(self, item_indices, stream, low, high, size=1):
+        unit_values = self.uniform(item_indices, stream, size=size)
+        
+        return low + numpy.floor(unit_values * (high - low)).astype(numpy.int64)
+    
+    def _get_random_bits(self, item_indices, stream, size):
+        stream_key = numpy.uint64(zlib.crc32(stream.encode()))
+        item_indices = numpy.asarray(item_indices, dtype=numpy.uint64)[:, numpy.newaxis]
+        slots = numpy.arange(size, dtype=numpy.uint64)[numpy.newaxis, :]
+        
+        with numpy.errstate(over="ignore"):
+            key = self._mix(self._seed_key ^ self._mix(stream_key + self._gamma))
+            item_keys = self._mix(key + (item_indices + numpy.uint64(1)) * self._gamma)
+            return self._mix(item_keys + (slots + numpy.uint64(1)) * self._gamma)
+    
+    def _mix(self, value):
+        # SplitMix64 finalizer
+        value = (value ^ (value >> self._mix_shifts[0])) * self._mix_multipliers[0]
+        value = (value ^ (value >> self._mix_shifts[1])) * self._mix_multipliers[1]
+        return value ^ (value >> self._mix_shifts[2])
+    
+
+class BS_AnimationBaker:
+    __slots__ = ()
+    
+    @staticmethod
+    def get_action(id_data, action_name):
+        animation_data = id_data.animation_data or id_data.animation_data_create()
+        if animation_data.action is None:
+            animation_data.action = bpy.data.actions.new(action_name)
+            
+        return animation_data.action
+    
+    @staticmethod
+    def bake_fcurve(action, data_path, frames, values, index=0):
+        # Replace the whole F-Curve with one keyframe per frame written in bulk,
+        # frames are integers so the interpolation between keyframes never matters
+        fcurve = action.fcurves.find(data_path, index=index)
+        if fcurve is not None:
+            action.fcurves.remove(fcurve)
+        fcurve = action.fcurves.new(data_path, index=index)
+        
+        keyframes_co = numpy.empty(2 * len(frames), dtype=numpy.float32)
+        keyframes_co[0::2] = frames
+        keyframes_co[1::2] = values
+        
+        fcurve.keyframe_points.add(len(frames))
+        fcurve.keyframe_points.foreach_set("co", keyframes_co)
+        fcurve.update()
+        
+        return fcurve
+    
+    @staticmethod
+    def has_fcurve(id_data, data_path, index=0):
+        animation_data = id_data.animation_data
+        if animation_data is None or animation_data.action is None:
+            return False
+        
+        return animation_data.action.fcurves.find(data_path, index=index) is not None
+    
+    @staticmethod
+    def clear_fcurve(id_data, data_path, index=0):
+        # Baked F-Curves of an earlier run would override the state set by the frame change handler
+        animation_data = id_data.animation_data
+        if animation_data is None or animation_data.action is None:
+            return
+        
+        fcurve = animation_data.action.fcurves.find(data_path, index=index)
+        if fcurve is not None:
+            animation_data.action.fcurves.remove(fcurve)
+        
+        
+class BS_Profiler:
+    __slots__ = ("_is_enabled", "_start_time", "_trace_events", "_max_trace_events", "_dropped_trace_events",
+                 "_spans_stats", "_open_spans", "_stats_lock")
+    
+    # Shared by all the spans while profiling is off, so they cost a method call
+    _disabled_span = contextlib.nullcontext()
+    
+    class _Span:
+        __slots__ = ("_profiler", "_name", "_category", "_start_time")
+        
+        def __init__(self, profiler, name, category):
+            self._profiler = profiler
+            self._name = name
+            self._category = category
+            
+        def __enter__(self):
+            self._start_time = time.perf_counter_ns()
+            return self
+        
+        def __exit__(self, *exc_info):
+            self._profiler.add_span(self._name, self._category, self._start_time, time.perf_counter_ns())
+            return False
+    
+    def __init__(self, max_trace_events=2_000_000):
+        self._is_enabled = False
+        self._start_time = None
+        self._trace_events = list()
+        self._max_trace_events = max_trace_events
+        self._dropped_trace_events = 0
+        self._spans_stats = dict()
+        self._open_spans = dict()
+        self._stats_lock = threading.Lock()
+    
+    @property
+    def is_enabled(self):
+        return self._is_enabled
+    
+    def enable(self):
+        self._is_enabled = True
+        self._start_time = time.perf_counter_ns()
+    
+    def span(self, name, category="generation"):
+        if not self._is_enabled:
+            return self._disabled_span
+        return self._Span(self, name, category)
+    
+    def begin(self, name):
+        # For the spans between two handlers, e.g. render_pre and render_post
+        if self._is_enabled:
+            self._open_spans[name] = time.perf_counter_ns()
+    
+    def end(self, name, category="render"):
+        start_time = self._open_spans.pop(name, None)
+        if start_time is not None:
+            self.add_span(name, category, start_time, time.perf_counter_ns())
+    
+    def add_span(self, name, category, start_time, end_time):
+        duration = end_time - start_time
+        with self._stats_lock:
+            span_stats = self._spans_stats.get(name, None)
+            if span_stats is None:
+                self._spans_stats[name] = [category, 1, duration, duration]
+            else:
+                span_stats[1] += 1
+                span_stats[2] += duration
+                span_stats[3] = max(span_stats[3], duration)
+            
+            # Long runs keep the statistics of all the spans but only the first events of the trace
+            if len(self._trace_events) < self._max_trace_events:
+                self._trace_events.append((name, category, start_time, duration, threading.get_ident()))
+            else:
+                self._dropped_trace_events += 1
+    
+    def write_chrome_trace(self, trace_path):
+        # Complete ("X") events in microseconds, loadable by chrome://tracing and Perfetto
+        process_id = os.getpid()
+        with open(trace_path, "w") as trace_file:
+            trace_file.write('{"displayTimeUnit":"ms","traceEvents":[\n')
+            for event_num, (name, category, start_time, duration, thread_id) in enumerate(self._trace_events):
+                trace_event = {"name": name, "cat": category, "ph": "X", 
+                               "ts": (start_time - self._start_time) / 1000, "dur": duration / 1000,
+                               "pid": process_id, "tid": thread_id}
+                trace_file.write(("," if event_num else "") + json.dumps(trace_event, separators=(",", ":")) + "\n")
+            trace_file.write(f'],"otherData":{{"dropped_events":{self._dropped_trace_events}}}}}\n')
+    
+    def get_summary(self):
+        wall_time = max(time.perf_counter_ns() - (self._start_time or 0), 1)
+        summary_lines = [f"{'span':<32}{'category':<12}{'count':>10}{'total s':>12}{'mean ms':>12}"
+                         f"{'max ms':>12}{'wall %':>9}"]
+        for name, (category, count, total_time, max_time) in sorted(self._spans_stats.items(), 
+                                                                   key=lambda span_stats: -span_stats[1][2]):
+            summary_lines.append(f"{name:<32}{category:<12}{count:>10}{total_time / 1e9:>12.3f}"
+                                 f"{total_time / count / 1e6:>12.3f}{max_time / 1e6:>12.3f}"
+                                 f"{100 * total_time / wall_time:>9.1f}")
+        summary_lines.append(f"wall time {wall_time / 1e9:.3f} s, spans of other threads overlap the main thread")
+        
+        return "\n".join(summary_lines)
+    
+
+bs_profiler = BS_Profiler()
         
-        # Composite Node
-        if nodes.get(composite_node_name, None):
-             self._composite_node = nodes[composite_node_name]
-        else:
-            self._composite_node = nodes.new("CompositorNodeComposite")
-        self._composite_node.location = (200, 200) 
      
 ############################################################################################################
 #                                           LABELED OBJECTS
@@ -143,14 +636,73 @@ class BS_PGT_LabeledObjectsProperies(PropertyGroup):
                                       type=bpy.types.Collection,
                                       name="Labeled Objects Collection")
                                       
+class BS_InstanceIDAllocator:
+    __slots__ = ("_instance_ids_table_path", "_instance_ids")
+    
+    instance_ids_table_name = "instance_ids.json"
+    # Blender keeps the object pass index, which carries the id, in a short
+    max_pass_index = 2**15 - 1
+    
+    def __init__(self, folder_path):
+        self._instance_ids_table_path = join_path(folder_path, self.instance_ids_table_name)
+        self._instance_ids = self._load_instance_ids()
+        
+    @property
+    def max_instance_id(self):
+        return max(self._instance_ids, default=0)
+        
+    def _load_instance_ids(self):
+        if not path_exists(self._instance_ids_table_path):
+            return dict()
+        
+        with open(self._instance_ids_table_path, "r") as iit:
+            return dict([(int(instance_id), (instance["label"], instance["model"]))
+                         for instance_id, instance in json.load(iit).items()])
+            
+    def allocate(self, struct_labeled_objects):
+        # Models keep the ids from the table, so masks of earlier runs decode the same way; 
+        # ids of the removed models stay reserved and new models get the next free ones
+        model_instance_ids = dict([(model_name, instance_id) 
+                                   for instance_id, (_, model_name) in self._instance_ids.items()])
+        next_instance_id = self.max_instance_id + 1
+        
+        for label_name, label_objects in struct_labeled_objects.items():
+            for model_objects in label_objects:
+                model_name = model_objects[0]
+                if model_name not in model_instance_ids:
+                    model_instance_ids[model_name] = next_instance_id
+                    next_instance_id += 1
+                self._instance_ids[model_instance_ids[model_name]] = (label_name, model_name)
+        
+        if self.max_instance_id > self.max_pass_index:
+            raise Exception(f"Labeled objects can have up to {self.max_pass_index} instance ids, "
+                            f"they need {self.max_instance_id}")
+        
+        return model_instance_ids
+    
+    def save(self):
+        instance_ids_table = dict([(str(instance_id), {"label": label_name, "model": model_name})
+                                   for instance_id, (label_name, model_name) in sorted(self._instance_ids.items())])
+        
+        # Shards write the same table at the same time, so every process writes its own file and renames it
+        instance_ids_table_tmp_path = f"{self._instance_ids_table_path}.{os.getpid()}.tmp"
+        with open(instance_ids_table_tmp_path, "w") as iit:
+            json.dump(instance_ids_table, iit, indent=1)
+        os.replace(instance_ids_table_tmp_path, self._instance_ids_table_path)
+        
+        
 class BS_LabeledObjects:    
-    __slots__ = ("_all_parent_objects", "_all_label_names", "_structured_labeled_objects",
-                 "_number_of_models", "_pass_index_step")
+    __slots__ = ("_all_parent_objects", "_all_label_names", "_structured_labeled_objects", "_labeled_models",
+                 "_number_of_models", "_max_instance_id")
              
     @property
     def structured_labeled_objects(self):
         return self._structured_labeled_objects
     
+    @property
+    def labeled_models(self):
+        return self._labeled_models
+    
     @property
     def all_parent_objects(self):
         return self._all_parent_objects
@@ -159,88 +711,118 @@ class BS_LabeledObjects:
     def number_of_models(self):
         return self._number_of_models
     
-    def insert_animation_keyframe(self, frame_num):
-        self._randomly_rotate()
-        for parent_object in self._all_parent_objects:
-            parent_object.keyframe_insert(data_path="rotation_euler", index=-1, frame=frame_num)
+    @property
+    def max_instance_id(self):
+        return self._max_instance_id
+    
+    def bake_animation(self, frames, randomness):
+        rotations = self.get_random_rotations(frames, randomness)
+        
+        for object_num, parent_object in enumerate(self._all_parent_objects):
+            action = BS_AnimationBaker.get_action(parent_object, f"BS {parent_object.name} Action")
+            for axis in range(3):
+                BS_AnimationBaker.bake_fcurve(action, "rotation_euler", frames, 
+                                              rotations[:, object_num, axis], index=axis)
             
-    def _randomly_rotate(self):     
+    def clear_animation(self):
         for parent_object in self._all_parent_objects:
-            orient_axis = random.randint(0, 2)
-            rotation_degree = radians(random.randint(117, 454))
-            parent_object.rotation_euler[orient_axis] = rotation_degree
+            for axis in range(3):
+                BS_AnimationBaker.clear_fcurve(parent_object, "rotation_euler", index=axis)
+    
+    def apply_item_state(self, item_index, randomness):
+        rotations = self.get_random_rotations([item_index], randomness)[0]
+        
+        for object_num, parent_object in enumerate(self._all_parent_objects):
+            parent_object.rotation_euler = rotations[object_num]
+            
+    def get_item_parameters(self, item_index, randomness):
+        rotations = self.get_random_rotations([item_index], randomness)[0]
+        
+        return {"rotations": dict([(parent_object.name, rotations[object_num].tolist()) 
+                                   for object_num, parent_object in enumerate(self._all_parent_objects)])}
+    
+    def get_random_rotations(self, item_indices, randomness):
+        # All three axes of every object are drawn for every item, so no item depends on the previous ones
+        num_objects = self._number_of_models
+        rotation_degrees = randomness.integers(item_indices, "labeled_objects.rotation", 
+                                               117, 455, size=num_objects * 3)
+        
+        return numpy.radians(rotation_degrees).reshape(len(item_indices), num_objects, 3)
             
     def __init__(self, context):
         labeled_objects_collection = context.scene.labeled_objects_collection
         
         if labeled_objects_collection:
-            self._all_parent_objects = self._get_all_parent_objects(labeled_objects_collection)
-            self._all_label_names = self._get_all_label_names(labeled_objects_collection)
-            self._structured_labeled_objects = self._get_structured_labeled_objects(labeled_objects_collection)
+            self._labeled_models = self._get_labeled_models(labeled_objects_collection)
+            self._all_label_names = tuple(self._labeled_models.keys())
+            self._all_parent_objects = tuple([model_objects[0] for label_models in self._labeled_models.values()
+                                              for model_objects in label_models])
+            self._structured_labeled_objects = self._get_structured_labeled_objects(self._labeled_models)
             self._number_of_models = len(self._all_parent_objects)
             self._setup_properties(context)
         else:
             raise Exception("You have to specify the labeled objects collection")
     
     def _setup_properties(self, context):
-        # Set pass indexes
+        # Set pass indexes, the pass index of a model is its instance id
         context.view_layer.use_pass_object_index = True
     
-        pass_indexes = self._get_pass_indexes()
-        for label_objects in self._structured_labeled_objects.values():
-            for model_objects in label_objects:
-                self._set_model_pass_index(model_objects, next(pass_indexes))
-                    
-    def _set_model_pass_index(self, model_objects, pass_index):
-        for model_object in model_objects:
-             bpy.data.objects[model_object].pass_index = pass_index
-    
-    def _get_pass_indexes(self):
-        number_of_models = self._number_of_models
-        if number_of_models < 255:
-            pass_index_step = (2**8 - 1) // number_of_models
-        else: 
-            pass_index_step = (2**16 - 1) // number_of_models
+        rendered_images_folder = context.scene.rendered_images_folder
+        instance_id_allocator = BS_InstanceIDAllocator(rendered_images_folder)
+        model_instance_ids = instance_id_allocator.allocate(self._structured_labeled_objects)
+        self._max_instance_id = instance_id_allocator.max_instance_id
+        if path_exists(rendered_images_folder):
+            instance_id_allocator.save()
         
-        for model_num in range(1, number_of_models + 1):
-            yield model_num * pass_index_step    
-            
-    def _get_all_label_names(self, labeled_objects_collection):
-        return tuple([label_coll.name for label_coll in labeled_objects_collection.children])
+        for label_models in self._labeled_models.values():
+            for model_objects in label_models:
+                pass_index = model_instance_ids[model_objects[0].name]
+                for model_object in model_objects:
+                    model_object.pass_index = pass_index
     
-    def _get_structured_labeled_objects(self, labeled_objects_collection):
-        labeled_objects = dict()
-        for label_collection in labeled_objects_collection.children:
-            label_name = label_collection.name
-            label_objects = self._get_labeled_objects_for_collection(label_collection)
-            labeled_objects[label_name] = label_objects
-
-        return labeled_objects
-            
-    def _get_all_parent_objects(self, labeled_objects_collection):
-        all_parent_objects = list()
+    def _get_structured_labeled_objects(self, labeled_models):
+        return dict([(label_name, tuple([tuple([model_object.name for model_object in model_objects]) 
+                                         for model_objects in label_models]))
+                     for label_name, label_models in labeled_models.items()])
+    
+    def _get_labeled_models(self, labeled_objects_collection):
+        # Every object of a label collection, its sub-collections included, is visited once; 
+        # the root parents found on the way are remembered for the objects below them
+        labeled_models = dict()
+        root_objects = dict()
         
         for label_collection in labeled_objects_collection.children:
-            all_parent_objects.extend(self._get_parent_objects_for_collection(label_collection))
+            label_models = dict()
+            for labeled_object in label_collection.all_objects:
+                parent_object = labeled_object.parent
+                if parent_object is None:
+                    root_object = labeled_object
+                else:
+                    root_object = root_objects.get(parent_object) or self._get_root_object(parent_object, root_objects)
+                root_objects[labeled_object] = root_object
+                
+                model_objects = label_models.get(root_object)
+                if model_objects is None:
+                    model_objects = label_models[root_object] = [root_object]
+                if labeled_object is not root_object:
+                    model_objects.append(labeled_object)
             
-        return tuple(all_parent_objects)  
-    
-    def _get_labeled_objects_for_collection(self, label_collection):
-        parent_objects = self._get_parent_objects_for_collection(label_collection)
-        label_objects = dict([(parent_object.name, list()) for parent_object in parent_objects])
+            labeled_models[label_collection.name] = tuple([tuple(model_objects) 
+                                                           for model_objects in label_models.values()])
         
-        child_objects = [object for object in label_collection.objects if object.parent is not None]
-        for child_object in child_objects: 
-            parent_object = child_object.parent
-            while parent_object.parent is not None:
-                parent_object = parent_object.parent
-            else:
-                label_objects[parent_object.name].append(child_object.name)
-                    
-        return tuple([(parent, *childs) for parent, childs in label_objects.items()])
+        return labeled_models
     
-    def _get_parent_objects_for_collection(self, label_collection):
-        return tuple([object for object in label_collection.objects if object.parent is None])
+    def _get_root_object(self, labeled_object, root_objects):
+        parent_chain = list()
+        while labeled_object not in root_objects and labeled_object.parent is not None:
+            parent_chain.append(labeled_object)
+            labeled_object = labeled_object.parent
+        
+        root_object = root_objects.setdefault(labeled_object, labeled_object)
+        for chain_object in parent_chain:
+            root_objects[chain_object] = root_object
+            
+        return root_object
      
 
 ############################################################################################################
@@ -280,6 +862,18 @@ class BS_PT_BackgroundSettings(BS_BlenderSyntherButtonsPanel):
             
             col.label(text="Plane textures folder path")
             col.prop(scene, "plane_textures_folder", text="")
+            col.separator()
+            
+            col.label(text="Texture sampling")
+            col.prop(scene, "texture_sampling_mode", text="")
+            col.separator()
+            
+            col.prop(scene, "use_resized_textures")
+            col.operator("bs.preprocess_textures")
+            col.separator()
+            
+            col.prop(scene, "texture_cache_size_mb")
+            col.prop(scene, "textures_to_prefetch")
             
         elif scene.background_type == "custom":
             pass
@@ -300,21 +894,277 @@ class BS_PGT_BackgroundProperies(PropertyGroup):
     bpy.types.Scene.randomly_change_bg_brightness = BoolProperty(
                                       default=True,
                                       name="Randomly Change BG Brightness")
+    bpy.types.Scene.texture_sampling_mode = EnumProperty(
+                                      items=(("round_robin", "Round Robin", "Textures in turn, by item index"),
+                                             ("shuffled", "Shuffled", "Every texture once per pass, in random order"),
+                                             ("weighted", "Weighted", 
+                                              "Random textures weighted by bs_texture_weights.json"),
+                                             ("random", "Random", "Random textures, with replacement")),
+                                      name="Texture Sampling Mode")
+    bpy.types.Scene.use_resized_textures = BoolProperty(
+                                      default=True,
+                                      name="Use Resized Textures",
+                                      description="Use the textures resized to the render resolution if there are any")
+    bpy.types.Scene.texture_cache_size_mb = IntProperty(
+                                      default=1024,
+                                      min=0,
+                                      name="Texture Cache (MB)",
+                                      description="Memory of the decoded background textures kept loaded")
+    bpy.types.Scene.textures_to_prefetch = IntProperty(
+                                      default=4,
+                                      min=0,
+                                      name="Textures To Prefetch",
+                                      description="Textures of the next items read from disk in the background")
+        
+        
+
+class BS_TextureCatalogue:
+    __slots__ = ("_textures_folder", "_texture_paths", "_sampling_mode", "_randomness",
+                 "_cumulative_weights", "_shuffled_epoch", "_shuffled_order")
+    
+    allowed_texture_extensions = (".png", ".jpg", ".jpeg",)
+    sampling_modes = ("round_robin", "shuffled", "weighted", "random")
+    _index_version = 1
+    _weights_file_name = "bs_texture_weights.json"
+    
+    def __init__(self, textures_folder, sampling_mode="round_robin", randomness=None, 
+                 resized_textures_folder=None):
+        if sampling_mode not in self.sampling_modes:
+            raise Exception(f"Unknown texture sampling mode '{sampling_mode}'")
+        
+        self._textures_folder = textures_folder
+        self._sampling_mode = sampling_mode
+        self._randomness = randomness or BS_ItemRandomness(0)
+        self._texture_paths = self._load_texture_paths()
+        # Weights are looked up by the source paths, before they are swapped for the resized ones
+        self._cumulative_weights = self._get_cumulative_weights() if sampling_mode == "weighted" else None
+        if resized_textures_folder is not None and path_exists(resized_textures_folder):
+            self._texture_paths = self._get_resized_texture_paths(resized_textures_folder)
+        self._shuffled_epoch = None
+        self._shuffled_order = None
+    
+    def __len__(self):
+        return len(self._texture_paths)
+    
+    @property
+    def texture_paths(self):
+        return self._texture_paths
+    
+    def get_item_texture_path(self, item_index):
+        return self._texture_paths[self.get_item_texture_num(item_index)]
+    
+    def get_item_texture_num(self, item_index):
+        num_textures = len(self._texture_paths)
+        
+        if self._sampling_mode == "round_robin":
+            return item_index % num_textures
+        
+        if self._sampling_mode == "shuffled":
+            # Every pass over the textures is an own permutation, it is computed once per pass
+            epoch, epoch_position = divmod(item_index, num_textures)
+            if epoch != self._shuffled_epoch:
+                shuffle_keys = self._randomness.uniform([epoch], "textures.shuffled", size=num_textures)[0]
+                self._shuffled_order = numpy.argsort(shuffle_keys, kind="stable")
+                self._shuffled_epoch = epoch
+            return int(self._shuffled_order[epoch_position])
         
+        if self._sampling_mode == "weighted":
+            weight_value = self._randomness.uniform([item_index], "textures.weighted")[0, 0] 
+            weight_value *= self._cumulative_weights[-1]
+            return min(int(numpy.searchsorted(self._cumulative_weights, weight_value, side="right")), 
+                       num_textures - 1)
         
+        return int(self._randomness.integers([item_index], "textures.random", 0, num_textures)[0, 0])
+    
+    def _load_texture_paths(self):
+        index_path = self._get_index_path()
+        
+        texture_index = self._read_index(index_path)
+        if texture_index is None:
+            texture_index = self._scan_textures_folder()
+            self._write_index(index_path, texture_index)
+        
+        return tuple([join_path(self._textures_folder, texture_path) for texture_path in texture_index["textures"]])
+    
+    def _get_resized_texture_paths(self, resized_textures_folder):
+        # Textures which did not need resizing are taken from the source folder
+        resized_texture_paths = set([os.path.relpath(resized_texture_path, resized_textures_folder) for 
+                                     resized_texture_path in BS_TextureCatalogue(resized_textures_folder).texture_paths])
+        
+        texture_paths = list()
+        for texture_path in self._texture_paths:
+            relative_texture_path = os.path.relpath(texture_path, self._textures_folder)
+            if relative_texture_path in resized_texture_paths:
+                texture_path = join_path(resized_textures_folder, relative_texture_path)
+            texture_paths.append(texture_path)
+        
+        return tuple(texture_paths)
+    
+    def _get_index_path(self):
+        textures_folder_key = hashlib.sha1(os.path.abspath(self._textures_folder).encode()).hexdigest()
+        return join_path(tempfile.gettempdir(), "blendersynther", f"texture_index_{textures_folder_key}.json")
+    
+    def _read_index(self, index_path):
+        # Adding, removing or renaming a file changes the mtime of its folder, 
+        # so checking the folders is enough to invalidate the index
+        try:
+            with open(index_path, "r") as index_file:
+                texture_index = json.load(index_file)
+            if texture_index.get("version", None) != self._index_version:
+                return None
+            for folder_path, folder_mtime in texture_index["folders"].items():
+                if os.stat(join_path(self._textures_folder, folder_path)).st_mtime_ns != folder_mtime:
+                    return None
+        except (OSError, ValueError, KeyError):
+            return None
+        
+        return texture_index
+    
+    def _write_index(self, index_path, texture_index):
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        temporary_index_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(temporary_index_path, "w") as index_file:
+            json.dump(texture_index, index_file)
+        os.replace(temporary_index_path, index_path)
+    
+    def _scan_textures_folder(self):
+        folders = dict()
+        texture_paths = list()
+        
+        # Hidden folders are skipped, they hold caches like the resized textures
+        folders_to_scan = [""]
+        while folders_to_scan:
+            folder_path = folders_to_scan.pop()
+            absolute_folder_path = join_path(self._textures_folder, folder_path)
+            folders[folder_path] = os.stat(absolute_folder_path).st_mtime_ns
+            
+            with os.scandir(absolute_folder_path) as folder_entries:
+                for folder_entry in folder_entries:
+                    entry_path = join_path(folder_path, folder_entry.name) if folder_path else folder_entry.name
+                    if folder_entry.is_dir(follow_symlinks=False):
+                        if not folder_entry.name.startswith("."):
+                            folders_to_scan.append(entry_path)
+                    elif folder_entry.name.lower().endswith(self.allowed_texture_extensions):
+                        texture_paths.append(entry_path)
+        
+        texture_paths.sort()
+        return {"version": self._index_version, "folders": folders, "textures": texture_paths}
+    
+    def _get_cumulative_weights(self):
+        # Weights are given per folder or file relative to the textures folder, the deepest match wins
+        weights_path = join_path(self._textures_folder, self._weights_file_name)
+        path_weights = dict()
+        if path_exists(weights_path):
+            with open(weights_path, "r") as weights_file:
+                path_weights = dict([(os.path.normpath(path), float(weight)) 
+                                     for path, weight in json.load(weights_file).items()])
+        
+        texture_weights = numpy.ones(len(self._texture_paths), dtype=numpy.float64)
+        for texture_num, texture_path in enumerate(self._texture_paths):
+            texture_path = os.path.relpath(texture_path, self._textures_folder)
+            while texture_path:
+                if texture_path in path_weights:
+                    texture_weights[texture_num] = path_weights[texture_path]
+                    break
+                texture_path = os.path.dirname(texture_path)
+        
+        if texture_weights.min() < 0 or texture_weights.sum() <= 0:
+            raise Exception(f"Texture weights in '{weights_path}' must be non-negative and not all zero")
+        
+        return numpy.cumsum(texture_weights)
+        
+
+class BS_TexturePreprocessor:
+    __slots__ = ("_textures_folder", "_target_size", "_resized_textures_folder")
+    
+    @staticmethod
+    def get_target_size(scene):
+        render = scene.render
+        return (max(1, render.resolution_x * render.resolution_percentage // 100),
+                max(1, render.resolution_y * render.resolution_percentage // 100))
+    
+    @staticmethod
+    def get_resized_textures_folder(textures_folder, target_size):
+        # Hidden folder, so the texture catalogue does not take the resized textures for the source ones
+        return join_path(textures_folder, f".bs_resized_{target_size[0]}x{target_size[1]}")
+    
+    @classmethod
+    def from_scene(cls, scene):
+        return cls(scene.plane_textures_folder, cls.get_target_size(scene))
+    
+    def __init__(self, textures_folder, target_size):
+        self._textures_folder = textures_folder
+        self._target_size = target_size
+        self._resized_textures_folder = self.get_resized_textures_folder(textures_folder, target_size)
+    
+    def launch(self, num_workers):
+        os.makedirs(self._resized_textures_folder, exist_ok=True)
+        
+        workers_script_args = list()
+        for shard_id in range(num_workers):
+            workers_script_args.append(["--preprocess-textures", 
+                                        "--textures-folder", os.path.abspath(self._textures_folder),
+                                        "--target-size", *[str(size) for size in self._target_size],
+                                        "--shards", str(num_workers), "--shard-id", str(shard_id)])
+            
+        return BS_ShardLauncher.run_workers(workers_script_args, self._resized_textures_folder)
+    
+    def resize_textures(self, shard_id=0, num_shards=1):
+        texture_paths = BS_TextureCatalogue(self._textures_folder).texture_paths
+        for texture_path in texture_paths[shard_id::num_shards]:
+            self._resize_texture(texture_path)
+    
+    def _resize_texture(self, texture_path):
+        resized_texture_path = join_path(self._resized_textures_folder, 
+                                         os.path.relpath(texture_path, self._textures_folder))
+        if (path_exists(resized_texture_path) 
+                and os.path.getmtime(resized_texture_path) >= os.path.getmtime(texture_path)):
+            return
+        
+        texture = bpy.data.images.load(texture_path)
+        try:
+            # The texture still has to cover the whole frame, it is never upscaled
+            width, height = texture.size
+            scale = max(self._target_size[0] / width, self._target_size[1] / height)
+            if scale >= 1:
+                return
+            texture.scale(max(1, round(width * scale)), max(1, round(height * scale)))
+            
+            texture_name, texture_extension = os.path.splitext(resized_texture_path)
+            temporary_texture_path = f"{texture_name}.tmp{texture_extension}"
+            os.makedirs(os.path.dirname(resized_texture_path), exist_ok=True)
+            texture.filepath_raw = temporary_texture_path
+            texture.file_format = "PNG" if texture_extension.lower() == ".png" else "JPEG"
+            texture.save()
+            os.replace(temporary_texture_path, resized_texture_path)
+        finally:
+            bpy.data.images.remove(texture)
+    
 
 class BS_BackgroundPlane:
     __slots__ = ("_plane", "_material")
     
-    def insert_animation_keyframe(self, frame_num):
-        self._material.insert_animation_keyframe(frame_num)
+    def bake_animation(self, frames, randomness):
+        self._material.bake_animation(frames, randomness)
         
-    def __init__(self, context):
+    def clear_animation(self):
+        self._material.clear_animation()
+        
+    def apply_item_state(self, item_index, randomness):
+        self._material.apply_item_state(item_index, randomness)
+        
+    def __init__(self, context, randomness):
         self._plane = self._set_plane(context)
-        self._material = self._Material(context, self._plane)
+        self._material = self._Material(context, self._plane, randomness)
         
-    def set_next_texture(self):
-        self._material.set_next_texture()
+    def set_item_texture(self, item_index):
+        self._material.set_item_texture(item_index)
+    
+    def stop_prefetching(self):
+        self._material.stop_prefetching()
+    
+    def get_item_parameters(self, item_index, randomness):
+        return self._material.get_item_parameters(item_index, randomness)
           
     def _set_plane(self, context):
         plane = context.scene.background_plane
@@ -322,35 +1172,140 @@ class BS_BackgroundPlane:
             return plane
         raise Exception("You have to specify the plane")
         
+    class _TextureCache:
+        __slots__ = ("_images", "_max_size", "_num_prefetched_textures", 
+                     "_prefetch_executor", "_prefetched_textures")
+        
+        _prefetch_chunk_size = 2**20
+        
+        def __init__(self, max_size_mb, num_prefetched_textures):
+            self._images = collections.OrderedDict()
+            self._max_size = max_size_mb * 2**20
+            self._num_prefetched_textures = num_prefetched_textures
+            self._prefetch_executor = None
+            self._prefetched_textures = collections.OrderedDict()
+        
+        @property
+        def num_prefetched_textures(self):
+            return self._num_prefetched_textures
+            
+        def get_image(self, texture_path):
+            image = self._images.get(texture_path, None)
+            if image is not None:
+                self._images.move_to_end(texture_path)
+                return image
+            
+            # Waits only if the prefetching of this texture has not finished yet
+            prefetched_texture = self._prefetched_textures.pop(texture_path, None)
+            if prefetched_texture is not None:
+                prefetched_texture.result()
+                
+            with bs_profiler.span("texture load", "io"):
+                image = bpy.data.images.load(texture_path, check_existing=True)
+            self._images[texture_path] = image
+            
+            return image
+        
+        def prefetch(self, texture_paths):
+            if not self._num_prefetched_textures:
+                return
+            if self._prefetch_executor is None:
+                self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+                                              max_workers=2, thread_name_prefix="BS Texture Prefetch")
+            
+            for texture_path in texture_paths:
+                if texture_path in self._images or texture_path in self._prefetched_textures:
+                    continue
+                self._prefetched_textures[texture_path] = self._prefetch_executor.submit(
+                                                              self._read_texture_file, texture_path)
+            
+            # Textures which were prefetched but never requested are forgotten
+            while len(self._prefetched_textures) > self._num_prefetched_textures:
+                self._prefetched_textures.popitem(last=False)
+        
+        def stop_prefetching(self):
+            if self._prefetch_executor is not None:
+                self._prefetch_executor.shutdown(wait=False)
+                self._prefetch_executor = None
+            self._prefetched_textures.clear()
+        
+        def _read_texture_file(self, texture_path):
+            # Reading the file ahead brings it into the OS page cache, so loading it later does not wait on disk
+            with open(texture_path, "rb") as texture_file:
+                while texture_file.read(self._prefetch_chunk_size):
+                    pass
+                    
+        def _get_image_size(self, image):
+            width, height = image.size
+            bytes_per_channel = 4 if image.is_float else 1
+            
+            return width * height * image.channels * bytes_per_channel
+            
+        def evict_images(self, current_image):
+            # Called once the node uses the current image, so the replaced one has no users left
+            cached_size = sum([self._get_image_size(image) for image in self._images.values()])
+            
+            for texture_path, image in tuple(self._images.items()):
+                if cached_size <= self._max_size:
+                    break
+                if image == current_image:
+                    continue
+                
+                cached_size -= self._get_image_size(image)
+                del self._images[texture_path]
+                # Images used by anything else than the background plane stay in the blend data
+                if image.users == 0:
+                    bpy.data.images.remove(image)
+        
     class _Material:
         __slots__ = ("_vary_brightness", "_material_textures_folder",
                          "_material", "_name", "_plane",
-                         "_material_texture_paths", "_allowed_texture_extensions",
-                         "_emission_node", "_image_texture_node", "_material_output_node")
+                         "_texture_catalogue", "_emission_node", "_image_texture_node", 
+                         "_material_output_node", "_texture_cache")
             
-        def __init__(self, context, plane):
+        def __init__(self, context, plane, randomness):
             self._plane = plane
-            self._allowed_texture_extensions = (".png", ".jpg", ".jpeg",)
             self._name = "BS Plane Material"
             self._vary_brightness = context.scene.randomly_change_bg_brightness
-            self._material_textures_folder = self._set_textures_folder(context)
-            self._material_texture_paths = self._get_material_texture_paths()
+            self._material_textures_folder = context.scene.plane_textures_folder
+            self._texture_catalogue = self._get_texture_catalogue(context, randomness)
             self._material = self._create_material(context)
+            self._texture_cache = BS_BackgroundPlane._TextureCache(context.scene.texture_cache_size_mb,
+                                                                   context.scene.textures_to_prefetch)
         
-        def insert_animation_keyframe(self, frame_num):
-            self._randomly_change_brightness()
-            self._emission_node.inputs["Strength"].keyframe_insert(data_path="default_value", frame=frame_num)
+        def bake_animation(self, frames, randomness):
+            emission_strengths = self.get_random_brightness(frames, randomness)
             
-        def _set_textures_folder(self, context):
-            plane_textures_folder = context.scene.plane_textures_folder
-
-            for file_name in os.listdir(plane_textures_folder):
-                if file_name.endswith(self._allowed_texture_extensions):
-                    return plane_textures_folder
+            node_tree = self._material.node_tree
+            action = BS_AnimationBaker.get_action(node_tree, f"{self._name} Action")
+            strength_data_path = self._emission_node.inputs["Strength"].path_from_id("default_value")
+            BS_AnimationBaker.bake_fcurve(action, strength_data_path, frames, emission_strengths)
+            
+        def clear_animation(self):
+            strength_data_path = self._emission_node.inputs["Strength"].path_from_id("default_value")
+            BS_AnimationBaker.clear_fcurve(self._material.node_tree, strength_data_path)
+            
+        def apply_item_state(self, item_index, randomness):
+            emission_strength = float(self.get_random_brightness([item_index], randomness)[0])
+            self._emission_node.inputs["Strength"].default_value = emission_strength
+            
+        def _get_texture_catalogue(self, context, randomness):
+            resized_textures_folder = None
+            if context.scene.use_resized_textures:
+                resized_textures_folder = BS_TexturePreprocessor.get_resized_textures_folder(
+                                              self._material_textures_folder,
+                                              BS_TexturePreprocessor.get_target_size(context.scene))
+                
+            texture_catalogue = BS_TextureCatalogue(self._material_textures_folder,
+                                                    sampling_mode=context.scene.texture_sampling_mode,
+                                                    randomness=randomness,
+                                                    resized_textures_folder=resized_textures_folder)
+            if len(texture_catalogue):
+                return texture_catalogue
                     
-            raise FileNotFoundError("Background textures folder must have at least 1 texture",
-                                        "with allowed extension.\n",
-                                        f"Allowed extensions are {allowed_texture_extensions}")
+            raise FileNotFoundError("Background textures folder must have at least 1 texture "
+                                    "with allowed extension.\n"
+                                    f"Allowed extensions are {BS_TextureCatalogue.allowed_texture_extensions}")
     
         def _create_material(self, context):
             material_name = self._name
@@ -386,23 +1341,50 @@ class BS_BackgroundPlane:
                 
             return material
             
-        def _randomly_change_brightness(self):
-            emission_strength = random.uniform(0.050, 2.990)
-            self._emission_node.inputs["Strength"].default_value = emission_strength
+        def get_item_parameters(self, item_index, randomness):
+            if self._vary_brightness:
+                emission_strength = float(self.get_random_brightness([item_index], randomness)[0])
+            else:
+                emission_strength = self._emission_node.inputs["Strength"].default_value
+            
+            return {"texture": self.get_item_texture_path(item_index), "emission_strength": emission_strength}
+        
+        def get_random_brightness(self, item_indices, randomness):
+            return randomness.uniform(item_indices, "background_plane.brightness", 0.050, 2.990)[:, 0]
                     
-        def _get_material_texture_paths(self):
-            material_textures_folder = itertools.cycle(os.listdir(self._material_textures_folder))
-            material_textures_folder_path = self._material_textures_folder
-                
-            for material_texture_file in material_textures_folder:
-                yield join_path(material_textures_folder_path, material_texture_file) 
+        def get_item_texture_path(self, item_index):
+            # Textures are picked by item index, so the texture of an item does not depend on the run
+            return self._texture_catalogue.get_item_texture_path(item_index)
                 
-        def set_next_texture(self):
-            material_texture_path = next(self._material_texture_paths)
-            material_texture = bpy.data.images.load(material_texture_path, check_existing=True)
-            self._image_texture_node.image = material_texture
-            #bpy.data.images.remove(material_texture)
+        def set_item_texture(self, item_index):
+            material_texture_path = self.get_item_texture_path(item_index)
+            image = self._texture_cache.get_image(material_texture_path)
+            self._image_texture_node.image = image
+            self._texture_cache.evict_images(image)
+            
+            num_prefetched_textures = self._texture_cache.num_prefetched_textures
+            next_texture_paths = [self.get_item_texture_path(next_item_index) for next_item_index 
+                                  in range(item_index + 1, item_index + 1 + num_prefetched_textures)]
+            self._texture_cache.prefetch(next_texture_paths)
+        
+        def stop_prefetching(self):
+            self._texture_cache.stop_prefetching()
                  
+class BS_OT_PreprocessTextures(Operator):
+    bl_label = "Resize Textures"
+    bl_idname = "bs.preprocess_textures"
+    bl_description = "Resize the plane textures to the render resolution using a Blender process per CPU"
+    
+    def execute(self, context):
+        texture_preprocessor = BS_TexturePreprocessor.from_scene(context.scene)
+        failed_shard_ids = texture_preprocessor.launch(os.cpu_count() or 1)
+        
+        if failed_shard_ids:
+            self.report({"ERROR"}, f"Resizing failed in shards {failed_shard_ids}")
+            return {"CANCELLED"}
+        return {"FINISHED"}
+    
+    
 class BS_BackgroundCustom:
     def __init__(self, context):
         pass
@@ -425,11 +1407,21 @@ class BS_PT_Lights(BS_BlenderSyntherButtonsPanel):
       
         col = flow.column()
         col.prop(scene, "randomly_toggle_lights")
+        col.prop(scene, "randomize_lights_energy")
+        if scene.randomize_lights_energy:
+            col.prop(scene, "lights_energy_variation")
+        col.prop(scene, "randomize_lights_color")
+        if scene.randomize_lights_color:
+            col.prop(scene, "lights_color_variation")
+        col.prop(scene, "randomize_lights_position")
+        if scene.randomize_lights_position:
+            col.prop(scene, "lights_position_offset")
         
         col = flow.column()
-        col.enabled = context.scene.randomly_toggle_lights
+        col.enabled = BS_Lights.is_randomization_enabled(scene)
         col.label(text="Lights collection")
         col.prop(scene, "lights_collection", text="")
+        col.operator("bs.reset_lights")
         
         
 class BS_PGT_LightsProperties(PropertyGroup):
@@ -439,41 +1431,253 @@ class BS_PGT_LightsProperties(PropertyGroup):
     bpy.types.Scene.randomly_toggle_lights = BoolProperty(
                                       default=True,
                                       name="Randomly Toggle Lights")
+    bpy.types.Scene.randomize_lights_energy = BoolProperty(
+                                      default=False,
+                                      name="Randomize Energy")
+    bpy.types.Scene.lights_energy_variation = FloatProperty(
+                                      default=0.5,
+                                      min=0.0,
+                                      max=1.0,
+                                      name="Energy Variation",
+                                      description="Energy of a light is its own energy scaled by a random factor "
+                                                  "from 1 - variation to 1 + variation")
+    bpy.types.Scene.randomize_lights_color = BoolProperty(
+                                      default=False,
+                                      name="Randomize Color")
+    bpy.types.Scene.lights_color_variation = FloatProperty(
+                                      default=0.2,
+                                      min=0.0,
+                                      max=1.0,
+                                      name="Color Variation",
+                                      description="Every color channel of a light is scaled by a random factor "
+                                                  "from 1 - variation to 1 + variation")
+    bpy.types.Scene.randomize_lights_position = BoolProperty(
+                                      default=False,
+                                      name="Randomize Position")
+    bpy.types.Scene.lights_position_offset = FloatProperty(
+                                      default=1.0,
+                                      min=0.0,
+                                      unit="LENGTH",
+                                      name="Position Offset",
+                                      description="Lights are moved from their own location by up to "
+                                                  "this distance along every axis")
 
      
 class BS_Lights:
-    __slots__ = ("_lights", "_num_lights",)
+    __slots__ = ("_lights", "_num_lights", "_lights_collection", "_light_data_nums", "_light_datas", 
+                 "_toggle", "_energy_variation", "_color_variation", "_position_offset",
+                 "_base_locations", "_base_energies", "_base_colors")
+    
+    # Lights are randomized around the values they had before the generation, which are kept in custom 
+    # properties while the baked F-Curves hide them; without the F-Curves the current values are taken
+    _base_location_key = "bs_base_location"
+    _base_energy_key = "bs_base_energy"
+    _base_color_key = "bs_base_color"
+    
+    @staticmethod
+    def is_randomization_enabled(scene):
+        return (scene.randomly_toggle_lights or scene.randomize_lights_energy 
+                or scene.randomize_lights_color or scene.randomize_lights_position)
+    
+    @property
+    def num_lights(self):
+        return self._num_lights
+    
+    def bake_animation(self, frames, randomness):
+        light_states = self.get_random_states(frames, randomness)
+        
+        for light_num, light in enumerate(self._lights):
+            if "hide_render" in light_states or "location" in light_states:
+                action = BS_AnimationBaker.get_action(light, f"BS {light.name} Action")
+            if "hide_render" in light_states:
+                BS_AnimationBaker.bake_fcurve(action, "hide_render", frames, light_states["hide_render"][:, light_num])
+            if "location" in light_states:
+                for axis in range(3):
+                    BS_AnimationBaker.bake_fcurve(action, "location", frames, 
+                                                  light_states["location"][:, light_num, axis], index=axis)
+        
+        for light_data_num, light_data in enumerate(self._light_datas):
+            if "energy" in light_states or "color" in light_states:
+                action = BS_AnimationBaker.get_action(light_data, f"BS {light_data.name} Action")
+            if "energy" in light_states:
+                BS_AnimationBaker.bake_fcurve(action, "energy", frames, light_states["energy"][:, light_data_num])
+            if "color" in light_states:
+                for channel in range(3):
+                    BS_AnimationBaker.bake_fcurve(action, "color", frames, 
+                                                  light_states["color"][:, light_data_num, channel], index=channel)
+            
+    def clear_animation(self):
+        for light in self._lights:
+            BS_AnimationBaker.clear_fcurve(light, "hide_render")
+            for axis in range(3):
+                BS_AnimationBaker.clear_fcurve(light, "location", index=axis)
+        for light_data in self._light_datas:
+            BS_AnimationBaker.clear_fcurve(light_data, "energy")
+            for channel in range(3):
+                BS_AnimationBaker.clear_fcurve(light_data, "color", index=channel)
+        self._set_base_values()
     
-    def insert_animation_keyframe(self, frame_num):
-        self._randomly_toggle()
+    def restore_base_values(self):
+        # The lights get their base values back and edits of them are taken by the next generation
+        self._set_base_values()
         for light in self._lights:
-            light.keyframe_insert(data_path="hide_render", frame=frame_num)
+            if self._base_location_key in light:
+                del light[self._base_location_key]
+        for light_data in self._light_datas:
+            for base_value_key in (self._base_energy_key, self._base_color_key):
+                if base_value_key in light_data:
+                    del light_data[base_value_key]
+    
+    def _set_base_values(self):
+        for light, base_location in zip(self._lights, self._base_locations):
+            light.location = base_location
+        for light_data, base_energy, base_color in zip(self._light_datas, self._base_energies, self._base_colors):
+            light_data.energy = base_energy
+            light_data.color = base_color
             
-    def _randomly_toggle(self):
-        lights_to_toggle = random.choices(self._lights, k=random.randint(1, self._num_lights))
+    def apply_item_state(self, item_index, randomness):
+        light_states = self.get_random_states([item_index], randomness)
         
-        for light in lights_to_toggle:
-            light.hide_viewport = not light.hide_viewport
-            light.hide_render = not light.hide_render
-            
-    def __init__(self, context):
-        if context.scene.lights_collection:
-            self._lights = context.scene.lights_collection.all_objects
-            self._num_lights = len(self._lights)
+        # Object properties are set for the whole collection at once, hide_viewport is never touched, 
+        # so the viewport depsgraph is not rebuilt during the render
+        light_objects = self._lights_collection.all_objects
+        if "hide_render" in light_states:
+            light_objects.foreach_set("hide_render", light_states["hide_render"][0].tolist())
+        if "location" in light_states:
+            light_objects.foreach_set("location", light_states["location"][0].astype(numpy.float32).ravel())
+        for light_data_num, light_data in enumerate(self._light_datas):
+            if "energy" in light_states:
+                light_data.energy = light_states["energy"][0, light_data_num]
+            if "color" in light_states:
+                light_data.color = light_states["color"][0, light_data_num]
             
+    def get_item_parameters(self, item_index, randomness):
+        light_states = self.get_random_states([item_index], randomness)
+        
+        light_names = [light.name for light in self._lights]
+        light_data_names = [light_data.name for light_data in self._light_datas]
+        
+        item_parameters = dict()
+        if "hide_render" in light_states:
+            item_parameters["lights"] = dict(zip(light_names, (~light_states["hide_render"][0]).tolist()))
+        if "location" in light_states:
+            item_parameters["lights_location"] = dict(zip(light_names, light_states["location"][0].tolist()))
+        if "energy" in light_states:
+            item_parameters["lights_energy"] = dict(zip(light_data_names, light_states["energy"][0].tolist()))
+        if "color" in light_states:
+            item_parameters["lights_color"] = dict(zip(light_data_names, light_states["color"][0].tolist()))
+        
+        return item_parameters
+    
+    def get_random_states(self, item_indices, randomness):
+        # Every light is randomized independently for every item, arrays are (items, lights[, channels])
+        num_items = len(item_indices)
+        num_light_datas = len(self._light_datas)
+        light_states = dict()
+        
+        if self._toggle:
+            switch_values = randomness.uniform(item_indices, "lights.hide_render", size=self._num_lights)
+            light_states["hide_render"] = switch_values < 0.5
+        if self._position_offset is not None:
+            location_offsets = randomness.uniform(item_indices, "lights.location", -self._position_offset, 
+                                                  self._position_offset, size=self._num_lights * 3)
+            light_states["location"] = self._base_locations + location_offsets.reshape(num_items, self._num_lights, 3)
+        if self._energy_variation is not None:
+            energy_factors = randomness.uniform(item_indices, "lights.energy", 1.0 - self._energy_variation, 
+                                                1.0 + self._energy_variation, size=num_light_datas)
+            light_states["energy"] = self._base_energies * energy_factors
+        if self._color_variation is not None:
+            color_factors = randomness.uniform(item_indices, "lights.color", 1.0 - self._color_variation, 
+                                               1.0 + self._color_variation, size=num_light_datas * 3)
+            light_states["color"] = numpy.clip(self._base_colors * color_factors.reshape(num_items, num_light_datas, 3), 
+                                               0.0, 1.0)
+        
+        return light_states
+            
+    def __init__(self, context):
+        scene = context.scene
+        self._lights_collection = scene.lights_collection
+        self._lights = tuple()
+        self._num_lights = 0
+        self._light_datas = tuple()
+        
+        self._toggle = scene.randomly_toggle_lights
+        self._energy_variation = scene.lights_energy_variation if scene.randomize_lights_energy else None
+        self._color_variation = scene.lights_color_variation if scene.randomize_lights_color else None
+        self._position_offset = scene.lights_position_offset if scene.randomize_lights_position else None
+        
+        if self._lights_collection:
+            self._lights = tuple(self._lights_collection.all_objects)
+            self._num_lights = len(self._lights)
+            # Light data shared by several objects is randomized once
+            self._light_datas = tuple(dict.fromkeys([light.data for light in self._lights if light.type == "LIGHT"]))
+        
+        self._base_locations = self._get_base_values(self._lights, self._base_location_key, "location").reshape(-1, 3)
+        self._base_energies = self._get_base_values(self._light_datas, self._base_energy_key, "energy")
+        self._base_colors = self._get_base_values(self._light_datas, self._base_color_key, "color").reshape(-1, 3)
+    
+    def _get_base_values(self, id_datas, base_value_key, property_name):
+        base_values = list()
+        for id_data in id_datas:
+            if base_value_key not in id_data or not BS_AnimationBaker.has_fcurve(id_data, property_name):
+                property_value = getattr(id_data, property_name)
+                id_data[base_value_key] = property_value if isinstance(property_value, float) else tuple(property_value)
+            base_value = id_data[base_value_key]
+            base_values.append(base_value if isinstance(base_value, float) else tuple(base_value))
+        
+        return numpy.array(base_values, dtype=numpy.float64)
+            
+            
+            
+class BS_OT_ResetLights(Operator):
+    bl_label = "Reset Lights"
+    bl_idname = "bs.reset_lights"
+    bl_description = ("Remove the baked light animation and give the lights back the values they are "
+                      "randomized around")
+    
+    def execute(self, context):
+        if not context.scene.lights_collection:
+            self.report({"ERROR"}, "You have to specify the lights collection")
+            return {"CANCELLED"}
+        
+        lights = BS_Lights(context)
+        lights.clear_animation()
+        lights.restore_base_values()
+        return {"FINISHED"}
             
             
 ############################################################################################################
 #                                              CAMERA
 ############################################################################################################
-class BS_OT_CameraSetupToTrack(Operator):
-    bl_label = "Setup The Camera"
-    bl_idname = "camera.setup_to_track"
-    _camera_container_name = "Camera Container" 
+class BS_OT_PreviewCameraViewpoints(Operator):
+    bl_label = "Preview Viewpoints"
+    bl_idname = "camera.preview_viewpoints"
+    bl_description = "Create a curve through the camera viewpoints at the max radius"
+    _preview_name = "BS Camera Viewpoints"
     
     def execute(self, context):
-        camera_container = BS_CameraContainer()
-        #  simplify camera setup
+        scene = context.scene
+        viewpoint_locations = (BS_Camera.get_target_location(scene) 
+                               + BS_Camera.get_viewpoint_directions(scene) * scene.camera_max_radius)
+        
+        preview_curve = bpy.data.curves.get(self._preview_name, None)
+        if preview_curve is not None:
+            bpy.data.curves.remove(preview_curve)
+        preview_curve = bpy.data.curves.new(self._preview_name, type="CURVE")
+        preview_curve.dimensions = "3D"
+        spline = preview_curve.splines.new("POLY")
+        spline.points.add(count=len(viewpoint_locations) - 1)
+        
+        points_co = numpy.ones((len(viewpoint_locations), 4), dtype=numpy.float32)
+        points_co[:, :3] = viewpoint_locations
+        spline.points.foreach_set("co", points_co.ravel())
+        
+        preview_object = bpy.data.objects.get(self._preview_name, None)
+        if preview_object is None:
+            preview_object = bpy.data.objects.new(self._preview_name, preview_curve)
+            scene.collection.objects.link(preview_object)
+        preview_object.data = preview_curve
+        preview_object.hide_render = True
         
         return {"FINISHED"}
     
@@ -482,62 +1686,49 @@ class BS_PGT_CameraProperies(PropertyGroup):
     bpy.types.Scene.shooting_camera = PointerProperty(
                                       type=bpy.types.Object,
                                       name="Shooting Camera")
+    # Blend files store the item numbers, 1 was the removed "follow_path", so it must not be reused
     bpy.types.Scene.camera_position_type = EnumProperty(
-                                      items=(("fixed", "Fixed", ""),
-                                             ("follow_path", "Follow Path", "")),
+                                      items=(("fixed", "Fixed", "The camera stays where it is", 0),
+                                             ("viewpoints", "Viewpoints", 
+                                              "The camera looks at the labeled objects from precomputed viewpoints "
+                                              "on a sphere around them", 2)),
                                       name="Camera Position Type") 
-                                          
-# Inner of 
-class Paths:
-    _half_loxodrome = None
-    
-    def execute(self, context):
-        camera_paths_collection = BS_CollectionsManager().camera_paths_collection
-        points = self._get_loxocurve_points()
-        loxocurve = bpy.data.curves.new("loxo", type='CURVE')
-        loxocurve.dimensions = '3D'
-        loxocurve.resolution_u = 2
-        spline = loxocurve.splines.new('NURBS')
-        spline.points.add(count=len(points) - 1)
-
-        for i, bp in enumerate(spline.points):
-            bp.co = (*points[i], 1)
-
-        loxodrome = bpy.data.objects.new(self.bl_label, loxocurve)    
-        camera_paths_collection.objects.link(loxodrome)
-        
-        return {"FINISHED"}
-    
-    def _get_loxocurve_points(self):
-        spirals = 17
-        revs = 23
-        angle_step = 10
-        
-        a = 1 / spirals
-        degs = floor(180 * revs)
-        end_degs = 0 if self._half_loxodrome else degs
-        segs = [radians(d) for d in range(-degs, end_degs, angle_step)]
-        
-        loxocurve_points = list()
-        for t in segs:
-            den = sqrt(1 + a**2 * t**2)
-            x = cos(t) / den
-            y = sin(t) / den
-            z = -a * t / den
-            loxocurve_points.append(Vector((x, y, z)))    
-             
-        return loxocurve_points
-
-class BS_OT_FullLoxoromeGenerator(Paths, Operator):
-    bl_label = "Full Sphere"
-    bl_idname = 'curve.full_sphere' 
-    _half_loxodrome = False
-
-
-class BS_OT_HalfLoxoromeGenerator(Paths, Operator):
-    bl_label = "Half Sphere"
-    bl_idname = 'curve.half_sphere' 
-    _half_loxodrome = True
+    bpy.types.Scene.camera_viewpoint_sampling = EnumProperty(
+                                      items=(("fibonacci", "Fibonacci Lattice", 
+                                              "Viewpoints spread evenly over the sphere"),
+                                             ("loxodrome", "Loxodrome", 
+                                              "Viewpoints along a spiral from the lowest to the highest elevation")),
+                                      name="Viewpoint Sampling")
+    bpy.types.Scene.camera_viewpoints = IntProperty(
+                                      default=100,
+                                      min=1,
+                                      name="Viewpoints",
+                                      description="Item i is shot from the viewpoint i modulo the viewpoints")
+    bpy.types.Scene.camera_min_radius = FloatProperty(
+                                      default=5.0,
+                                      min=0.0,
+                                      unit="LENGTH",
+                                      name="Min Radius")
+    bpy.types.Scene.camera_max_radius = FloatProperty(
+                                      default=5.0,
+                                      min=0.0,
+                                      unit="LENGTH",
+                                      name="Max Radius",
+                                      description="Distance of the camera to the labeled objects is random "
+                                                  "between the min and max radius")
+    bpy.types.Scene.camera_min_elevation = FloatProperty(
+                                      default=radians(-90),
+                                      min=radians(-90),
+                                      max=radians(90),
+                                      subtype="ANGLE",
+                                      name="Min Elevation",
+                                      description="0 keeps the camera on the upper hemisphere")
+    bpy.types.Scene.camera_max_elevation = FloatProperty(
+                                      default=radians(90),
+                                      min=radians(-90),
+                                      max=radians(90),
+                                      subtype="ANGLE",
+                                      name="Max Elevation")
     
     
 class BS_PT_Camera(BS_BlenderSyntherButtonsPanel):
@@ -568,86 +1759,145 @@ class BS_PT_CameraSettings(BS_BlenderSyntherButtonsPanel):
         scene = context.scene
         flow = layout.grid_flow(row_major=True, even_columns=False, even_rows=False, align=True)
         
-        if scene.camera_position_type == "follow_path":   
+        if scene.camera_position_type == "viewpoints":   
             col = flow.column()       
-            col.label(text="Generate a path")
-            col.operator("curve.full_sphere")
-            col.operator("curve.half_sphere")
+            col.prop(scene, "camera_viewpoint_sampling")
+            col.prop(scene, "camera_viewpoints")
+            col.separator()
+            
+            col.prop(scene, "camera_min_radius")
+            col.prop(scene, "camera_max_radius")
+            col.prop(scene, "camera_min_elevation")
+            col.prop(scene, "camera_max_elevation")
             col.separator()
             
-            col.label(text="Camera Setup")
-            col.operator("camera.setup_to_track")
+            col.operator("camera.preview_viewpoints")
         elif scene.camera_position_type == "fixed":
             pass
              
               
 class BS_Camera:
-    _camera_container_name = "Camera Container"
+    __slots__ = ("_camera", "_target_location", "_viewpoint_directions", "_min_radius", "_max_radius")
     
-    class _Fixed:
-        pass
+    _loxodrome_spirals = 17
+    # Elevations are kept off the poles, where the view direction is parallel to the up axis
+    _max_abs_elevation_sine = 0.999
     
-    class _FollowingPath:
-        pass
+    @staticmethod
+    def get_target_location(scene):
+        # The camera looks at the mean location of the labeled models
+        labeled_objects_collection = scene.labeled_objects_collection
+        if not labeled_objects_collection:
+            raise Exception("You have to specify the labeled objects collection")
+        
+        root_locations = [tuple(labeled_object.matrix_world.translation) 
+                          for labeled_object in labeled_objects_collection.all_objects if labeled_object.parent is None]
+        if not root_locations:
+            return numpy.zeros(3)
+        return numpy.mean(root_locations, axis=0)
     
-    @property
-    def camera_container(self):
-        return bpy.data.objects.get(self._camera_container_name, None)
+    @classmethod
+    def get_viewpoint_directions(cls, scene):
+        min_elevation_sine = max(sin(scene.camera_min_elevation), -cls._max_abs_elevation_sine)
+        max_elevation_sine = min(sin(scene.camera_max_elevation), cls._max_abs_elevation_sine)
+        if min_elevation_sine > max_elevation_sine:
+            raise Exception("Camera min elevation must not be above the max elevation")
+        
+        if scene.camera_viewpoint_sampling == "loxodrome":
+            return cls.get_loxodrome_directions(scene.camera_viewpoints, min_elevation_sine, max_elevation_sine)
+        return cls.get_fibonacci_directions(scene.camera_viewpoints, min_elevation_sine, max_elevation_sine)
     
-    def setup_tracking_camera(self, context):
-        scene = context.scene
-        labeled_object = xyu
-        camera_container = BS_Camera().camera_container
-        tracking_camera = scene.shooting_camera
-        camera_container_collection = BS_CollectionsManager().camera_container_collection
-        
-        # Link the tracking camera to the Camera Container collection
-        for tracking_camera_collection in tracking_camera.users_collection:
-            tracking_camera_collection.objects.unlink(tracking_camera)
-        camera_container_collection.objects.link(tracking_camera)
-        
-        # Set the camera to the 3D cursor location
-        cursor_location = scene.cursor.location
-        tracking_camera.location = cursor_location
-        
-        # Set Camera Container as a parent of the tracking camera
-        tracking_camera.parent = camera_container
-        
-        # Set Camera constraint to track the model
-        if tracking_camera.constraints.get("BS Track To", None) is None:
-            tracking_camera_track_to_constr = tracking_camera.constraints.new(type="TRACK_TO")
-            # SET CONSTARINT NAME
-        else:
-            tracking_camera_track_to_constr = tracking_camera.constraints["BS Track To"]
-            
-        tracking_camera_track_to_constr.target = labeled_object
+    @staticmethod
+    def get_fibonacci_directions(num_viewpoints, min_elevation_sine, max_elevation_sine):
+        # Heights evenly spaced between the elevation limits cover equal sphere areas, 
+        # the golden angle between consecutive viewpoints spreads them around the axis
+        viewpoint_nums = numpy.arange(num_viewpoints)
+        z = min_elevation_sine + (viewpoint_nums + 0.5) / num_viewpoints * (max_elevation_sine - min_elevation_sine)
+        azimuths = viewpoint_nums * numpy.pi * (3.0 - sqrt(5.0))
+        
+        return BS_Camera._get_directions(z, azimuths)
+    
+    @classmethod
+    def get_loxodrome_directions(cls, num_viewpoints, min_elevation_sine, max_elevation_sine):
+        # Points of the loxodrome (cos t, sin t, -a t) / sqrt(1 + a^2 t^2) evenly spaced in t, 
+        # t of the elevation limits comes from inverting its z
+        a = 1 / cls._loxodrome_spirals
+        min_t, max_t = [-z / (a * sqrt(1 - z ** 2)) for z in (max_elevation_sine, min_elevation_sine)]
+        t = numpy.linspace(min_t, max_t, num_viewpoints)
+        z = -a * t / numpy.sqrt(1 + a ** 2 * t ** 2)
+        
+        return BS_Camera._get_directions(z, t)
     
-    def setup_camera_container(self, context):
-        camera_container = BS_CameraContainer().camera_container
-        camera_paths_collection = BS_CollectionsManager().camera_paths_collection
+    @staticmethod
+    def _get_directions(z, azimuths):
+        horizontal_lengths = numpy.sqrt(1 - z ** 2)
         
-        def create_camera_container(self):
-            camera_container_collection = BS_CollectionsManager().camera_container_collection
-            if bpy.data.objects.get(self._camera_container_name, None) is None:
-                camera_container = bpy.data.objects.new(self._camera_container_name, None)
-                camera_container_collection.objects.link(camera_container)
+        return numpy.stack((horizontal_lengths * numpy.cos(azimuths), horizontal_lengths * numpy.sin(azimuths), z), 
+                           axis=-1)
+    
+    @staticmethod
+    def get_look_at_rotations(locations, target_location):
+        # The camera looks along its -Z axis with its X axis kept horizontal, 
+        # so the XYZ Euler angles have no gimbal lock
+        z_axes = locations - target_location
+        z_axes /= numpy.linalg.norm(z_axes, axis=-1, keepdims=True)
+        x_axes = numpy.cross((0.0, 0.0, 1.0), z_axes)
+        x_axes /= numpy.linalg.norm(x_axes, axis=-1, keepdims=True)
+        y_axes = numpy.cross(z_axes, x_axes)
+        
+        return numpy.stack((numpy.arctan2(y_axes[:, 2], z_axes[:, 2]), 
+                            numpy.arcsin(-numpy.clip(x_axes[:, 2], -1.0, 1.0)), 
+                            numpy.arctan2(x_axes[:, 1], x_axes[:, 0])), axis=-1)
+    
+    def bake_animation(self, frames, randomness):
+        locations, rotations = self.get_random_poses(frames, randomness)
+        
+        action = BS_AnimationBaker.get_action(self._camera, f"BS {self._camera.name} Action")
+        for axis in range(3):
+            BS_AnimationBaker.bake_fcurve(action, "location", frames, locations[:, axis], index=axis)
+            BS_AnimationBaker.bake_fcurve(action, "rotation_euler", frames, rotations[:, axis], index=axis)
             
-        def set_follow_path_constraint(camera_container, context):
-            if camera_container.constraints.get("BS Follow Path", None) is None:
-                camera_container_follow_path_constr = camera_container.constraints.new(type="FOLLOW_PATH")
-            else:
-                camera_container_follow_path_constr = camera_container.constraints["BS Follow Path"]
-                
-            follow_path_constraint.target = camera_paths_collection.objects[0]
-            follow_path_constraint.use_fixed_location = True
-            follow_path_constraint.use_curve_follow = True
-            follow_path_constraint.use_curve_radius = False
-            follow_path_constraint.forward_axis = "FORWARD_Z"
-            follow_path_constraint.up_axis = "UP_Y"
-            
-            bpy.context.view_layer.objects.active = camera_container
-            bpy.ops.constraint.followpath_path_animate({"constraint": camera_container_follow_path_constr}, 
-                                                        constraint="BS Follow Path")
+    def clear_animation(self):
+        for axis in range(3):
+            BS_AnimationBaker.clear_fcurve(self._camera, "location", index=axis)
+            BS_AnimationBaker.clear_fcurve(self._camera, "rotation_euler", index=axis)
+            
+    def apply_item_state(self, item_index, randomness):
+        locations, rotations = self.get_random_poses([item_index], randomness)
+        
+        self._camera.location = locations[0]
+        self._camera.rotation_euler = rotations[0]
+            
+    def get_item_parameters(self, item_index, randomness):
+        locations, rotations = self.get_random_poses([item_index], randomness)
+        
+        return {"camera": {"location": locations[0].tolist(), "rotation_euler": rotations[0].tolist()}}
+    
+    def get_random_poses(self, item_indices, randomness):
+        item_indices = numpy.asarray(item_indices)
+        viewpoint_directions = self._viewpoint_directions[item_indices % len(self._viewpoint_directions)]
+        radii = randomness.uniform(item_indices, "camera.radius", self._min_radius, self._max_radius)
+        locations = self._target_location + viewpoint_directions * radii
+        
+        return locations, self.get_look_at_rotations(locations, self._target_location)
+    
+    def __init__(self, context):
+        scene = context.scene
+        self._camera = scene.shooting_camera or scene.camera
+        if self._camera is None:
+            raise Exception("You have to specify the shooting camera to use the camera viewpoints")
+        if self._camera.parent is not None:
+            raise Exception("The shooting camera must not have a parent to use the camera viewpoints")
+        
+        self._min_radius = min(scene.camera_min_radius, scene.camera_max_radius)
+        self._max_radius = max(scene.camera_min_radius, scene.camera_max_radius)
+        if self._max_radius <= 0:
+            raise Exception("Camera max radius must be above 0")
+        self._target_location = self.get_target_location(scene)
+        self._viewpoint_directions = self.get_viewpoint_directions(scene)
+        self._camera.rotation_mode = "XYZ"
+        # The moved camera renders the items, also the masks and boxes follow it
+        scene.camera = self._camera
                                               
 
 ############################################################################################################
@@ -669,6 +1919,11 @@ class BS_PT_Annotations(BS_BlenderSyntherButtonsPanel):
         col.enabled = scene.generate_segmentation_masks
         col.label(text="Where to save the segmentation masks")
         col.prop(scene, "segmentation_masks_folder", text="")
+        col.label(text="Segmentation masks method")
+        col.prop(scene, "segmentation_masks_method", text="")
+        
+        col = flow.column()
+        col.prop(scene, "generate_bounding_boxes")
       
           
 class BS_PGT_AnnotationsProperies(PropertyGroup):
@@ -679,40 +1934,126 @@ class BS_PGT_AnnotationsProperies(PropertyGroup):
     bpy.types.Scene.generate_segmentation_masks = BoolProperty(
                                       default=False,
                                       name="Generate Segmentation Masks") 
+    bpy.types.Scene.segmentation_masks_method = EnumProperty(
+                                      items=(("index_pass", "Object Index Pass", 
+                                              "Object index pass of the render, switches the render engine to Cycles"),
+                                             ("id_scene", "Object ID Scene", 
+                                              "Flat object colors rendered by Workbench in a linked scene, "
+                                              "works with any render engine")),
+                                      name="Segmentation Masks Method")
+    bpy.types.Scene.generate_bounding_boxes = BoolProperty(
+                                      default=False,
+                                      name="Generate Bounding Boxes",
+                                      description="Project the labeled models into the camera view, "
+                                                  "works with any render engine") 
                                                        
 class BS_Annotations:
-    __slots__ = ("_divide_node", "_segmentation_output_node",
+    __slots__ = ("_segmentation_output_node",
                  "_segmentation_masks_folder", "_segmentation_color_mode", 
                  "_divide_node_name", "_segmentation_output_node_name",
-                 "_segmentation_image_name")
+                 "_segmentation_image_name", "_id_scene_name", "_id_node_names", "_id_scene",
+                 "_segmentation_masks_encoding", "_output_layout", "_staging_folder")
+    
+    # Masks hold the instance ids, in the smallest lossless format for the largest id:
+    # (largest id, file format, color depth, ids divide factor, extension)
+    _segmentation_masks_encodings = ((2**8 - 1, "PNG", "8", 2**8 - 1, ".png"),
+                                     (BS_InstanceIDAllocator.max_pass_index, "PNG", "16", 2**16 - 1, ".png"))
+    _base_color_key = "bs_base_color"
+    
+    @classmethod
+    def get_segmentation_masks_encoding(cls, max_instance_id):
+        for segmentation_masks_encoding in cls._segmentation_masks_encodings:
+            if max_instance_id <= segmentation_masks_encoding[0]:
+                return segmentation_masks_encoding
+        raise Exception(f"Segmentation masks can hold up to {BS_InstanceIDAllocator.max_pass_index} instance ids, "
+                        f"the labeled objects need {max_instance_id}")
+    
+    @classmethod
+    def get_segmentation_masks_encoding_info(cls, max_instance_id):
+        _, file_format, color_depth, _, extension = cls.get_segmentation_masks_encoding(max_instance_id)
+        return {"file_format": file_format, "color_depth": int(color_depth), "extension": extension,
+                "pixel_values": "instance ids, 0 is the background",
+                "instance_ids_table": BS_InstanceIDAllocator.instance_ids_table_name}
+    
+    @property
+    def segmentation_masks_folder(self):
+        return self._segmentation_masks_folder
+    
+    @property
+    def segmentation_image_extension(self):
+        return self._segmentation_masks_encoding[4]
     
     def set_index(self, index):
-        segmentation_image_name = self._segmentation_image_name.format(index=index)
+        segmentation_image_name = self._segmentation_image_name.format(
+                                  index=index, subfolder=self._output_layout.get_item_subfolder(index))
         self._segmentation_output_node.file_slots[0].path = segmentation_image_name
+        
+    def get_item_path(self, index, staged=False):
+        masks_folder = self._staging_folder if staged else self._segmentation_masks_folder
+        return join_path(masks_folder, self._output_layout.get_item_subfolder(index),
+                         f"{index:010d}{self.segmentation_image_extension}")
     
-    def __init__(self, context, num_models):
+    def __init__(self, context, max_instance_id):
+        self._output_layout = BS_OutputLayout(context)
+        self._staging_folder = None
         self._divide_node_name = "BS Divide"
         self._segmentation_output_node_name = "BS Segmentation Output"
+        self._id_scene_name = "BS Segmentation IDs"
+        self._id_node_names = {"render_layers": "BS ID Render Layers", "separate": "BS ID Separate",
+                               "high_byte": "BS ID High Byte", "round": "BS ID Round",
+                               "low_byte": "BS ID Low Byte", "combine": "BS ID Combine"}
+        self._segmentation_masks_folder = None
+        self._segmentation_output_node = None
+        self._id_scene = None
+        self._segmentation_masks_encoding = self.get_segmentation_masks_encoding(max_instance_id)
         
         if context.scene.generate_segmentation_masks:
-            self._segmentation_image_name = "##########"
+            self._segmentation_image_name = "{subfolder}##########"
             self._segmentation_color_mode = "BW"
             self._segmentation_masks_folder = self._set_segmentation_masks_folder(context)
+            self._staging_folder = self._segmentation_masks_folder
+            if context.scene.write_outputs_async:
+                self._staging_folder = BS_AsyncItemWriter.get_staging_folder(self._segmentation_masks_folder)
             
-            self._add_compositor_nodes(context)
-            self._setup_compositor_nodes(num_models)
-            self._connect_compositor_nodes(context)
+            if context.scene.segmentation_masks_method == "id_scene":
+                self._id_scene = self._setup_id_scene(context)
+            else:
+                self._delete_id_scene()
         else:
-            self._delete_compositor_nodes(context)
+            self._delete_id_scene()
     
-    def _delete_compositor_nodes(self, context):
-        nodes = context.scene.node_tree.nodes
+    def add_compositor_nodes(self, compositor_graph, context):
+        if self._segmentation_masks_folder is None:
+            return
         
-        if nodes.get(self._divide_node_name, None):
-            nodes.remove(nodes[self._divide_node_name])
-            
-        if nodes.get(self._segmentation_output_node_name, None):
-            nodes.remove(nodes[self._segmentation_output_node_name])
+        _, segm_masks_file_format, segm_masks_color_depth, ids_div_factor, _ = self._segmentation_masks_encoding
+        output_properties = [("base_path", self._staging_folder),
+                             ("format.file_format", segm_masks_file_format),
+                             ("format.color_mode", self._segmentation_color_mode),
+                             ("format.color_depth", segm_masks_color_depth),
+                             ("format.compression", BS_AsyncItemWriter.get_png_compression(
+                                                    self._staging_folder != self._segmentation_masks_folder))]
+        compositor_graph.add_node(self._segmentation_output_node_name, "CompositorNodeOutputFile", (400, -300),
+                                  properties=output_properties, file_slots=("Image",))
+        
+        if self._id_scene is not None:
+            self._add_id_compositor_nodes(compositor_graph, ids_div_factor)
+            return
+        
+        compositor_graph.add_node(self._divide_node_name, "CompositorNodeMath", (400, 0),
+                                  properties=(("operation", "DIVIDE"),), inputs=((1, ids_div_factor),))
+        compositor_graph.add_link(BS_CompositorGraph.render_layers_node_name, "IndexOB", self._divide_node_name, 0)
+        compositor_graph.add_link(self._divide_node_name, "Value", self._segmentation_output_node_name, 0)
+    
+    def set_compositor_nodes(self, node_tree):
+        if self._segmentation_masks_folder is not None:
+            self._segmentation_output_node = node_tree.nodes[self._segmentation_output_node_name]
+            self.set_index(0)
+    
+    def _delete_id_scene(self):
+        id_scene = bpy.data.scenes.get(self._id_scene_name, None)
+        if id_scene is not None:
+            bpy.data.scenes.remove(id_scene)
         
     def _set_segmentation_masks_folder(self, context):
         segmentation_masks_folder = context.scene.segmentation_masks_folder
@@ -722,52 +2063,229 @@ class BS_Annotations:
         raise FileNotFoundError(f"Specified segmentation masks folder '{segmentation_masks_folder}' "
                                  "does not exist")
                                  
-    def _setup_compositor_nodes(self, num_models):
-        segm_masks_color_depth = 8 if num_models < 256 else 16
-        divide_node_div_factor = 2**8 -1 if num_models < 256 else 2**16 - 1
+    def _setup_id_scene(self, context):
+        scene = context.scene
+        id_scene = bpy.data.scenes.get(self._id_scene_name, None) or bpy.data.scenes.new(self._id_scene_name)
+        self._link_scene_content(scene, id_scene)
+        self._copy_collections_exclusion(context.view_layer.layer_collection, 
+                                         id_scene.view_layers[0].layer_collection)
+        # The camera rendering the images, so the masks line up with them
+        id_scene.camera = scene.camera
+        id_scene.world = None
         
-        # Divide Node
-        self._divide_node.operation = "DIVIDE"
-        self._divide_node.inputs[1].default_value = divide_node_div_factor  
+        render = id_scene.render
+        render.engine = "BLENDER_WORKBENCH"
+        render.resolution_x = scene.render.resolution_x
+        render.resolution_y = scene.render.resolution_y
+        render.resolution_percentage = scene.render.resolution_percentage
+        render.pixel_aspect_x = scene.render.pixel_aspect_x
+        render.pixel_aspect_y = scene.render.pixel_aspect_y
+        render.film_transparent = True
+        render.use_compositing = False
+        render.use_sequencer = False
         
-        # File Output (Segmentation Mask) Node
-        self._segmentation_output_node.base_path = self._segmentation_masks_folder
-        self._segmentation_output_node.format.color_mode = self._segmentation_color_mode
-        self._segmentation_output_node.format.color_depth = str(segm_masks_color_depth)
-        self._segmentation_output_node.file_slots[0].path = self._segmentation_image_name
+        # Unlit, unfiltered object colors, so every pixel holds the exact id of the nearest object
+        id_scene.display.render_aa = "OFF"
+        shading = id_scene.display.shading
+        shading.light = "FLAT"
+        shading.color_type = "OBJECT"
+        shading.show_shadows = False
+        shading.show_cavity = False
+        shading.show_object_outline = False
+        shading.show_specular_highlight = False
+        shading.use_dof = False
         
-    def _connect_compositor_nodes(self, context):
-        node_tree = context.scene.node_tree
-        render_layers_node = BS_CompositorNodesManager(context).render_layers_node 
+        return id_scene
+    
+    def set_id_colors(self):
+        if self._id_scene is None:
+            return
         
-        node_tree.links.new(render_layers_node.outputs["IndexOB"],
-                            self._divide_node.inputs[0])
-        node_tree.links.new(self._divide_node.outputs["Value"],
-                            self._segmentation_output_node.inputs[0])
+        for id_object in self._id_scene.objects:
+            # A color left by an interrupted generation is not taken as the user's one
+            if self._base_color_key not in id_object:
+                id_object[self._base_color_key] = tuple(id_object.color)
+            id_object.color = self._get_id_color(id_object.pass_index)
+    
+    def restore_object_colors(self):
+        # The object colors of the user come back for the viewport and the Object Info shading
+        if self._id_scene is None:
+            return
         
-    def _add_compositor_nodes(self, context):
-        context.scene.use_nodes = True
+        for id_object in self._id_scene.objects:
+            if self._base_color_key in id_object:
+                id_object.color = tuple(id_object[self._base_color_key])
+                del id_object[self._base_color_key]
+    
+    def _link_scene_content(self, scene, id_scene):
+        for collection in tuple(id_scene.collection.children):
+            id_scene.collection.children.unlink(collection)
+        for scene_object in tuple(id_scene.collection.objects):
+            id_scene.collection.objects.unlink(scene_object)
+            
+        for collection in scene.collection.children:
+            id_scene.collection.children.link(collection)
+        for scene_object in scene.collection.objects:
+            id_scene.collection.objects.link(scene_object)
+            
+    def _copy_collections_exclusion(self, layer_collection, id_layer_collection):
+        for child_layer_collection in layer_collection.children:
+            id_child_layer_collection = id_layer_collection.children[child_layer_collection.name]
+            id_child_layer_collection.exclude = child_layer_collection.exclude
+            self._copy_collections_exclusion(child_layer_collection, id_child_layer_collection)
+            
+    def _get_id_color(self, pass_index):
+        # Ids above 255 are split into two bytes, so they survive a half float render buffer
+        high_byte, low_byte = divmod(pass_index, 256)
+        return (high_byte / 255, low_byte / 255, 0.0, 1.0)
+    
+    def _add_id_compositor_nodes(self, compositor_graph, ids_div_factor):
+        id_node_names = self._id_node_names
+        # mask = (round(R * 255) * 256 + G * 255) / ids_div_factor
+        id_node_specs = {"render_layers": ("CompositorNodeRLayers", (("scene", self._id_scene), 
+                                                                     ("layer", self._id_scene.view_layers[0].name)), ()),
+                         "separate": ("CompositorNodeSepRGBA", (), ()),
+                         "high_byte": ("CompositorNodeMath", (("operation", "MULTIPLY"),), ((1, 255),)),
+                         "round": ("CompositorNodeMath", (("operation", "ROUND"),), ()),
+                         "low_byte": ("CompositorNodeMath", (("operation", "MULTIPLY"),), 
+                                      ((1, 255 / ids_div_factor),)),
+                         "combine": ("CompositorNodeMath", (("operation", "MULTIPLY_ADD"),), 
+                                     ((1, 256 / ids_div_factor),))}
+        for node_num, (node_key, (node_type, properties, inputs)) in enumerate(id_node_specs.items()):
+            compositor_graph.add_node(id_node_names[node_key], node_type, (node_num * 200, -600), 
+                                      properties=properties, inputs=inputs)
         
-        divide_node_name = self._divide_node_name
-        segmentation_output_node_name = self._segmentation_output_node_name
+        compositor_graph.add_link(id_node_names["render_layers"], "Image", id_node_names["separate"], "Image")
+        compositor_graph.add_link(id_node_names["separate"], "R", id_node_names["high_byte"], 0)
+        compositor_graph.add_link(id_node_names["high_byte"], "Value", id_node_names["round"], 0)
+        compositor_graph.add_link(id_node_names["separate"], "G", id_node_names["low_byte"], 0)
+        compositor_graph.add_link(id_node_names["round"], "Value", id_node_names["combine"], 0)
+        compositor_graph.add_link(id_node_names["low_byte"], "Value", id_node_names["combine"], 2)
+        compositor_graph.add_link(id_node_names["combine"], "Value", self._segmentation_output_node_name, 0)
         
-        nodes = context.scene.node_tree.nodes
         
-        # Divide Node
-        if nodes.get(divide_node_name, None):
-             self._divide_node = nodes[divide_node_name]
-        else:
-            self._divide_node = nodes.new("CompositorNodeMath")
-            self._divide_node.name = divide_node_name
-        self._divide_node.location = (400, 0)
+class BS_BoundingBoxes:
+    __slots__ = ("_camera", "_resolution", "_pixel_aspect", "_models", "_mesh_objects", 
+                 "_local_vertices", "_object_vertex_slices", "_model_vertex_starts",
+                 "_item_boxes", "_boxes_writer")
+    
+    metadata_name = "bounding_boxes"
+    
+    def __init__(self, context, labeled_models, shard_id=None):
+        scene = context.scene
+        # Boxes are projected through the camera rendering the images
+        self._camera = scene.camera
+        if self._camera is None:
+            raise Exception("You have to set the scene camera to generate bounding boxes")
         
-        # File (Segmentation Mask) Output Node
-        if nodes.get(segmentation_output_node_name, None):
-             self._segmentation_output_node = nodes[segmentation_output_node_name]
-        else:
-            self._segmentation_output_node = nodes.new("CompositorNodeOutputFile")
-            self._segmentation_output_node.name = segmentation_output_node_name 
-        self._segmentation_output_node.location = (400, -300)
+        render = scene.render
+        self._resolution = (render.resolution_x * render.resolution_percentage // 100,
+                            render.resolution_y * render.resolution_percentage // 100)
+        self._pixel_aspect = (render.pixel_aspect_x, render.pixel_aspect_y)
+        
+        self._models, self._mesh_objects, model_object_nums = self._get_models(labeled_models)
+        self._read_local_vertices(context.evaluated_depsgraph_get(), model_object_nums)
+        
+        self._item_boxes = collections.OrderedDict()
+        self._boxes_writer = BS_ItemMetadataWriter(scene.rendered_images_folder, shard_id, 
+                                                   metadata_name=self.metadata_name)
+        
+    def _get_models(self, labeled_models):
+        models = list()
+        mesh_objects = list()
+        model_object_nums = list()
+        
+        for label_name, label_models in labeled_models.items():
+            for model_objects in label_models:
+                model_mesh_objects = [model_object for model_object in model_objects if model_object.type == "MESH"]
+                if not model_mesh_objects:
+                    continue
+                
+                models.append((label_name, model_objects[0].name))
+                model_object_nums.append(tuple(range(len(mesh_objects), len(mesh_objects) + len(model_mesh_objects))))
+                mesh_objects.extend(model_mesh_objects)
+        
+        return tuple(models), tuple(mesh_objects), tuple(model_object_nums)
+    
+    def _read_local_vertices(self, depsgraph, model_object_nums):
+        # Labeled models are only rotated as a whole, so the evaluated vertices are read once 
+        # and only the object matrices change from frame to frame
+        object_vertices = list()
+        for mesh_object in self._mesh_objects:
+            evaluated_object = mesh_object.evaluated_get(depsgraph)
+            evaluated_mesh = evaluated_object.to_mesh()
+            vertices = numpy.empty(len(evaluated_mesh.vertices) * 3, dtype=numpy.float32)
+            evaluated_mesh.vertices.foreach_get("co", vertices)
+            evaluated_object.to_mesh_clear()
+            object_vertices.append(vertices.reshape(-1, 3))
+        
+        # Vertices of a model are contiguous, so per model extremes are a single reduceat
+        vertex_counts = [len(vertices) for vertices in object_vertices]
+        vertex_starts = numpy.concatenate(([0], numpy.cumsum(vertex_counts)))
+        self._object_vertex_slices = tuple([slice(int(vertex_starts[object_num]), int(vertex_starts[object_num + 1]))
+                                            for object_num in range(len(object_vertices))])
+        self._model_vertex_starts = numpy.array([vertex_starts[object_nums[0]] for object_nums in model_object_nums],
+                                                dtype=numpy.int64)
+        
+        self._local_vertices = numpy.ones((int(vertex_starts[-1]), 4), dtype=numpy.float64)
+        for object_num, vertices in enumerate(object_vertices):
+            self._local_vertices[self._object_vertex_slices[object_num], :3] = vertices
+    
+    def compute_boxes(self, scene, depsgraph):
+        if not len(self._models):
+            self._item_boxes[scene.frame_current] = list()
+            return
+        
+        evaluated_camera = self._camera.evaluated_get(depsgraph)
+        projection_matrix = numpy.array(evaluated_camera.calc_matrix_camera(
+                                            depsgraph, x=self._resolution[0], y=self._resolution[1],
+                                            scale_x=self._pixel_aspect[0], scale_y=self._pixel_aspect[1]))
+        view_projection_matrix = projection_matrix @ numpy.array(evaluated_camera.matrix_world.inverted())
+        
+        clip_vertices = numpy.empty_like(self._local_vertices)
+        for mesh_object, object_vertex_slice in zip(self._mesh_objects, self._object_vertex_slices):
+            object_matrix = view_projection_matrix @ numpy.array(mesh_object.evaluated_get(depsgraph).matrix_world)
+            clip_vertices[object_vertex_slice] = self._local_vertices[object_vertex_slice] @ object_matrix.T
+        
+        # Vertices behind the camera are left out of the boxes
+        w = clip_vertices[:, 3]
+        is_visible = w > 1e-6
+        w = numpy.where(is_visible, w, 1.0)
+        x = (clip_vertices[:, 0] / w + 1.0) * 0.5 * self._resolution[0]
+        y = (1.0 - clip_vertices[:, 1] / w) * 0.5 * self._resolution[1]
+        
+        x_min = numpy.minimum.reduceat(numpy.where(is_visible, x, numpy.inf), self._model_vertex_starts)
+        y_min = numpy.minimum.reduceat(numpy.where(is_visible, y, numpy.inf), self._model_vertex_starts)
+        x_max = numpy.maximum.reduceat(numpy.where(is_visible, x, -numpy.inf), self._model_vertex_starts)
+        y_max = numpy.maximum.reduceat(numpy.where(is_visible, y, -numpy.inf), self._model_vertex_starts)
+        
+        x_min, x_max = numpy.clip(x_min, 0, self._resolution[0]), numpy.clip(x_max, 0, self._resolution[0])
+        y_min, y_max = numpy.clip(y_min, 0, self._resolution[1]), numpy.clip(y_max, 0, self._resolution[1])
+        
+        boxes = list()
+        for model_num in numpy.flatnonzero((x_max > x_min) & (y_max > y_min)).tolist():
+            label_name, model_name = self._models[model_num]
+            boxes.append({"label": label_name, "model": model_name,
+                          "bbox": [round(float(x_min[model_num]), 2), round(float(y_min[model_num]), 2),
+                                   round(float(x_max[model_num] - x_min[model_num]), 2),
+                                   round(float(y_max[model_num] - y_min[model_num]), 2)]})
+        
+        self._item_boxes[scene.frame_current] = boxes
+    
+    def get_item_boxes(self, item_index):
+        # Items are written in the frame order, possibly a few frames later when the outputs are written 
+        # asynchronously, so the boxes of the earlier frames are not needed anymore
+        while self._item_boxes and next(iter(self._item_boxes)) < item_index:
+            self._item_boxes.popitem(last=False)
+        return self._item_boxes.get(item_index, None)
+    
+    def write_item_boxes(self, item_index):
+        item_boxes = self.get_item_boxes(item_index)
+        if item_boxes is not None:
+            self._boxes_writer.write_item(item_index, {"bounding_boxes": item_boxes})
+    
+    def close(self):
+        self._boxes_writer.close()
         
         
 ############################################################################################################
@@ -780,8 +2298,30 @@ class BS_PGT_RenderProperies(PropertyGroup):
                                       name="Rendered Images Folder")
     bpy.types.Scene.rendered_images_file_format = EnumProperty(
                                       items=(("JPEG", "JPEG", ""),
-                                             ("PNG", "PNG", "")),
+                                             ("PNG", "PNG", ""),
+                                             ("OPEN_EXR_MULTILAYER", "Multilayer EXR", 
+                                              "Image, object index, depth and normal passes in one file")),
                                       name="Rendered Images File Format")
+    bpy.types.Scene.output_layout = EnumProperty(
+                                      items=(("flat", "Flat", "All the items in the output folders"),
+                                             ("nested", "Nested Folders", 
+                                              "Items in numbered subfolders of the output folders"),
+                                             ("tar_shards", "Tar Shards", 
+                                              "Items packed into WebDataset style tar shards")),
+                                      name="Output Layout")
+    bpy.types.Scene.items_per_folder = IntProperty(
+                                      default=1000,
+                                      min=1,
+                                      name="Items Per Folder")
+    bpy.types.Scene.items_per_tar_shard = IntProperty(
+                                      default=1000,
+                                      min=1,
+                                      name="Items Per Tar Shard")
+    bpy.types.Scene.exr_codec = EnumProperty(
+                                      items=(("ZIP", "ZIP", "Lossless"),
+                                             ("PIZ", "PIZ", "Lossless, better for noisy images"),
+                                             ("DWAA", "DWAA", "Lossy, the smallest files")),
+                                      name="EXR Codec")
         
         
 class BS_PT_Render(BS_BlenderSyntherButtonsPanel):
@@ -796,20 +2336,76 @@ class BS_PT_Render(BS_BlenderSyntherButtonsPanel):
         col = flow.column()    
         col.label(text="Rendered images file format")
         col.prop(scene, "rendered_images_file_format", text="")
+        if scene.rendered_images_file_format == "OPEN_EXR_MULTILAYER":
+            col.prop(scene, "exr_codec")
         col.separator()
         
         col.label(text="Where to save the rendered images")
         col.prop(scene, "rendered_images_folder", text="")
+        col.separator()
+        
+        col.label(text="Output layout")
+        col.prop(scene, "output_layout", text="")
+        if scene.output_layout == "nested":
+            col.prop(scene, "items_per_folder")
+        elif scene.output_layout == "tar_shards":
+            col.prop(scene, "items_per_tar_shard")
                                                                                                                                                                            
 
 class BS_Render:
     __slots__ = ("_render_output_node", "_rendered_images_folder", 
                  "_rendered_images_color_mode", "_render_output_node_name",
-                 "_rendered_image_name")
+                 "_rendered_image_name", "_rendered_image_extension", "_output_layout",
+                 "_staging_folder")
+    
+    _file_format_extensions = {"JPEG": ".jpg", "PNG": ".png", "OPEN_EXR_MULTILAYER": ".exr"}
+    # Layer name: (names of the render layers output, channels in the file)
+    _multilayer_exr_layers = {"Image": (("Image",), ("R", "G", "B", "A")),
+                              "IndexOB": (("IndexOB",), ("V",)),
+                              "Depth": (("Depth", "Z"), ("V",)),
+                              "Normal": (("Normal",), ("X", "Y", "Z"))}
+    
+    @property
+    def rendered_images_folder(self):
+        return self._rendered_images_folder
+    
+    @property
+    def rendered_image_extension(self):
+        return self._rendered_image_extension
+    
+    @classmethod
+    def get_multilayer_exr_outputs(cls, render_layers_node):
+        multilayer_exr_outputs = dict()
+        for layer_name, (output_names, _) in cls._multilayer_exr_layers.items():
+            for output_name in output_names:
+                output = render_layers_node.outputs.get(output_name, None)
+                if output is not None and output.enabled:
+                    multilayer_exr_outputs[layer_name] = output
+                    break
+                    
+        return multilayer_exr_outputs
+    
+    @classmethod
+    def get_multilayer_exr_layout(cls, context):
+        render_layers_node = BS_CompositorGraph.get_render_layers_node(context.scene)
+        layers = [{"name": layer_name, 
+                   "channels": [f"{layer_name}.{channel}" for channel in cls._multilayer_exr_layers[layer_name][1]]}
+                  for layer_name in cls.get_multilayer_exr_outputs(render_layers_node)]
+        
+        return {"codec": context.scene.exr_codec, "color_depth": 32, "layers": layers}
     
     def set_index(self, index):
-        rendered_image_name = self._rendered_image_name.format(index=index)
-        self._render_output_node.file_slots[0].path = rendered_image_name
+        rendered_image_name = self._rendered_image_name.format(
+                              index=index, subfolder=self._output_layout.get_item_subfolder(index))
+        if self._render_output_node.format.file_format == "OPEN_EXR_MULTILAYER":
+            self._render_output_node.base_path = join_path(self._staging_folder, rendered_image_name)
+        else:
+            self._render_output_node.file_slots[0].path = rendered_image_name
+            
+    def get_item_path(self, index, staged=False):
+        rendered_images_folder = self._staging_folder if staged else self._rendered_images_folder
+        return join_path(rendered_images_folder, self._output_layout.get_item_subfolder(index),
+                         f"{index:010d}{self._rendered_image_extension}")
     
     def _set_rendered_images_folder(self, context):
         rendered_images_folder = context.scene.rendered_images_folder
@@ -819,43 +2415,59 @@ class BS_Render:
                                  "does not exist")
                                  
     def __init__(self, context):
-        self._rendered_image_name = "##########"
+        self._output_layout = BS_OutputLayout(context)
+        self._rendered_image_name = "{subfolder}##########"
         self._render_output_node_name = "BS Render Output"
         self._rendered_images_color_mode = "RGB"
         self._rendered_images_folder = self._set_rendered_images_folder(context)
+        self._rendered_image_extension = self._file_format_extensions[context.scene.rendered_images_file_format]
+        # Output nodes write into the staging folder, from which the asynchronous writer moves the files
+        self._staging_folder = self._rendered_images_folder
+        if context.scene.write_outputs_async:
+            self._staging_folder = BS_AsyncItemWriter.get_staging_folder(self._rendered_images_folder)
         
-        self._add_compositor_nodes(context)
-        self._setup_compositor_nodes(context)
-        self._connect_compositor_nodes(context)
+        self._render_output_node = None
         
-    def _add_compositor_nodes(self, context):
-        context.scene.use_nodes = True
+    def add_compositor_nodes(self, compositor_graph, context):
+        rendered_image_format = context.scene.rendered_images_file_format
         
-        render_output_node_name = self._render_output_node_name
-        nodes = context.scene.node_tree.nodes
+        if rendered_image_format == "OPEN_EXR_MULTILAYER":
+            self._add_multilayer_exr_output_node(compositor_graph, context)
+            return
         
-        # Rendered Output Node
-        if nodes.get(render_output_node_name, None):
-             self._render_output_node = nodes[render_output_node_name]
-        else:
-            self._render_output_node = nodes.new("CompositorNodeOutputFile")
-            self._render_output_node.name = render_output_node_name
-        self._render_output_node.location = (500, 200)
-    
-    def _setup_compositor_nodes(self, context):
-        rendered_image_format = context.scene.rendered_images_file_format
+        compositor_graph.add_node(self._render_output_node_name, "CompositorNodeOutputFile", (500, 200),
+                                  properties=(("base_path", self._staging_folder),
+                                              ("format.file_format", rendered_image_format),
+                                              ("format.color_mode", self._rendered_images_color_mode),
+                                              ("format.compression", BS_AsyncItemWriter.get_png_compression(
+                                                  self._staging_folder != self._rendered_images_folder))),
+                                  file_slots=("Image",))
+        compositor_graph.add_link(BS_CompositorGraph.render_layers_node_name, "Image", 
+                                  self._render_output_node_name, 0)
         
-        self._render_output_node.base_path = self._rendered_images_folder
-        self._render_output_node.format.file_format = rendered_image_format
-        self._render_output_node.format.color_mode = self._rendered_images_color_mode
-        self._render_output_node.file_slots[0].path = self._rendered_image_name
+    def set_compositor_nodes(self, node_tree):
+        self._render_output_node = node_tree.nodes[self._render_output_node_name]
+        self.set_index(0)
         
-    def _connect_compositor_nodes(self, context):
-        node_tree = context.scene.node_tree
-        render_layers_node = BS_CompositorNodesManager(context).render_layers_node 
+    def _add_multilayer_exr_output_node(self, compositor_graph, context):
+        # Passes are rendered in the same sample loop as the image, so they only add the encoding time
+        view_layer = context.view_layer
+        view_layer.use_pass_object_index = True
+        view_layer.use_pass_z = True
+        view_layer.use_pass_normal = True
         
-        node_tree.links.new(render_layers_node.outputs["Image"],
-                            self._render_output_node.inputs[0])
+        # A multilayer file has no file slots, its base path is the file path itself;
+        # passes the render engine does not produce are left out of the files
+        render_layers_node = BS_CompositorGraph.get_render_layers_node(context.scene)
+        multilayer_exr_outputs = self.get_multilayer_exr_outputs(render_layers_node)
+        compositor_graph.add_node(self._render_output_node_name, "CompositorNodeOutputFile", (500, 200),
+                                  properties=(("format.file_format", "OPEN_EXR_MULTILAYER"),
+                                              ("format.color_depth", "32"),
+                                              ("format.exr_codec", context.scene.exr_codec)),
+                                  layer_slots=tuple(multilayer_exr_outputs))
+        for layer_name, layer_output in multilayer_exr_outputs.items():
+            compositor_graph.add_link(BS_CompositorGraph.render_layers_node_name, layer_output.name,
+                                      self._render_output_node_name, layer_name)
 
     
 ############################################################################################################
@@ -878,6 +2490,30 @@ class BS_PT_DatasetGeneration(BS_BlenderSyntherButtonsPanel):
         col.prop(scene, "first_item_index")
         col.separator()
         
+        col.prop(scene, "random_seed")
+        col.separator()
+        
+        col.prop(scene, "animation_mode")
+        col.separator()
+        
+        col.prop(scene, "resume_generation")
+        col.separator()
+        
+        col.prop(scene, "write_items_metadata")
+        col.separator()
+        
+        col.prop(scene, "write_outputs_async")
+        if scene.write_outputs_async:
+            col.prop(scene, "output_writer_threads")
+            col.prop(scene, "max_pending_items")
+        col.separator()
+        
+        col.prop(scene, "use_render_cache")
+        if scene.use_render_cache:
+            col.prop(scene, "render_cache_folder")
+            col.prop(scene, "render_cache_size_mb")
+        col.separator()
+        
         col.operator("bs.generate_dataset")
         
         
@@ -890,66 +2526,975 @@ class BS_PGT_DatasetGenerationProperties(PropertyGroup):
                                         default=0,
                                         min=0,
                                         name="First Item Index")
+    bpy.types.Scene.random_seed = IntProperty(
+                                        default=0,
+                                        min=0,
+                                        name="Random Seed",
+                                        description="Together with the item index fully determines the item")
+    bpy.types.Scene.animation_mode = EnumProperty(
+                                        items=(("keyframes", "Baked Keyframes", 
+                                                "Bake the random state of every item into F-Curves before rendering"),
+                                               ("procedural", "Procedural", 
+                                                "Set the random state of every item in a frame change handler, "
+                                                "no keyframes are stored, for huge item counts")),
+                                        name="Animation Mode")
+    bpy.types.Scene.resume_generation = BoolProperty(
+                                        default=False,
+                                        name="Resume Generation",
+                                        description="Render only the items which are not generated yet")
+    bpy.types.Scene.write_items_metadata = BoolProperty(
+                                        default=True,
+                                        name="Write Items Metadata",
+                                        description="Write the scene parameters of every item to items_metadata.jsonl")
+    bpy.types.Scene.write_outputs_async = BoolProperty(
+                                        default=False,
+                                        name="Write Outputs Asynchronously",
+                                        description="Compress, checksum and move the written files in background "
+                                                    "threads while the next items render")
+    bpy.types.Scene.output_writer_threads = IntProperty(
+                                        default=4,
+                                        min=1,
+                                        name="Output Writer Threads")
+    bpy.types.Scene.max_pending_items = IntProperty(
+                                        default=16,
+                                        min=1,
+                                        name="Max Pending Items",
+                                        description="Rendering waits when so many items are not written yet")
+    bpy.types.Scene.use_render_cache = BoolProperty(
+                                        default=False,
+                                        name="Use Render Cache",
+                                        description="Reuse the outputs of items rendered before with the same "
+                                                    "saved .blend file, item parameters and render settings")
+    bpy.types.Scene.render_cache_folder = StringProperty(
+                                        default="",
+                                        name="Render Cache Folder",
+                                        description="Empty for ~/.cache/blendersynther/render_cache",
+                                        subtype="DIR_PATH")
+    bpy.types.Scene.render_cache_size_mb = IntProperty(
+                                        default=10240,
+                                        min=1,
+                                        name="Render Cache Size (MB)",
+                                        description="The least recently used cached outputs are removed "
+                                                    "above this size")
+    
     
+class BS_ProgressManifest:
+    __slots__ = ("_manifest_path", "_manifest_file")
+    
+    _manifest_name = "bs_progress_manifest.txt"
+    
+    @staticmethod
+    def scan_folder(folder_path, file_extension):
+        # Items are named by their 10-digit index, empty files are left by interrupted writes
+        completed_items = list()
+        with os.scandir(folder_path) as folder_entries:
+            for folder_entry in folder_entries:
+                if folder_entry.is_dir():
+                    # Numbered subfolders of the nested output layout
+                    if folder_entry.name.isdigit():
+                        completed_items.extend(BS_ProgressManifest.scan_folder(folder_entry.path, 
+                                                                               file_extension).tolist())
+                    continue
+                item_name, item_extension = os.path.splitext(folder_entry.name)
+                if (item_extension == file_extension and item_name.isdigit() 
+                        and folder_entry.stat().st_size > 0):
+                    completed_items.append(int(item_name))
+        
+        return numpy.array(completed_items, dtype=numpy.int64)
+    
+    def __init__(self, rendered_images_folder):
+        self._manifest_path = join_path(rendered_images_folder, self._manifest_name)
+        self._manifest_file = None
+    
+    @property
+    def exists(self):
+        return path_exists(self._manifest_path)
     
+    def get_completed_items(self):
+        with open(self._manifest_path, "r") as manifest_file:
+            return numpy.array(manifest_file.read().split(), dtype=numpy.int64)
+    
+    def mark_item_completed(self, item_index):
+        # Line buffered appends, so a crash loses at most the item being written
+        if self._manifest_file is None:
+            self._manifest_file = open(self._manifest_path, "a", buffering=1)
+        self._manifest_file.write(f"{item_index}\n")
+    
+    def close(self):
+        if self._manifest_file is not None:
+            self._manifest_file.close()
+            self._manifest_file = None
+    
+
+class BS_AsyncItemWriter:
+    __slots__ = ("_executor", "_num_threads", "_pending_items_semaphore", "_pending_items", 
+                 "_png_compression_level", "_checksums_path", "_checksums_file", "_checksums_root",
+                 "_failed_items")
+    
+    _staging_folder_name = ".bs_staging"
+    _checksums_name = "checksums"
+    _png_signature = b"\x89PNG\r\n\x1a\n"
+    
+    @classmethod
+    def get_staging_folder(cls, folder_path):
+        return join_path(folder_path, cls._staging_folder_name)
+    
+    @staticmethod
+    def get_png_compression(is_staged):
+        # Staged PNGs are written uncompressed by Blender and compressed by the writer threads
+        return 0 if is_staged else 15
+    
+    @classmethod
+    def get_checksums_path(cls, folder_path, shard_id=None):
+        checksums_name = cls._checksums_name if shard_id is None else f"{cls._checksums_name}.shard-{shard_id:04d}"
+        return join_path(folder_path, f"{checksums_name}.sha256")
+    
+    @classmethod
+    def merge_shards(cls, folder_path, shard_ids):
+        shard_checksums_paths = [cls.get_checksums_path(folder_path, shard_id) for shard_id in shard_ids]
+        shard_checksums_paths = [shard_checksums_path for shard_checksums_path in shard_checksums_paths
+                                 if path_exists(shard_checksums_path)]
+        if not shard_checksums_paths:
+            return
+        
+        with open(cls.get_checksums_path(folder_path), "ab") as checksums_file:
+            for shard_checksums_path in shard_checksums_paths:
+                with open(shard_checksums_path, "rb") as shard_checksums_file:
+                    shutil.copyfileobj(shard_checksums_file, checksums_file)
+                os.remove(shard_checksums_path)
+    
+    @classmethod
+    def recompress_png(cls, png_data, compression_level):
+        # The image data of all the IDAT chunks is one zlib stream, which is deflated again as a single IDAT
+        if png_data[:8] != cls._png_signature:
+            raise ValueError("Not a PNG file")
+        
+        chunks = list()
+        image_data = list()
+        chunk_start = 8
+        while chunk_start < len(png_data):
+            chunk_length, chunk_type = struct.unpack(">I4s", png_data[chunk_start:chunk_start + 8])
+            chunk_data = png_data[chunk_start + 8:chunk_start + 8 + chunk_length]
+            chunk_start += chunk_length + 12
+            if chunk_type == b"IDAT":
+                if not image_data:
+                    chunks.append((chunk_type, None))
+                image_data.append(chunk_data)
+            else:
+                chunks.append((chunk_type, chunk_data))
+        
+        compressed_image_data = zlib.compress(zlib.decompress(b"".join(image_data)), compression_level)
+        recompressed_png = [cls._png_signature]
+        for chunk_type, chunk_data in chunks:
+            if chunk_data is None:
+                chunk_data = compressed_image_data
+            recompressed_png.append(struct.pack(">I", len(chunk_data)) + chunk_type + chunk_data
+                                    + struct.pack(">I", zlib.crc32(chunk_type + chunk_data)))
+        
+        return b"".join(recompressed_png)
+    
+    def __init__(self, checksums_root, num_threads=4, max_pending_items=16, png_compression_level=6, 
+                 shard_id=None):
+        self._executor = None
+        self._num_threads = num_threads
+        self._pending_items_semaphore = threading.BoundedSemaphore(max_pending_items)
+        self._pending_items = collections.deque()
+        self._png_compression_level = png_compression_level
+        self._checksums_root = checksums_root
+        self._checksums_path = self.get_checksums_path(checksums_root, shard_id)
+        self._checksums_file = None
+        self._failed_items = list()
+    
+    @property
+    def failed_items(self):
+        return self._failed_items
+        
+    def submit(self, item_index, item_files):
+        # Blocks the render thread while max_pending_items items are waiting, so the memory stays bounded
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._num_threads, 
+                                                                   thread_name_prefix="BS Output Writer")
+        self._pending_items_semaphore.acquire()
+        try:
+            item_future = self._executor.submit(self._write_item_files, item_files)
+        except BaseException:
+            self._pending_items_semaphore.release()
+            raise
+        item_future.add_done_callback(lambda _: self._pending_items_semaphore.release())
+        self._pending_items.append((item_index, item_future))
+        
+    def get_written_items(self, wait=False):
+        # Items are handed back in the submission order, on the calling thread
+        written_items = list()
+        while self._pending_items and (wait or self._pending_items[0][1].done()):
+            item_index, item_future = self._pending_items.popleft()
+            try:
+                checksums = item_future.result()
+            except Exception:
+                # Raising in the render handler would be swallowed by Blender, failed items are kept for the run
+                print(f"BlenderSynther: writing item {item_index} failed", file=sys.stderr)
+                traceback.print_exc()
+                self._failed_items.append(item_index)
+                continue
+            self._write_checksums(checksums)
+            written_items.append(item_index)
+            
+        return written_items
+    
+    def _write_item_files(self, item_files):
+        with bs_profiler.span("async file output", "io"):
+            return self._write_staged_files(item_files)
+    
+    def _write_staged_files(self, item_files):
+        checksums = list()
+        for staged_file_path, file_path in item_files:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            if file_path.endswith(".png") and self._png_compression_level:
+                with open(staged_file_path, "rb") as staged_file:
+                    file_data = self.recompress_png(staged_file.read(), self._png_compression_level)
+                temporary_file_path = f"{file_path}.tmp"
+                with open(temporary_file_path, "wb") as temporary_file:
+                    temporary_file.write(file_data)
+                os.replace(temporary_file_path, file_path)
+                os.remove(staged_file_path)
+            else:
+                with open(staged_file_path, "rb") as staged_file:
+                    file_data = staged_file.read()
+                os.replace(staged_file_path, file_path)
+            checksums.append((hashlib.sha256(file_data).hexdigest(), file_path))
+            
+        return checksums
+    
+    def _write_checksums(self, checksums):
+        if self._checksums_file is None:
+            self._checksums_file = open(self._checksums_path, "a")
+        for checksum, file_path in checksums:
+            relative_file_path = os.path.relpath(file_path, self._checksums_root).replace(os.sep, "/")
+            self._checksums_file.write(f"{checksum}  {relative_file_path}\n")
+    
+    def close(self):
+        # Writer threads are started again by the next rendered animation
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._checksums_file is not None:
+            self._checksums_file.close()
+            self._checksums_file = None
+
+
+class BS_OutputLayout:
+    __slots__ = ("_output_layout", "_items_per_folder", "_items_per_tar_shard")
+    
+    def __init__(self, context):
+        self._output_layout = context.scene.output_layout
+        self._items_per_folder = context.scene.items_per_folder
+        self._items_per_tar_shard = context.scene.items_per_tar_shard
+        
+    @property
+    def is_nested(self):
+        return self._output_layout == "nested"
+    
+    @property
+    def is_tar_shards(self):
+        return self._output_layout == "tar_shards"
+    
+    @property
+    def items_per_tar_shard(self):
+        return self._items_per_tar_shard
+        
+    def get_item_subfolder(self, item_index):
+        if self.is_nested:
+            return f"{item_index // self._items_per_folder:06d}/"
+        return ""
+    
+    def get_layout_info(self):
+        layout_info = {"layout": self._output_layout}
+        if self.is_nested:
+            layout_info["items_per_folder"] = self._items_per_folder
+            layout_info["subfolder_name"] = "item index // items_per_folder, 6 digits"
+        elif self.is_tar_shards:
+            layout_info["items_per_tar_shard"] = self._items_per_tar_shard
+            layout_info["tar_index"] = f"{BS_TarShardWriter.tar_index_name}.jsonl"
+        return layout_info
+    
+    
+class BS_TarShardWriter:
+    __slots__ = ("_folder_path", "_tar_name_prefix", "_items_per_tar_shard", "_tar_num", 
+                 "_tar_file", "_tar_name", "_items_in_tar", "_tar_index_writer")
+    
+    tar_index_name = "tar_index"
+    
+    def __init__(self, folder_path, items_per_tar_shard, shard_id=None):
+        self._folder_path = folder_path
+        self._tar_name_prefix = "data" if shard_id is None else f"data-{shard_id:04d}"
+        self._items_per_tar_shard = items_per_tar_shard
+        self._tar_num = self._get_next_tar_num()
+        self._tar_file = None
+        self._tar_name = None
+        self._items_in_tar = 0
+        self._tar_index_writer = BS_ItemMetadataWriter(folder_path, shard_id, metadata_name=self.tar_index_name)
+        
+    def _get_next_tar_num(self):
+        # Resumed generations start new tar shards, the earlier ones are never appended to
+        tar_nums = [-1]
+        with os.scandir(self._folder_path) as folder_entries:
+            for folder_entry in folder_entries:
+                tar_name, tar_extension = os.path.splitext(folder_entry.name)
+                tar_name_prefix, _, tar_num = tar_name.rpartition("-")
+                if tar_extension == ".tar" and tar_name_prefix == self._tar_name_prefix and tar_num.isdigit():
+                    tar_nums.append(int(tar_num))
+                    
+        return max(tar_nums) + 1
+    
+    def _open_tar(self):
+        self._tar_name = f"{self._tar_name_prefix}-{self._tar_num:06d}.tar"
+        self._tar_file = tarfile.open(join_path(self._folder_path, self._tar_name), "w", 
+                                      format=tarfile.USTAR_FORMAT)
+        self._tar_num += 1
+        self._items_in_tar = 0
+    
+    def _close_tar(self):
+        if self._tar_file is not None:
+            self._tar_file.close()
+            self._tar_file = None
+    
+    def _add_tar_member(self, tar_info, member_file):
+        # Byte range of the member data, so a loader can read an item without going over the tar
+        data_offset = self._tar_file.offset + len(tar_info.tobuf(tarfile.USTAR_FORMAT))
+        self._tar_file.addfile(tar_info, member_file)
+        return [data_offset, tar_info.size]
+    
+    def write_item(self, item_index, item_files, item_records):
+        # WebDataset layout: all the members of an item share the key and differ by the extension
+        if self._tar_file is None:
+            self._open_tar()
+        item_key = f"{item_index:010d}"
+        tar_members = dict()
+        
+        for file_path, member_extension in item_files:
+            tar_info = self._tar_file.gettarinfo(file_path, arcname=f"{item_key}{member_extension}")
+            tar_info.uid = tar_info.gid = 0
+            tar_info.uname = tar_info.gname = ""
+            with open(file_path, "rb") as item_file:
+                tar_members[tar_info.name] = self._add_tar_member(tar_info, item_file)
+            
+        for member_extension, item_record in item_records.items():
+            item_record_data = json.dumps(item_record, separators=(",", ":")).encode("utf-8")
+            tar_info = tarfile.TarInfo(f"{item_key}{member_extension}")
+            tar_info.size = len(item_record_data)
+            tar_info.mtime = int(time.time())
+            tar_members[tar_info.name] = self._add_tar_member(tar_info, io.BytesIO(item_record_data))
+        
+        self._tar_file.fileobj.flush()
+        self._tar_index_writer.write_item(item_index, {"tar": self._tar_name, "members": tar_members})
+        for file_path, _ in item_files:
+            os.remove(file_path)
+        
+        self._items_in_tar += 1
+        if self._items_in_tar >= self._items_per_tar_shard:
+            self._close_tar()
+            
+    def close(self):
+        self._close_tar()
+        self._tar_index_writer.close()
+    
+
+class BS_RenderCache:
+    __slots__ = ("_cache_folder", "_max_cache_size", "_cache_size", "_output_states")
+    
+    default_cache_folder = join_path("~", ".cache", "blendersynther", "render_cache")
+    # Settings which do not change the rendered pixels, e.g. the threads set per shard
+    _ignored_render_settings = ("filepath", "frame_map_old", "frame_map_new", "use_lock_interface",
+                                "threads", "threads_mode", "use_persistent_data", "use_save_buffers",
+                                "tile_x", "tile_y")
+    _ignored_cycles_settings = ("tile_order", "use_progressive_refine")
+    
+    @staticmethod
+    def get_rna_settings(rna_struct, ignored_settings=()):
+        rna_settings = dict()
+        for rna_property in rna_struct.bl_rna.properties:
+            if (rna_property.type not in {"BOOLEAN", "INT", "FLOAT", "STRING", "ENUM"} 
+                    or rna_property.identifier in ignored_settings or rna_property.identifier == "rna_type"):
+                continue
+            value = getattr(rna_struct, rna_property.identifier)
+            if isinstance(value, (set, frozenset)):
+                value = sorted(value)
+            elif not isinstance(value, (bool, int, float, str)):
+                value = tuple(value)
+            rna_settings[rna_property.identifier] = value
+        
+        return rna_settings
+    
+    @staticmethod
+    def has_unsaved_changes():
+        # Background runs change the scene only through the run config, whose settings end up in the key
+        return bpy.data.is_dirty and not bpy.app.background
+    
+    @staticmethod
+    def get_blend_file_hash():
+        blend_file_path = bpy.data.filepath
+        if not blend_file_path:
+            raise Exception("Save the .blend file to use the render cache")
+        
+        blend_file_hash = hashlib.sha256()
+        with open(blend_file_path, "rb") as blend_file:
+            for chunk in iter(lambda: blend_file.read(2**20), b""):
+                blend_file_hash.update(chunk)
+        
+        return blend_file_hash.hexdigest()
+    
+    @staticmethod
+    def get_image_files_state(excluded_folder=None):
+        # Images loaded from disk are not saved in the .blend, e.g. the textures of a custom background
+        image_files_state = dict()
+        for image in bpy.data.images:
+            if image.source not in {"FILE", "SEQUENCE", "MOVIE"} or image.packed_file is not None:
+                continue
+            image_path = os.path.abspath(bpy.path.abspath(image.filepath, library=image.library))
+            if excluded_folder is not None and image_path.startswith(excluded_folder):
+                continue
+            image_state = None
+            if path_exists(image_path):
+                image_stat = os.stat(image_path)
+                image_state = (image_stat.st_size, image_stat.st_mtime_ns)
+            image_files_state[image_path] = image_state
+        
+        return image_files_state
+    
+    def __init__(self, context, labeled_objects):
+        self._cache_folder = os.path.expanduser(context.scene.render_cache_folder or self.default_cache_folder)
+        os.makedirs(self._cache_folder, exist_ok=True)
+        self._max_cache_size = context.scene.render_cache_size_mb * 2**20
+        self._output_states = self._get_output_states(context, labeled_objects)
+        self._cache_size = sum([file_size for _, file_size, _ in self._get_cache_files()])
+        if self._cache_size > self._max_cache_size:
+            self._evict()
+        
+    def _get_output_states(self, context, labeled_objects):
+        scene = context.scene
+        # The plane textures are part of the item parameters
+        excluded_folder = None
+        if scene.background_type == "plane":
+            excluded_folder = join_path(os.path.abspath(scene.plane_textures_folder), "")
+        scene_state = {"blend_file": self.get_blend_file_hash(),
+                       "image_files": self.get_image_files_state(excluded_folder),
+                       "render": self.get_rna_settings(scene.render, self._ignored_render_settings),
+                       "view_settings": self.get_rna_settings(scene.view_settings),
+                       "display_settings": self.get_rna_settings(scene.display_settings),
+                       "view_layer": self.get_rna_settings(context.view_layer)}
+        if scene.render.engine == "CYCLES":
+            scene_state["cycles"] = self.get_rna_settings(scene.cycles, self._ignored_cycles_settings)
+        elif scene.render.engine == "BLENDER_EEVEE":
+            scene_state["eevee"] = self.get_rna_settings(scene.eevee)
+        else:
+            scene_state["display"] = self.get_rna_settings(scene.display.shading)
+        
+        # Every output file has its own key, so a settings change of one output does not miss the others
+        image_state = dict(scene_state, file_format=scene.rendered_images_file_format, exr_codec=scene.exr_codec)
+        mask_state = dict(scene_state, method=scene.segmentation_masks_method,
+                          instance_ids=dict([(parent_object.name, parent_object.pass_index) 
+                                             for parent_object in labeled_objects.all_parent_objects]),
+                          max_instance_id=labeled_objects.max_instance_id)
+        
+        return {"image": json.dumps(image_state, sort_keys=True, default=str),
+                "mask": json.dumps(mask_state, sort_keys=True, default=str)}
+    
+    def get_item_keys(self, item_parameters):
+        texture_state = None
+        if item_parameters.get("texture"):
+            texture_stat = os.stat(item_parameters["texture"])
+            texture_state = (texture_stat.st_size, texture_stat.st_mtime_ns)
+        item_state = json.dumps([item_parameters, texture_state], sort_keys=True, default=str)
+        
+        return dict([(output_name, hashlib.sha256(f"{output_state}{item_state}".encode("utf-8")).hexdigest())
+                     for output_name, output_state in self._output_states.items()])
+    
+    def _get_cache_path(self, item_key, item_file_path):
+        return join_path(self._cache_folder, item_key[:2], f"{item_key}{os.path.splitext(item_file_path)[1]}")
+    
+    @staticmethod
+    def _link_file(source_path, destination_path):
+        # Hard links cost no copy, other file systems fall back to copying
+        temporary_path = f"{destination_path}.{os.getpid()}.tmp"
+        try:
+            os.link(source_path, temporary_path)
+        except OSError:
+            shutil.copyfile(source_path, temporary_path)
+        os.replace(temporary_path, destination_path)
+    
+    def is_item_cached(self, item_keys, item_files):
+        return all([path_exists(self._get_cache_path(item_keys[output_name], item_file_path))
+                    for output_name, item_file_path in item_files.items()])
+    
+    def restore_item(self, item_keys, item_files):
+        for output_name, item_file_path in item_files.items():
+            cache_path = self._get_cache_path(item_keys[output_name], item_file_path)
+            os.makedirs(os.path.dirname(item_file_path), exist_ok=True)
+            self._link_file(cache_path, item_file_path)
+            # Modification times order the eviction, the least recently used files go first
+            os.utime(cache_path)
+    
+    @staticmethod
+    def detach_item(item_files):
+        # Blender overwrites files in place, an output linked to the cache would change the cached file
+        for item_file_path in item_files.values():
+            if path_exists(item_file_path) and os.stat(item_file_path).st_nlink > 1:
+                os.remove(item_file_path)
+    
+    def store_item(self, item_keys, item_files):
+        for output_name, item_file_path in item_files.items():
+            cache_path = self._get_cache_path(item_keys[output_name], item_file_path)
+            if path_exists(cache_path):
+                os.utime(cache_path)
+                continue
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            self._link_file(item_file_path, cache_path)
+            self._cache_size += os.stat(cache_path).st_size
+        
+        if self._cache_size > self._max_cache_size:
+            self._evict()
+    
+    def _get_cache_files(self):
+        cache_files = list()
+        for folder_path, _, file_names in os.walk(self._cache_folder):
+            for file_name in file_names:
+                file_path = join_path(folder_path, file_name)
+                file_stat = os.stat(file_path)
+                cache_files.append((file_stat.st_mtime, file_stat.st_size, file_path))
+        
+        return cache_files
+    
+    def _evict(self):
+        # The cache is trimmed below its size limit, so the next items do not trigger the scan again
+        cache_files = sorted(self._get_cache_files())
+        self._cache_size = sum([file_size for _, file_size, _ in cache_files])
+        for _, file_size, file_path in cache_files:
+            if self._cache_size <= 0.9 * self._max_cache_size:
+                break
+            os.remove(file_path)
+            self._cache_size -= file_size
+    
+
 class BS_OT_GenerateDataset(Operator):
     bl_label = "Generate Dataset"
     bl_idname = "bs.generate_dataset"
     
     def execute(self, context):
+        if context.scene.use_render_cache and BS_RenderCache.has_unsaved_changes():
+            self.report({"WARNING"}, "The blend file has unsaved changes, the render cache is not used")
         dataset_generator = BS_DatasetGenerator(context)
-        
-        bpy.app.handlers.frame_change_pre.clear()
-        bpy.app.handlers.frame_change_pre.append(dataset_generator.set_next_scene_render_state)
-
-        bpy.ops.render.render("INVOKE_DEFAULT", animation=True)  
+        if not dataset_generator.item_ranges:
+            self.report({"INFO"}, "All the items are already generated")
+            return {"FINISHED"}
+        dataset_generator.install_handlers()
+        dataset_generator.render_item_ranges(context)
         
         return {"FINISHED"}
 
 class BS_DatasetGenerator:
     __slots__ = ("_items_to_generate", "_first_item_index", 
-                 "_labeled_objects", "_background", "_lights",
+                 "_labeled_objects", "_background", "_lights", "_camera",
                  "_render", "_annotations", "_dataset_json_generator",
-                 "_objects_to_animate", "_scene_render_changes")
+                 "_objects_to_animate", "_scene_render_changes", "_randomness",
+                 "_progress_manifest", "_item_ranges", "_item_written_callbacks",
+                 "_generation_finished_callbacks", "_item_metadata_writer", 
+                 "_item_parameters_sources", "_random_seed", "_bounding_boxes", 
+                 "_output_layout", "_tar_shard_writer", "_async_item_writer", "_is_procedural",
+                 "_render_cache", "_item_ranges_to_render", "_render_window")
     
-    def __init__(self, context):
-        if context.scene.generate_segmentation_masks:
+    _handler_names = ("frame_change_pre", "frame_change_post", "render_init", "render_pre", "render_post", 
+                      "render_write", "render_complete", "render_cancel")
+    
+    @property
+    def item_ranges(self):
+        return self._item_ranges
+    
+    @property
+    def failed_items(self):
+        if self._async_item_writer is None:
+            return list()
+        return self._async_item_writer.failed_items
+    
+    @staticmethod
+    def remove_handlers():
+        # Handlers of the previous generators are recognized by the class name, as it survives add-on reloads
+        for handler_name in BS_DatasetGenerator._handler_names:
+            handlers = getattr(bpy.app.handlers, handler_name)
+            for handler in tuple(handlers):
+                if type(getattr(handler, "__self__", None)).__name__ == "BS_DatasetGenerator":
+                    handlers.remove(handler)
+    
+    def __init__(self, context, shard_id=None):
+        if context.scene.generate_segmentation_masks and context.scene.segmentation_masks_method == "index_pass":
             context.scene.render.engine = "CYCLES"
         
         self._items_to_generate = int(context.scene.items_to_generate)
         self._first_item_index = int(context.scene.first_item_index)
         self._check_item_indices_correctness(self._items_to_generate, self._first_item_index)
+        self._random_seed = context.scene.random_seed
+        self._randomness = BS_ItemRandomness(self._random_seed)
+        self._is_procedural = context.scene.animation_mode == "procedural"
                        
-        self._labeled_objects = BS_LabeledObjects(context)
-        self._background = self._select_background(context)
-        self._lights = BS_Lights(context)
-        self._render = BS_Render(context)
-        self._annotations = BS_Annotations(context, self._labeled_objects.number_of_models)
+        with bs_profiler.span("setup labeled objects", "setup"):
+            self._labeled_objects = BS_LabeledObjects(context)
+        with bs_profiler.span("setup background", "setup"):
+            self._background = self._select_background(context)
+        with bs_profiler.span("setup lights", "setup"):
+            self._lights = BS_Lights(context)
+        self._camera = None
+        if context.scene.camera_position_type == "viewpoints":
+            with bs_profiler.span("setup camera", "setup"):
+                self._camera = BS_Camera(context)
+        with bs_profiler.span("setup compositor nodes", "setup"):
+            self._render = BS_Render(context)
+            self._annotations = BS_Annotations(context, self._labeled_objects.max_instance_id)
+            self._build_compositor_graph(context)
+        self._bounding_boxes = None
+        if context.scene.generate_bounding_boxes:
+            with bs_profiler.span("setup bounding boxes", "setup"):
+                self._bounding_boxes = BS_BoundingBoxes(context, self._labeled_objects.labeled_models, shard_id)
         self._dataset_json_generator = BS_DatasetJSONGenerator(
                                        context=context,
-                                       struct_labeled_objects=self._labeled_objects.structured_labeled_objects) 
+                                       labeled_models=self._labeled_objects.labeled_models,
+                                       shard_id=shard_id) 
+        
+        self._progress_manifest = BS_ProgressManifest(self._render.rendered_images_folder)
+        self._item_metadata_writer = BS_ItemMetadataWriter(self._render.rendered_images_folder, shard_id)
+        self._output_layout = BS_OutputLayout(context)
+        self._tar_shard_writer = None
+        if self._output_layout.is_tar_shards:
+            self._tar_shard_writer = BS_TarShardWriter(self._render.rendered_images_folder, 
+                                                       self._output_layout.items_per_tar_shard, shard_id)
+        self._async_item_writer = None
+        if context.scene.write_outputs_async:
+            self._async_item_writer = BS_AsyncItemWriter(self._render.rendered_images_folder,
+                                                         context.scene.output_writer_threads,
+                                                         context.scene.max_pending_items, shard_id=shard_id)
+        self._render_cache = None
+        # Renders of unsaved scene edits would be cached under the key of the saved .blend
+        if context.scene.use_render_cache and not BS_RenderCache.has_unsaved_changes():
+            with bs_profiler.span("setup render cache", "setup"):
+                self._render_cache = BS_RenderCache(context, self._labeled_objects)
+        self._item_ranges = self._plan_item_ranges(context)
+        self._item_ranges_to_render = list()
+        self._render_window = None
         
         self._objects_to_animate = self._compose_objects_to_animate(context)
+        self._item_parameters_sources = self._compose_item_parameters_sources(context)
         self._scene_render_changes = self._compose_scene_render_changes(context)
-        self._compose_animation(context)
-        self._dataset_json_generator.generate_json()
+        self._item_written_callbacks = self._compose_item_written_callbacks(context)
+        self._generation_finished_callbacks = self._compose_generation_finished_callbacks(context)
+        with bs_profiler.span("compose animation", "setup"):
+            self._compose_animation(context)
+        if self._render_cache is not None and self._item_ranges:
+            with bs_profiler.span("restore cached items", "setup"):
+                self._item_ranges = self._restore_cached_items(context)
+            if not self._item_ranges:
+                # Nothing is rendered, so the render handlers do not close the writers
+                self.generation_finished()
+        self._set_frame_range(context)
+        if not (context.scene.resume_generation and self._dataset_json_generator.json_exists):
+            self._dataset_json_generator.generate_json()
                 
+        if self._item_ranges:
+            for scene_change in self._scene_render_changes:
+                scene_change(self._item_ranges[0][0])
+    
+    def _build_compositor_graph(self, context):
+        compositor_graph = BS_CompositorGraph()
+        self._render.add_compositor_nodes(compositor_graph, context)
+        self._annotations.add_compositor_nodes(compositor_graph, context)
+        compositor_graph.build(context.scene)
+        
+        self._render.set_compositor_nodes(context.scene.node_tree)
+        self._annotations.set_compositor_nodes(context.scene.node_tree)
+    
+    def _compose_item_written_callbacks(self, context):
+        item_written_callbacks = list()
+        if self._render_cache is not None:
+            # Before the packing, which removes the loose files
+            item_written_callbacks.append(self._store_cached_item)
+        if context.scene.write_items_metadata:
+            item_written_callbacks.append(self._write_item_metadata)
+        if self._bounding_boxes is not None:
+            item_written_callbacks.append(self._bounding_boxes.write_item_boxes)
+        if self._tar_shard_writer is not None:
+            item_written_callbacks.append(self._pack_item)
+        item_written_callbacks.append(self._progress_manifest.mark_item_completed)
+        
+        return tuple(item_written_callbacks)
+    
+    def _compose_item_parameters_sources(self, context):
+        item_parameters_sources = list()
+        
+        item_parameters_sources.append(self._labeled_objects)
+        if self._lights in self._objects_to_animate:
+            item_parameters_sources.append(self._lights)
+        if self._camera is not None:
+            item_parameters_sources.append(self._camera)
         if context.scene.background_type == "plane":
-            self._background.set_next_texture()
+            item_parameters_sources.append(self._background)
+        
+        return tuple(item_parameters_sources)
+    
+    def _get_item_metadata(self, item_index):
+        item_metadata = dict(seed=self._random_seed)
+        for item_parameters_source in self._item_parameters_sources:
+            item_metadata.update(item_parameters_source.get_item_parameters(item_index, self._randomness))
+        
+        return item_metadata
+    
+    def _write_item_metadata(self, item_index):
+        self._item_metadata_writer.write_item(item_index, self._get_item_metadata(item_index))
+        
+    def _pack_item(self, item_index):
+        item_files = [(self._render.get_item_path(item_index), self._render.rendered_image_extension)]
+        if self._annotations.segmentation_masks_folder is not None:
+            item_files.append((self._annotations.get_item_path(item_index), 
+                               f".mask{self._annotations.segmentation_image_extension}"))
+        
+        item_record = dict()
+        if bpy.context.scene.write_items_metadata:
+            item_record.update(self._get_item_metadata(item_index))
+        if self._bounding_boxes is not None:
+            item_record["bounding_boxes"] = self._bounding_boxes.get_item_boxes(item_index)
+        
+        self._tar_shard_writer.write_item(item_index, item_files, {".json": item_record} if item_record else dict())
+    
+    def item_written(self, scene, *args):
+        if self._async_item_writer is None:
+            self._run_item_written_callbacks(scene.frame_current)
+            return
+        
+        # The callbacks of an item run once its files are in place, while the next items render
+        self._async_item_writer.submit(scene.frame_current, self._get_item_files(scene.frame_current))
+        for item_index in self._async_item_writer.get_written_items():
+            self._run_item_written_callbacks(item_index)
+            
+    def _run_item_written_callbacks(self, item_index):
+        with bs_profiler.span("item written callbacks", "frame"):
+            for item_written_callback in self._item_written_callbacks:
+                item_written_callback(item_index)
+    
+    def _get_item_outputs(self, item_index):
+        item_outputs = {"image": self._render.get_item_path(item_index)}
+        if self._annotations.segmentation_masks_folder is not None:
+            item_outputs["mask"] = self._annotations.get_item_path(item_index)
+        
+        return item_outputs
+    
+    def _store_cached_item(self, item_index):
+        item_keys = self._render_cache.get_item_keys(self._get_item_metadata(item_index))
+        self._render_cache.store_item(item_keys, self._get_item_outputs(item_index))
+    
+    def _restore_cached_items(self, context):
+        cached_items = list()
+        items_to_render = list()
+        for range_first_item_index, range_last_item_index in self._item_ranges:
+            for item_index in range(range_first_item_index, range_last_item_index + 1):
+                item_keys = self._render_cache.get_item_keys(self._get_item_metadata(item_index))
+                if self._render_cache.is_item_cached(item_keys, self._get_item_outputs(item_index)):
+                    cached_items.append((item_index, item_keys))
+                else:
+                    items_to_render.append(item_index)
+        item_ranges = self._get_item_ranges(numpy.array(items_to_render, dtype=numpy.int64))
+        
+        # Frame changes of the cached items must not run the handlers of a previous generator
+        self.remove_handlers()
+        for item_index, item_keys in cached_items:
+            self._render_cache.restore_item(item_keys, self._get_item_outputs(item_index))
+            self._finish_restored_item(context, item_index)
+        for range_first_item_index, range_last_item_index in item_ranges:
+            for item_index in range(range_first_item_index, range_last_item_index + 1):
+                self._render_cache.detach_item(self._get_item_outputs(item_index))
+        
+        return item_ranges
+    
+    def _finish_restored_item(self, context, item_index):
+        if self._bounding_boxes is not None:
+            # Boxes come from the evaluated scene of the item, which needs no render
+            if self._is_procedural:
+                self.apply_item_state(item_index)
+            context.scene.frame_set(item_index)
+            self.scene_evaluated(context.scene)
+        self._run_item_written_callbacks(item_index)
+    
+    def _get_item_files(self, item_index):
+        item_files = [(self._render.get_item_path(item_index, staged=True), self._render.get_item_path(item_index))]
+        if self._annotations.segmentation_masks_folder is not None:
+            item_files.append((self._annotations.get_item_path(item_index, staged=True), 
+                               self._annotations.get_item_path(item_index)))
+        
+        return item_files
+    
+    def _finish_writing_items(self):
+        for item_index in self._async_item_writer.get_written_items(wait=True):
+            self._run_item_written_callbacks(item_index)
+    
+    def _compose_generation_finished_callbacks(self, context):
+        generation_finished_callbacks = list()
+        if self._async_item_writer is not None:
+            generation_finished_callbacks.append(self._finish_writing_items)
+            generation_finished_callbacks.append(self._async_item_writer.close)
+        generation_finished_callbacks.append(self._item_metadata_writer.close)
+        if self._bounding_boxes is not None:
+            generation_finished_callbacks.append(self._bounding_boxes.close)
+        if self._tar_shard_writer is not None:
+            generation_finished_callbacks.append(self._tar_shard_writer.close)
+        generation_finished_callbacks.append(self._progress_manifest.close)
+        generation_finished_callbacks.append(self._annotations.restore_object_colors)
+        if context.scene.background_type == "plane":
+            generation_finished_callbacks.append(self._background.stop_prefetching)
+        if self._is_procedural and self._lights in self._objects_to_animate:
+            generation_finished_callbacks.append(self._lights.restore_base_values)
+        
+        return tuple(generation_finished_callbacks)
+    
+    def generation_started(self, *args):
+        # Called before every rendered animation, the finished one gave the objects their colors back
+        self._annotations.set_id_colors()
+    
+    def generation_finished(self, *args):
+        # Called after every rendered animation, also the cancelled ones
+        for generation_finished_callback in self._generation_finished_callbacks:
+            generation_finished_callback()
+    
+    def _plan_item_ranges(self, context):
+        first_item_index = self._first_item_index
+        last_item_index = self._first_item_index + self._items_to_generate - 1
+        
+        if not context.scene.resume_generation:
+            return ((first_item_index, last_item_index),)
+        
+        completed_items = self._get_completed_items(context)
+        completed_items = completed_items[(completed_items >= first_item_index) 
+                                          & (completed_items <= last_item_index)]
+        is_item_missing = numpy.ones(self._items_to_generate, dtype=bool)
+        is_item_missing[completed_items - first_item_index] = False
+        missing_items = numpy.flatnonzero(is_item_missing) + first_item_index
+        
+        return self._get_item_ranges(missing_items)
+    
+    @staticmethod
+    def _get_item_ranges(missing_items):
+        # Every run of consecutive missing items is rendered as its own animation
+        if not len(missing_items):
+            return tuple()
+        
+        range_breaks = numpy.flatnonzero(numpy.diff(missing_items) > 1)
+        range_starts = numpy.concatenate((missing_items[:1], missing_items[range_breaks + 1]))
+        range_ends = numpy.concatenate((missing_items[range_breaks], missing_items[-1:]))
+        
+        return tuple(zip(range_starts.tolist(), range_ends.tolist()))
+    
+    def _get_completed_items(self, context):
+        if self._progress_manifest.exists:
+            return self._progress_manifest.get_completed_items()
+        
+        # Datasets started without a manifest are indexed by their output files
+        completed_items = BS_ProgressManifest.scan_folder(self._render.rendered_images_folder,
+                                                          self._render.rendered_image_extension)
+        if context.scene.generate_segmentation_masks:
+            completed_masks = BS_ProgressManifest.scan_folder(self._annotations.segmentation_masks_folder,
+                                                              self._annotations.segmentation_image_extension)
+            completed_items = numpy.intersect1d(completed_items, completed_masks)
+        
+        return completed_items
     
     def _compose_scene_render_changes(self, context):
         scene_render_changes = list()
+        if self._is_procedural:
+            scene_render_changes.append(self.apply_item_state)
         if context.scene.background_type == "plane":
-            scene_render_changes.append(self._background.set_next_texture)
-            return tuple(scene_render_changes)
+            scene_render_changes.append(self._background.set_item_texture)
+        if self._output_layout.is_nested:
+            scene_render_changes.append(self._render.set_index)
+            if self._annotations.segmentation_masks_folder is not None:
+                scene_render_changes.append(self._annotations.set_index)
+        
+        return tuple(scene_render_changes)
         
-    def set_next_scene_render_state(self, *args):
-        for scene_change in self._scene_render_changes:
-            scene_change()    
+    def apply_item_state(self, item_index):
+        # Procedural mode: the random state of the item is computed from its index and set directly
+        for animated_object in self._objects_to_animate:
+            animated_object.apply_item_state(item_index, self._randomness)
+    
+    def set_next_scene_render_state(self, scene, *args):
+        # Frame number is the index of the item being rendered
+        with bs_profiler.span("set scene render state", "frame"):
+            for scene_change in self._scene_render_changes:
+                scene_change(scene.frame_current)    
+        
+    def render_started(self, *args):
+        bs_profiler.begin("render")
+    
+    def render_finished(self, *args):
+        # render_post of an animation frame comes after the compositing, so the span includes the
+        # File Output nodes writing the files
+        bs_profiler.end("render")
+    
+    def scene_evaluated(self, scene, depsgraph=None):
+        # Bounding boxes need the object matrices after the frame's animation is evaluated
+        if self._bounding_boxes is not None:
+            with bs_profiler.span("compute bounding boxes", "frame"):
+                self._bounding_boxes.compute_boxes(scene, depsgraph or bpy.context.evaluated_depsgraph_get())
+    
+    def install_handlers(self):
+        self.remove_handlers()
+        bpy.app.handlers.frame_change_pre.append(self.set_next_scene_render_state)
+        bpy.app.handlers.frame_change_post.append(self.scene_evaluated)
+        bpy.app.handlers.render_init.append(self.generation_started)
+        bpy.app.handlers.render_write.append(self.item_written)
+        bpy.app.handlers.render_complete.append(self.generation_finished)
+        bpy.app.handlers.render_cancel.append(self.generation_finished)
+        if bs_profiler.is_enabled:
+            bpy.app.handlers.render_pre.append(self.render_started)
+            bpy.app.handlers.render_post.append(self.render_finished)
+    
+    def render_item_ranges(self, context):
+        # The UI renders the item ranges one after another, every next one is started once the previous
+        # render has completed
+        self._item_ranges_to_render = list(self._item_ranges)
+        self._render_window = context.window
+        bpy.app.handlers.render_complete.append(self.item_range_rendered)
+        bpy.app.handlers.render_cancel.append(self.item_range_cancelled)
+        self._render_next_item_range()
+    
+    def item_range_rendered(self, *args):
+        # A render cannot be started from the handlers of the finishing one, nor can they be removed 
+        # while Blender runs them
+        if self._item_ranges_to_render:
+            bpy.app.timers.register(self._render_next_item_range)
+        else:
+            self._finish_rendering()
+    
+    def item_range_cancelled(self, *args):
+        self._item_ranges_to_render.clear()
+        self._finish_rendering()
+    
+    def _finish_rendering(self):
+        # Frame changes after the generation, e.g. scrubbing the timeline, must not compute boxes or
+        # change the scene anymore
+        bpy.app.timers.register(self.remove_handlers)
+    
+    def _render_next_item_range(self):
+        if not self._item_ranges_to_render:
+            return None
+        
+        first_item_index, last_item_index = self._item_ranges_to_render[0]
+        scene = self._render_window.scene
+        scene.frame_start = first_item_index
+        scene.frame_end = last_item_index
+        context_override = {"window": self._render_window, "screen": self._render_window.screen, "scene": scene}
+        if "CANCELLED" in bpy.ops.render.render(context_override, "INVOKE_DEFAULT", animation=True):
+            # The render job of the previous range has not ended yet
+            return 0.1
+        del self._item_ranges_to_render[0]
+        return None
         
     def _select_background(self, context):
         if context.scene.background_type == "plane":
-            return BS_BackgroundPlane(context)
+            return BS_BackgroundPlane(context, self._randomness)
         elif context.scene.background_type == "custom":
             return BS_BackgroundCustom(context)
         
@@ -962,27 +3507,539 @@ class BS_DatasetGenerator:
         objects_to_animate = list()
         
         objects_to_animate.append(self._labeled_objects)
-        if context.scene.randomly_toggle_lights:
+        if BS_Lights.is_randomization_enabled(context.scene) and self._lights.num_lights:
             objects_to_animate.append(self._lights)
-        if context.scene.randomly_change_bg_brightness:
+        if self._camera is not None:
+            objects_to_animate.append(self._camera)
+        if context.scene.background_type == "plane" and context.scene.randomly_change_bg_brightness:
             objects_to_animate.append(self._background)
         
         return tuple(objects_to_animate)
     
     def _compose_animation(self, context):
-        first_item_index = self._first_item_index
-        last_item_index = self._first_item_index + self._items_to_generate - 1
+        if not self._item_ranges:
+            return
+        
+        if self._is_procedural:
+            for animated_object in self._objects_to_animate:
+                animated_object.clear_animation()
+        else:
+            # Random parameters of all the frames are drawn at once and baked into the F-Curves in bulk
+            frames = numpy.concatenate([numpy.arange(range_first_item_index, range_last_item_index + 1) 
+                                        for range_first_item_index, range_last_item_index in self._item_ranges])
+            for animated_object in self._objects_to_animate:
+                animated_object.bake_animation(frames, self._randomness)       
+    
+    def _set_frame_range(self, context):
+        if not self._item_ranges:
+            return
+        
+        context.scene.frame_start = self._item_ranges[0][0]
+        context.scene.frame_end = self._item_ranges[0][1]
+        context.scene.frame_current = self._item_ranges[0][0]
+        
+        
+############################################################################################################
+#                                           HEADLESS RUN
+############################################################################################################
+class BS_ConfigError(Exception):
+    pass
+
+
+class BS_RunConfig:
+    __slots__ = ("_config_path", "_sections")
+    
+    # Scene pointer properties are given in the config by datablock name
+    _pointer_properties = {"labeled_objects_collection": "collections",
+                           "lights_collection": "collections",
+                           "background_plane": "objects",
+                           "shooting_camera": "objects"}
+    _section_names = ("scene", "render", "cycles")
+    
+    def __init__(self, config_path=None):
+        self._config_path = config_path
+        self._sections = dict([(section_name, dict()) for section_name in self._section_names])
+        
+        if config_path is not None:
+            self.update(self._load_config(config_path))
+    
+    @property
+    def config_path(self):
+        return self._config_path
+    
+    def save(self, config_path):
+        config = dict([(section_name, section_settings) for section_name, section_settings in self._sections.items()
+                       if section_settings])
+        with open(config_path, "w") as config_file:
+            json.dump(config, config_file, indent=1)
+    
+    def update(self, config):
+        for section_name, section_settings in config.items():
+            if section_name not in self._sections:
+                raise BS_ConfigError(f"Unknown config section '{section_name}'. "
+                                     f"Allowed sections are {self._section_names}")
+            if not isinstance(section_settings, dict):
+                raise BS_ConfigError(f"Config section '{section_name}' must be a table of settings")
+            self._sections[section_name].update(section_settings)
+    
+    def apply(self, context):
+        scene = context.scene
         
-        context.scene.frame_start = first_item_index
-        context.scene.frame_end = last_item_index
+        for property_name, value in self._sections["scene"].items():
+            if property_name in self._pointer_properties:
+                value = self._get_datablock(property_name, value)
+            self._set_property(scene, "scene", property_name, value)
             
-        for frame_num in range(first_item_index, last_item_index + 1):
-            context.scene.frame_current = frame_num
+        for property_name, value in self._sections["render"].items():
+            self._set_property(scene.render, "render", property_name, value)
+        
+        cycles_settings = self._sections["cycles"]
+        if cycles_settings and getattr(scene, "cycles", None) is None:
+            raise BS_ConfigError("Config has 'cycles' settings but the Cycles add-on is not enabled")
+        for property_name, value in cycles_settings.items():
+            self._set_property(scene.cycles, "cycles", property_name, value)
+    
+    def _set_property(self, owner, section_name, property_name, value):
+        if not hasattr(owner, property_name):
+            raise BS_ConfigError(f"Unknown {section_name} setting '{property_name}'")
+        try:
+            setattr(owner, property_name, value)
+        except (TypeError, ValueError, AttributeError) as error:
+            raise BS_ConfigError(f"Invalid value {value!r} for {section_name} setting "
+                                 f"'{property_name}': {error}")
+    
+    def _get_datablock(self, property_name, datablock_name):
+        datablocks = getattr(bpy.data, self._pointer_properties[property_name])
+        datablock = datablocks.get(datablock_name, None)
+        if datablock is None:
+            raise BS_ConfigError(f"'{datablock_name}' given for '{property_name}' "
+                                 "does not exist in the blend file")
+        return datablock
+    
+    def _load_config(self, config_path):
+        with open(config_path, "r") as config_file:
+            config_text = config_file.read()
+        
+        try:
+            if config_path.endswith(".toml"):
+                if tomllib is None:
+                    raise BS_ConfigError("TOML configs need Python 3.11+ or the 'toml' package")
+                return tomllib.loads(config_text)
+            return json.loads(config_text)
+        except BS_ConfigError:
+            raise
+        except Exception as error:
+            raise BS_ConfigError(f"Cannot parse config '{config_path}': {error}")
+
+
+class BS_RenderAutotuner:
+    __slots__ = ("_context", "_args", "_item_indices", "_work_folder")
+    
+    # Every combination is rendered, from which the cheapest one reaching the target quality is taken
+    _samples_grid = (16, 32, 64, 128, 256)
+    _use_denoising_grid = (False, True)
+    _max_bounces_grid = (4, 8, 12)
+    _reference_settings = {"samples": 1024, "use_denoising": False, "max_bounces": 12}
+    _tile_sizes = (16, 32, 64, 256)
+    
+    def __init__(self, context, args):
+        self._context = context
+        self._args = args
+        self._item_indices = self._get_item_indices(context.scene, args.autotune_items)
+        self._work_folder = None
+        
+    def _get_item_indices(self, scene, num_items):
+        # Items are spread over the planned ones, so the sample covers the variety of the dataset
+        items_to_generate = scene.items_to_generate
+        item_nums = numpy.unique(numpy.linspace(0, items_to_generate - 1, min(num_items, items_to_generate)))
+        return tuple((scene.first_item_index + item_nums.astype(numpy.int64)).tolist())
+    
+    def run(self):
+        scene = self._context.scene
+        if scene.render.engine != "CYCLES":
+            raise BS_ConfigError("Autotuning tunes the Cycles settings, the render engine has to be CYCLES")
+        
+        self._work_folder = tempfile.mkdtemp(prefix="bs_autotune_")
+        try:
+            dataset_generator = self._setup_dataset_generator(scene)
+            try:
+                reference_images, _ = self._render_items(self._reference_settings)
+                results = list()
+                for settings in self._get_settings_grid():
+                    images, render_time = self._render_items(settings)
+                    psnr = min([self.get_psnr(image, reference_image) 
+                                for image, reference_image in zip(images, reference_images)])
+                    results.append((settings, render_time, psnr))
+                    print(f"BlenderSynther: autotune {settings} - {render_time:.2f} s, PSNR {psnr:.2f} dB")
+                
+                best_settings = self._select_settings(results)
+                best_settings.update(self._select_tile_size(best_settings))
+            finally:
+                dataset_generator.generation_finished()
+                BS_DatasetGenerator.remove_handlers()
+        finally:
+            shutil.rmtree(self._work_folder, ignore_errors=True)
+        
+        self._save_settings(best_settings)
+        return best_settings
+    
+    def _setup_dataset_generator(self, scene):
+        # Items are set up by the dataset generator as in a real run, but only the rendered images are written
+        scene.rendered_images_folder = self._work_folder
+        scene.rendered_images_file_format = "PNG"
+        scene.first_item_index = self._item_indices[0]
+        scene.items_to_generate = self._item_indices[-1] - self._item_indices[0] + 1
+        scene.resume_generation = False
+        scene.generate_segmentation_masks = False
+        scene.generate_bounding_boxes = False
+        scene.write_items_metadata = False
+        scene.write_outputs_async = False
+        scene.use_render_cache = False
+        scene.output_layout = "flat"
+        
+        dataset_generator = BS_DatasetGenerator(self._context)
+        dataset_generator.install_handlers()
+        return dataset_generator
+    
+    def _get_settings_grid(self):
+        for samples, use_denoising, max_bounces in itertools.product(self._samples_grid, self._use_denoising_grid,
+                                                                     self._max_bounces_grid):
+            yield {"samples": samples, "use_denoising": use_denoising, "max_bounces": max_bounces}
+    
+    def _apply_settings(self, settings):
+        scene = self._context.scene
+        for property_name, value in settings.items():
+            if property_name in ("tile_x", "tile_y"):
+                setattr(scene.render, property_name, value)
+            else:
+                setattr(scene.cycles, property_name, value)
+    
+    def _render_items(self, settings):
+        scene = self._context.scene
+        self._apply_settings(settings)
+        
+        images = list()
+        render_time = 0.0
+        for item_index in self._item_indices:
+            scene.frame_set(item_index)
+            start_time = time.perf_counter()
+            bpy.ops.render.render(write_still=False)
+            render_time += time.perf_counter() - start_time
+            images.append(self._read_rendered_image(item_index))
             
-            for animated_object in self._objects_to_animate:
-                animated_object.insert_animation_keyframe(frame_num)       
+        return images, render_time
+    
+    def _read_rendered_image(self, item_index):
+        # The quality is measured on the written 8-bit images, as the dataset gets them
+        image_path = join_path(self._work_folder, f"{item_index:010d}.png")
+        image = bpy.data.images.load(image_path, check_existing=False)
+        try:
+            pixels = numpy.empty(len(image.pixels), dtype=numpy.float32)
+            image.pixels.foreach_get(pixels)
+        finally:
+            bpy.data.images.remove(image)
+            os.remove(image_path)
         
-        context.scene.frame_current = first_item_index
+        return pixels.reshape(-1, 4)[:, :3]
+    
+    @staticmethod
+    def get_psnr(image, reference_image):
+        mse = float(numpy.mean(numpy.square(image - reference_image, dtype=numpy.float64)))
+        return float("inf") if mse == 0 else 10 * numpy.log10(1 / mse)
+    
+    def _select_settings(self, results):
+        target_psnr = self._args.target_psnr
+        passing_results = [result for result in results if result[2] >= target_psnr]
+        if passing_results:
+            settings, render_time, psnr = min(passing_results, key=lambda result: result[1])
+        else:
+            settings, render_time, psnr = max(results, key=lambda result: result[2])
+            print(f"BlenderSynther: no settings reach {target_psnr} dB, taking the closest ones", file=sys.stderr)
+        
+        print(f"BlenderSynther: selected {settings} - {render_time:.2f} s, PSNR {psnr:.2f} dB")
+        return dict(settings)
+    
+    def _select_tile_size(self, settings):
+        # Tile size changes only the render time, so it is timed with the selected quality settings
+        if not hasattr(self._context.scene.render, "tile_x"):
+            return dict()
+        
+        tile_times = list()
+        for tile_size in self._tile_sizes:
+            tile_settings = dict(settings, tile_x=tile_size, tile_y=tile_size)
+            _, render_time = self._render_items(tile_settings)
+            tile_times.append((render_time, tile_size))
+            print(f"BlenderSynther: autotune tile size {tile_size} - {render_time:.2f} s")
+        
+        tile_size = min(tile_times)[1]
+        return {"tile_x": tile_size, "tile_y": tile_size}
+    
+    def _save_settings(self, settings):
+        autotuned_config_path = (self._args.autotune_output 
+                                 or f"{os.path.splitext(self._args.config)[0]}.autotuned.json")
+        
+        # The config is saved without the command line overrides
+        run_config = BS_RunConfig(self._args.config)
+        render_settings = dict([(property_name, settings.pop(property_name)) 
+                                for property_name in ("tile_x", "tile_y") if property_name in settings])
+        run_config.update({"cycles": settings, "render": render_settings})
+        run_config.save(autotuned_config_path)
+        print(f"BlenderSynther: autotuned config saved to '{autotuned_config_path}'")
+        
+        
+class BS_HeadlessRunner:
+    __slots__ = ("_args",)
+    
+    EXIT_SUCCESS = 0
+    EXIT_CONFIG_ERROR = 2
+    EXIT_GENERATION_ERROR = 3
+    EXIT_RENDER_CANCELLED = 4
+    EXIT_SHARD_FAILED = 5
+    
+    @staticmethod
+    def get_script_args(argv):
+        # Blender passes everything after "--" to the script untouched
+        if "--" in argv:
+            return argv[argv.index("--") + 1:]
+        return list()
+    
+    def __init__(self, script_args):
+        self._args = self._parse_args(script_args)
+    
+    def run(self):
+        if self._args.profile is None:
+            return self._run()
+        
+        bs_profiler.enable()
+        try:
+            return self._run()
+        finally:
+            bs_profiler.write_chrome_trace(self._args.profile)
+            print(bs_profiler.get_summary())
+            print(f"BlenderSynther: Chrome trace written to '{self._args.profile}'")
+    
+    def _run(self):
+        context = bpy.context
+        is_worker = self._args.shard_id is not None
+        
+        if self._args.preprocess_textures and is_worker:
+            return self._preprocess_textures_shard()
+        
+        try:
+            self._compose_run_config().apply(context)
+        except (BS_ConfigError, OSError) as error:
+            print(f"BlenderSynther: configuration error: {error}", file=sys.stderr)
+            return self.EXIT_CONFIG_ERROR
+        
+        if self._args.autotune:
+            return self._autotune_render_settings(context)
+        if self._args.preprocess_textures:
+            num_workers = self._args.shards or os.cpu_count() or 1
+            failed_shard_ids = BS_TexturePreprocessor.from_scene(context.scene).launch(num_workers)
+            return self.EXIT_SHARD_FAILED if failed_shard_ids else self.EXIT_SUCCESS
+        if (self._args.shards or 1) > 1 and not is_worker:
+            return BS_ShardLauncher(context, self._args).run()
+        return self._generate_dataset(context)
+    
+    def _preprocess_textures_shard(self):
+        try:
+            texture_preprocessor = BS_TexturePreprocessor(self._args.textures_folder, tuple(self._args.target_size))
+            texture_preprocessor.resize_textures(self._args.shard_id, self._args.shards)
+        except Exception:
+            traceback.print_exc()
+            return self.EXIT_GENERATION_ERROR
+        return self.EXIT_SUCCESS
+    
+    def _autotune_render_settings(self, context):
+        try:
+            BS_RenderAutotuner(context, self._args).run()
+        except BS_ConfigError as error:
+            print(f"BlenderSynther: configuration error: {error}", file=sys.stderr)
+            return self.EXIT_CONFIG_ERROR
+        except Exception:
+            traceback.print_exc()
+            return self.EXIT_GENERATION_ERROR
+        return self.EXIT_SUCCESS
+    
+    def _generate_dataset(self, context):
+        render_result = {"FINISHED"}
+        try:
+            dataset_generator = BS_DatasetGenerator(context, shard_id=self._args.shard_id)
+            dataset_generator.install_handlers()
+            
+            for first_item_index, last_item_index in dataset_generator.item_ranges:
+                context.scene.frame_start = first_item_index
+                context.scene.frame_end = last_item_index
+                render_result = bpy.ops.render.render("EXEC_DEFAULT", animation=True)
+                if "FINISHED" not in render_result:
+                    break
+        except Exception:
+            traceback.print_exc()
+            return self.EXIT_GENERATION_ERROR
+        finally:
+            BS_DatasetGenerator.remove_handlers()
+        
+        if dataset_generator.failed_items:
+            # The failed items are not in the progress manifest, so a resumed run renders them again
+            print(f"BlenderSynther: {len(dataset_generator.failed_items)} item(s) were not written: "
+                  f"{dataset_generator.failed_items}", file=sys.stderr)
+            return self.EXIT_GENERATION_ERROR
+        
+        if "FINISHED" not in render_result:
+            print("BlenderSynther: rendering was cancelled", file=sys.stderr)
+            return self.EXIT_RENDER_CANCELLED
+        return self.EXIT_SUCCESS
+    
+    def _compose_run_config(self):
+        run_config = BS_RunConfig(self._args.config)
+        
+        scene_overrides = dict()
+        if self._args.first_item_index is not None:
+            scene_overrides["first_item_index"] = self._args.first_item_index
+        if self._args.items_to_generate is not None:
+            scene_overrides["items_to_generate"] = self._args.items_to_generate
+        if self._args.resume:
+            scene_overrides["resume_generation"] = True
+        
+        render_overrides = dict()
+        if self._args.threads is not None and (self._args.shards or 1) <= 1:
+            render_overrides["threads_mode"] = "FIXED"
+            render_overrides["threads"] = self._args.threads
+            
+        run_config.update({"scene": scene_overrides, "render": render_overrides})
+        return run_config
+    
+    def _parse_args(self, script_args):
+        parser = argparse.ArgumentParser(
+                    prog="blender -b scene.blend -P BlenderSynther.py --",
+                    description="Generate a BlenderSynther dataset without the UI")
+        parser.add_argument("--config",
+                            help="JSON or TOML file with 'scene', 'render' and 'cycles' settings")
+        parser.add_argument("--first-item-index", type=int, default=None,
+                            help="Override the first item index of the config")
+        parser.add_argument("--items-to-generate", type=int, default=None,
+                            help="Override the number of items of the config")
+        parser.add_argument("--resume", action="store_true",
+                            help="Render only the items which are not generated yet")
+        parser.add_argument("--shards", type=int, default=None,
+                            help="Split the work between this many Blender worker processes, "
+                                 "by default 1 for rendering and 1 per CPU for texture preprocessing")
+        parser.add_argument("--threads", type=int, default=None,
+                            help="Render threads of every worker, by default the CPUs are split evenly")
+        parser.add_argument("--preprocess-textures", action="store_true",
+                            help="Resize the plane textures to the render resolution instead of rendering")
+        parser.add_argument("--autotune", action="store_true",
+                            help="Find the cheapest Cycles settings reaching --target-psnr instead of rendering")
+        parser.add_argument("--autotune-items", type=int, default=4,
+                            help="Items rendered for every autotuned setting")
+        parser.add_argument("--target-psnr", type=float, default=35.0,
+                            help="Lowest PSNR in dB against the reference render accepted by autotuning")
+        parser.add_argument("--autotune-output", default=None,
+                            help="Where to save the autotuned config, by default <config>.autotuned.json")
+        parser.add_argument("--profile", default=None,
+                            help="Time the generation stages, write a Chrome trace JSON to this path "
+                                 "and print a summary")
+        parser.add_argument("--shard-id", type=int, default=None,
+                            help=argparse.SUPPRESS)
+        parser.add_argument("--textures-folder", default=None,
+                            help=argparse.SUPPRESS)
+        parser.add_argument("--target-size", type=int, nargs=2, default=None,
+                            help=argparse.SUPPRESS)
+        
+        args = parser.parse_args(script_args)
+        if args.config is None and not (args.preprocess_textures and args.shard_id is not None):
+            parser.error("the following arguments are required: --config")
+        return args
+
+
+class BS_ShardLauncher:
+    __slots__ = ("_args", "_rendered_images_folder", "_blend_file_path", 
+                 "_shards", "_threads_per_shard")
+    
+    def __init__(self, context, args):
+        self._args = args
+        self._rendered_images_folder = context.scene.rendered_images_folder
+        self._blend_file_path = bpy.data.filepath
+        self._shards = self._split_items(context.scene.first_item_index, 
+                                         context.scene.items_to_generate, args.shards)
+        self._threads_per_shard = args.threads or max(1, (os.cpu_count() or 1) // len(self._shards))
+    
+    def run(self):
+        if not self._blend_file_path:
+            print("BlenderSynther: sharded runs need a saved blend file", file=sys.stderr)
+            return BS_HeadlessRunner.EXIT_CONFIG_ERROR
+        if not path_exists(self._rendered_images_folder):
+            print(f"BlenderSynther: rendered images folder '{self._rendered_images_folder}' "
+                  "does not exist", file=sys.stderr)
+            return BS_HeadlessRunner.EXIT_CONFIG_ERROR
+        
+        workers_script_args = list()
+        for shard_id, shard in enumerate(self._shards):
+            workers_script_args.append(self._get_worker_script_args(shard_id, *shard))
+            print(f"BlenderSynther: shard {shard_id} renders items {shard[0]}..{sum(shard) - 1} "
+                  f"with {self._threads_per_shard} threads")
+        
+        failed_shard_ids = self.run_workers(workers_script_args, self._rendered_images_folder, 
+                                            self._blend_file_path)
+        if failed_shard_ids:
+            return BS_HeadlessRunner.EXIT_SHARD_FAILED
+        
+        BS_DatasetJSONGenerator.merge_shards(self._rendered_images_folder, range(len(self._shards)))
+        BS_ItemMetadataWriter.merge_shards(self._rendered_images_folder, range(len(self._shards)))
+        BS_ItemMetadataWriter.merge_shards(self._rendered_images_folder, range(len(self._shards)),
+                                           BS_BoundingBoxes.metadata_name)
+        BS_ItemMetadataWriter.merge_shards(self._rendered_images_folder, range(len(self._shards)),
+                                           BS_TarShardWriter.tar_index_name)
+        BS_AsyncItemWriter.merge_shards(self._rendered_images_folder, range(len(self._shards)))
+        return BS_HeadlessRunner.EXIT_SUCCESS
+    
+    @staticmethod
+    def run_workers(workers_script_args, logs_folder, blend_file_path=None):
+        blender_args = [bpy.app.binary_path, "--background"]
+        blender_args += [blend_file_path] if blend_file_path else ["--factory-startup"]
+        blender_args += ["--python", os.path.abspath(__file__), "--"]
+        
+        workers = list()
+        for shard_id, worker_script_args in enumerate(workers_script_args):
+            shard_log_path = join_path(logs_folder, f"shard-{shard_id:04d}.log")
+            with open(shard_log_path, "w") as shard_log:
+                workers.append(subprocess.Popen(blender_args + worker_script_args,
+                                                stdout=shard_log, stderr=subprocess.STDOUT))
+        
+        failed_shard_ids = [shard_id for shard_id, worker in enumerate(workers) 
+                            if worker.wait() != BS_HeadlessRunner.EXIT_SUCCESS]
+        if failed_shard_ids:
+            print(f"BlenderSynther: shards {failed_shard_ids} failed, see their logs in '{logs_folder}'", 
+                  file=sys.stderr)
+            
+        return failed_shard_ids
+    
+    def _get_worker_script_args(self, shard_id, first_item_index, items_to_generate):
+        return ["--config", os.path.abspath(self._args.config),
+                "--first-item-index", str(first_item_index),
+                "--items-to-generate", str(items_to_generate),
+                "--threads", str(self._threads_per_shard),
+                "--shard-id", str(shard_id)] + (["--resume"] if self._args.resume else []) + \
+                self._get_worker_profile_args(shard_id)
+    
+    def _get_worker_profile_args(self, shard_id):
+        if self._args.profile is None:
+            return list()
+        profile_path, profile_extension = os.path.splitext(os.path.abspath(self._args.profile))
+        return ["--profile", f"{profile_path}.shard-{shard_id:04d}{profile_extension}"]
+    
+    def _split_items(self, first_item_index, items_to_generate, num_shards):
+        num_shards = min(num_shards, items_to_generate)
+        shard_size, shards_with_extra_item = divmod(items_to_generate, num_shards)
+        
+        shards = list()
+        shard_first_item_index = first_item_index
+        for shard_id in range(num_shards):
+            shard_items = shard_size + (1 if shard_id < shards_with_extra_item else 0)
+            shards.append((shard_first_item_index, shard_items))
+            shard_first_item_index += shard_items
+        
+        return tuple(shards)
         
         
 ############################################################################################################
@@ -995,8 +4052,7 @@ classes = (BS_PGT_LabeledObjectsProperies, BS_PGT_BackgroundProperies,
            BS_PT_BackgroundSettings, BS_PT_Lights,
            BS_PT_Camera, BS_PT_CameraSettings, BS_PT_Annotations,
            BS_PT_Render, BS_PT_DatasetGeneration, 
-           BS_OT_FullLoxoromeGenerator, BS_OT_HalfLoxoromeGenerator,
-           BS_OT_CameraSetupToTrack,
+           BS_OT_PreviewCameraViewpoints, BS_OT_PreprocessTextures, BS_OT_ResetLights,
            BS_OT_GenerateDataset, 
            )
 
@@ -1012,12 +4068,15 @@ def unregister():
     
 if __name__ == '__main__':
     from functools import partial
-    from time import process_time
     from datetime import datetime
     #from bpy.app.handlers import persistent
     
     register()
     
+    script_args = BS_HeadlessRunner.get_script_args(sys.argv)
+    if script_args:
+        sys.exit(BS_HeadlessRunner(script_args).run())
+    
     context = bpy.context
     scene = context.scene
     # Animation Compositor
@@ -1042,7 +4101,6 @@ if __name__ == '__main__':
     #bpy.ops.render.render(context, "INVOKE_DEFAULT")
     #bpy.app.timers.register(bs_render)      
     #context = bpy.context
-    #start_time = process_time()
     
     #labeled_objects = BS_LabeledObjects(context)
     #lights = BS_Lights(context)
@@ -1060,7 +4118,3 @@ if __name__ == '__main__':
     #bpy.app.handlers.render_complete.append(render_next_scene)
     #bpy.ops.render.render("INVOKE_DEFAULT", write_still=True)    
     #bpy.app.handlers.render_complete.clear()
-
-    # 1000 - 0.0047 sec
-    # 10000 - 0.0515 sec
-    #print("Execution time:", (process_time() - start_time) / 10, "(sec)")
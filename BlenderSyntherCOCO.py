@@ -0,0 +1,265 @@
+"""Exports a BlenderSynther dataset with segmentation masks as COCO instances.
+
+Runs with a plain Python 3 interpreter, outside of Blender:
+
+    python BlenderSyntherCOCO.py rendered/images/folder/ -o instances.json --workers 8
+
+Needs NumPy and Pillow to read the 8 or 16 bit PNG masks.
+"""
+import argparse
+import concurrent.futures
+import collections
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+from os.path import join as join_path
+
+import numpy
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class BS_MaskRLEEncoder:
+    __slots__ = ()
+    
+    @staticmethod
+    def get_counts(instance_mask):
+        # COCO run lengths go over the pixels in column-major order and start with a run of zeros
+        pixels = instance_mask.T.ravel()
+        run_boundaries = numpy.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+        run_boundaries = numpy.concatenate(([0], run_boundaries, [pixels.size]))
+        counts = numpy.diff(run_boundaries)
+        if pixels[0]:
+            counts = numpy.concatenate(([0], counts))
+        
+        return counts
+    
+    @staticmethod
+    def compress_counts(counts):
+        # Same LEB128-like string encoding as pycocotools' rleToString
+        compressed_counts = list()
+        counts = counts.tolist()
+        for count_num, count in enumerate(counts):
+            if count_num > 2:
+                count -= counts[count_num - 2]
+            more_chunks = True
+            while more_chunks:
+                chunk = count & 0x1f
+                count >>= 5
+                more_chunks = (count != -1) if chunk & 0x10 else (count != 0)
+                if more_chunks:
+                    chunk |= 0x20
+                compressed_counts.append(chr(chunk + 48))
+        
+        return "".join(compressed_counts)
+    
+    @classmethod
+    def encode(cls, instance_mask):
+        height, width = instance_mask.shape
+        return {"size": [height, width], "counts": cls.compress_counts(cls.get_counts(instance_mask))}
+    
+
+# Per worker process lookup table from mask pixel values to category ids, set by the pool initializer
+_category_lut = None
+
+
+def _init_worker(category_lut):
+    global _category_lut
+    _category_lut = category_lut
+
+
+def _read_tar_member(tar_path, data_offset, data_size):
+    with open(tar_path, "rb") as tar_file:
+        tar_file.seek(data_offset)
+        return io.BytesIO(tar_file.read(data_size))
+
+
+def _encode_item_mask(item_index, mask_source):
+    # Masks are loose files, or (tar path, data offset, data size) members of the tar shards
+    if isinstance(mask_source, tuple):
+        mask_source = _read_tar_member(*mask_source)
+    mask = numpy.asarray(Image.open(mask_source))
+    if mask.ndim == 3:
+        mask = mask[..., 0]
+    mask = mask.astype(numpy.int64)
+    
+    # Pixel values are the instance ids of the models, values outside of the table are background
+    mask[(mask < 0) | (mask >= len(_category_lut))] = 0
+    mask_categories = _category_lut[mask]
+    
+    annotations = list()
+    for instance_id in numpy.unique(mask[mask_categories > 0]).tolist():
+        instance_mask = mask == instance_id
+        rows = numpy.flatnonzero(instance_mask.any(axis=1))
+        columns = numpy.flatnonzero(instance_mask.any(axis=0))
+        annotations.append({"category_id": int(_category_lut[instance_id]),
+                            "instance_id": instance_id,
+                            "segmentation": BS_MaskRLEEncoder.encode(instance_mask),
+                            "area": int(instance_mask.sum()),
+                            "bbox": [int(columns[0]), int(rows[0]), 
+                                     int(columns[-1] - columns[0] + 1), int(rows[-1] - rows[0] + 1)],
+                            "iscrowd": 0})
+    
+    return item_index, mask.shape, annotations
+
+
+class BS_COCOExporter:
+    __slots__ = ("_dataset_info", "_rendered_images_folder", "_segmentation_masks_folder",
+                 "_categories", "_category_lut", "_num_workers", "_mask_extension")
+    
+    _rendered_image_extensions = {"JPEG": ".jpg", "PNG": ".png", "OPEN_EXR_MULTILAYER": ".exr"}
+    
+    def __init__(self, rendered_images_folder, segmentation_masks_folder=None, num_workers=None):
+        if Image is None:
+            raise ImportError("COCO export needs Pillow to read the segmentation masks")
+        
+        self._rendered_images_folder = rendered_images_folder
+        with open(join_path(rendered_images_folder, "dataset_info.json"), "r") as dij:
+            self._dataset_info = json.load(dij)
+        if "labeled_objects_info" not in self._dataset_info:
+            raise Exception("The dataset was generated without segmentation masks")
+        
+        self._segmentation_masks_folder = (segmentation_masks_folder 
+                                           or self._dataset_info.get("segmentation_masks_folder", None))
+        if self._segmentation_masks_folder is None and not self._is_tar_shards:
+            raise Exception("Segmentation masks folder is not in the dataset info, it has to be given")
+        
+        # Datasets without the encoding info have 8 or 16 bit PNG masks
+        segmentation_masks_encoding = self._dataset_info.get("segmentation_masks_encoding", dict())
+        self._mask_extension = segmentation_masks_encoding.get("extension", ".png")
+        
+        self._categories, self._category_lut = self._compose_categories()
+        self._num_workers = num_workers or os.cpu_count() or 1
+    
+    def export(self, coco_json_path):
+        # Images and annotations are streamed into two files, so no more than a window of masks is in memory
+        rendered_image_extension = self._rendered_image_extensions[self._dataset_info["rendered_images_format"]]
+        num_annotations = 0
+        
+        with open(coco_json_path, "w") as coco_json, tempfile.TemporaryFile("w+") as annotations_json:
+            coco_json.write('{"info":')
+            json.dump({"description": "BlenderSynther dataset", 
+                       "random_seed": self._dataset_info.get("random_seed", None)}, coco_json)
+            coco_json.write(',"categories":')
+            json.dump(self._categories, coco_json)
+            coco_json.write(',"images":[')
+            
+            for item_num, (item_index, mask_size, annotations) in enumerate(self._encode_masks()):
+                height, width = mask_size
+                image_record = {"id": item_index, "width": width, "height": height,
+                                "file_name": f"{self._get_item_subfolder(item_index)}"
+                                             f"{item_index:010d}{rendered_image_extension}"}
+                coco_json.write(("," if item_num else "") + json.dumps(image_record, separators=(",", ":")))
+                
+                for annotation in annotations:
+                    num_annotations += 1
+                    annotation["id"] = num_annotations
+                    annotation["image_id"] = item_index
+                    annotations_json.write(("," if num_annotations > 1 else "") 
+                                           + json.dumps(annotation, separators=(",", ":")))
+            
+            coco_json.write('],"annotations":[')
+            annotations_json.seek(0)
+            shutil.copyfileobj(annotations_json, coco_json)
+            coco_json.write("]}")
+        
+        return num_annotations
+    
+    @property
+    def _is_tar_shards(self):
+        return self._dataset_info.get("output_layout", dict()).get("layout", "flat") == "tar_shards"
+    
+    def _encode_masks(self):
+        masks = self._get_tar_masks() if self._is_tar_shards else self._get_masks()
+        max_pending_masks = self._num_workers * 8
+        
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self._num_workers, initializer=_init_worker,
+                                                    initargs=(self._category_lut,)) as executor:
+            pending_masks = collections.deque()
+            for item_index, mask_source in masks:
+                pending_masks.append(executor.submit(_encode_item_mask, item_index, mask_source))
+                if len(pending_masks) >= max_pending_masks:
+                    yield pending_masks.popleft().result()
+            while pending_masks:
+                yield pending_masks.popleft().result()
+    
+    def _get_item_subfolder(self, item_index):
+        # Images of the nested output layout are in the same numbered subfolders as the masks
+        output_layout = self._dataset_info.get("output_layout", dict())
+        if output_layout.get("layout", "flat") == "nested":
+            return f"{item_index // output_layout['items_per_folder']:06d}/"
+        return ""
+    
+    def _get_masks(self, folder_path=None):
+        masks = list()
+        with os.scandir(folder_path or self._segmentation_masks_folder) as folder_entries:
+            for folder_entry in folder_entries:
+                if folder_entry.is_dir():
+                    if folder_entry.name.isdigit():
+                        masks.extend(self._get_masks(folder_entry.path))
+                    continue
+                item_name, item_extension = os.path.splitext(folder_entry.name)
+                if item_extension == self._mask_extension and item_name.isdigit():
+                    masks.append((int(item_name), folder_entry.path))
+        
+        masks.sort()
+        return masks
+    
+    def _get_tar_masks(self):
+        # The tar shards hold no loose masks, they are read through the byte ranges of the tar index
+        tar_index_name = self._dataset_info["output_layout"].get("tar_index", "tar_index.jsonl")
+        tar_index_path = join_path(self._rendered_images_folder, tar_index_name)
+        if not os.path.exists(tar_index_path):
+            raise FileNotFoundError(f"Tar index '{tar_index_path}' of the tar-sharded dataset does not exist")
+        
+        # Items rendered again by resumed generations are in the index more than once, the last record wins
+        masks = dict()
+        with open(tar_index_path, "r") as tar_index:
+            for tar_index_line in tar_index:
+                item_record = json.loads(tar_index_line)
+                mask_member = item_record["members"].get(f"{item_record['item']:010d}.mask{self._mask_extension}")
+                if mask_member is not None:
+                    masks[item_record["item"]] = (join_path(self._rendered_images_folder, item_record["tar"]), 
+                                                  *mask_member)
+        
+        return sorted(masks.items())
+    
+    def _compose_categories(self):
+        labeled_objects_info = self._dataset_info["labeled_objects_info"]
+        
+        categories = list()
+        max_pass_index = max([max(pass_indexes, default=0) for pass_indexes in labeled_objects_info.values()])
+        category_lut = numpy.zeros(max_pass_index + 1, dtype=numpy.int64)
+        for category_id, (label_name, pass_indexes) in enumerate(labeled_objects_info.items(), start=1):
+            categories.append({"id": category_id, "name": label_name, "supercategory": "object"})
+            category_lut[pass_indexes] = category_id
+        
+        return categories, category_lut
+    
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export BlenderSynther segmentation masks as COCO instances")
+    parser.add_argument("rendered_images_folder", help="Folder with the rendered images and dataset_info.json")
+    parser.add_argument("-o", "--output", default=None, 
+                        help="COCO JSON path, by default instances.json in the rendered images folder")
+    parser.add_argument("--masks-folder", default=None, 
+                        help="Segmentation masks folder, by default the one stored in dataset_info.json")
+    parser.add_argument("--workers", type=int, default=None, help="Mask decoding processes, by default one per CPU")
+    args = parser.parse_args(argv)
+    
+    coco_json_path = args.output or join_path(args.rendered_images_folder, "instances.json")
+    coco_exporter = BS_COCOExporter(args.rendered_images_folder, args.masks_folder, args.workers)
+    num_annotations = coco_exporter.export(coco_json_path)
+    print(f"BlenderSynther: {num_annotations} instances written to '{coco_json_path}'")
+    
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
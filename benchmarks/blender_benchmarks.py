@@ -0,0 +1,34 @@
+"""Runs the benchmark cases inside Blender, it is started by run_benchmarks.py:
+
+    blender -b --factory-startup --python benchmarks/blender_benchmarks.py -- --results results.json
+"""
+import argparse
+import json
+import os
+import sys
+
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.dirname(BENCHMARKS_FOLDER), BENCHMARKS_FOLDER]
+
+import BlenderSynther
+
+
+def main():
+    script_args = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else list()
+    parser = argparse.ArgumentParser(description="BlenderSynther benchmarks inside Blender")
+    parser.add_argument("--results", required=True, help="Path of the results JSON file")
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--filter", default=None)
+    parser.add_argument("--repeats", type=int, default=9)
+    args = parser.parse_args(script_args)
+
+    BlenderSynther.register()
+    import cases
+
+    results = cases.run_cases(args.filter, args.quick, args.repeats)
+    with open(args.results, "w") as rf:
+        json.dump(results, rf, indent=1)
+
+
+main()
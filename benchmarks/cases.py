@@ -0,0 +1,194 @@
+"""Benchmark cases of the BlenderSynther scene setup hot paths.
+
+The cases build their synthetic scenes through the bpy API, so the same code runs against the
+fake bpy of fake_blender/ under plain CPython and against the real one inside Blender.
+"""
+import gc
+import os
+import statistics
+import tempfile
+import time
+import types
+
+import bpy
+import numpy
+
+import BlenderSynther
+
+
+def clear_blend_data():
+    if hasattr(bpy.data, "batch_remove"):
+        bpy.data.batch_remove(list(bpy.data.objects) + list(bpy.data.collections) + list(bpy.data.actions))
+    else:
+        bpy.data.clear()
+
+
+def get_context():
+    # Inside Blender the add-on's scene properties are registered on the real scene
+    if bpy.context.scene is not None:
+        return bpy.context
+    scene = types.SimpleNamespace(labeled_objects_collection=None, rendered_images_folder="")
+    return types.SimpleNamespace(scene=scene, view_layer=types.SimpleNamespace(use_pass_object_index=False))
+
+
+def build_labeled_objects_collection(num_objects, num_labels=10, objects_per_model=4, is_chain=False):
+    # Every model is a parent object with (objects_per_model - 1) children, spread over the label collections;
+    # the children of a chain model are each parented to the previous one
+    labeled_objects_collection = bpy.data.collections.new("BS Bench Labeled Objects")
+    label_collections = [bpy.data.collections.new(f"BS Bench Label {label_num}") for label_num in range(num_labels)]
+    for label_collection in label_collections:
+        labeled_objects_collection.children.link(label_collection)
+
+    num_models = max(1, num_objects // objects_per_model)
+    for model_num in range(num_models):
+        label_collection = label_collections[model_num % num_labels]
+        parent_object = bpy.data.objects.new(f"BS Bench Model {model_num}", None)
+        label_collection.objects.link(parent_object)
+        child_parent_object = parent_object
+        for child_num in range(objects_per_model - 1):
+            child_object = bpy.data.objects.new(f"BS Bench Model {model_num}.{child_num}", None)
+            # Half of the children are nested, so the walk up to the root is measured too
+            child_object.parent = child_parent_object if (child_num % 2 or is_chain) else parent_object
+            child_parent_object = child_object
+            label_collection.objects.link(child_object)
+
+    return labeled_objects_collection
+
+
+def setup_labeled_objects(num_objects, objects_per_model=4, is_chain=False):
+    clear_blend_data()
+    context = get_context()
+    context.scene.labeled_objects_collection = build_labeled_objects_collection(
+                                               num_objects, objects_per_model=objects_per_model, is_chain=is_chain)
+    # The instance ids table is not saved into a folder which does not exist
+    context.scene.rendered_images_folder = os.path.join(tempfile.gettempdir(), "bs_bench_no_output")
+    return context
+
+
+def bench_labeled_objects_setup(num_objects, objects_per_model=4, is_chain=False):
+    context = setup_labeled_objects(num_objects, objects_per_model, is_chain)
+    return lambda: BlenderSynther.BS_LabeledObjects(context)
+
+
+def bench_bake_animation(num_objects, num_frames):
+    labeled_objects = BlenderSynther.BS_LabeledObjects(setup_labeled_objects(num_objects))
+    randomness = BlenderSynther.BS_ItemRandomness(0)
+    frames = numpy.arange(num_frames)
+    return lambda: labeled_objects.bake_animation(frames, randomness)
+
+
+def bench_apply_item_state(num_objects, num_items):
+    # Procedural animation mode, the state of every item is set in the frame change handler
+    labeled_objects = BlenderSynther.BS_LabeledObjects(setup_labeled_objects(num_objects))
+    randomness = BlenderSynther.BS_ItemRandomness(0)
+
+    def apply_item_states():
+        for item_index in range(num_items):
+            labeled_objects.apply_item_state(item_index, randomness)
+
+    return apply_item_states
+
+
+def bench_instance_ids(num_objects):
+    labeled_objects = BlenderSynther.BS_LabeledObjects(setup_labeled_objects(num_objects))
+    structured_labeled_objects = labeled_objects.structured_labeled_objects
+    folder_path = tempfile.mkdtemp(prefix="bs_bench_ids_")
+    return lambda: BlenderSynther.BS_InstanceIDAllocator(folder_path).allocate(structured_labeled_objects)
+
+
+def bench_texture_sampling(sampling_mode, num_items, num_textures=1000):
+    textures_folder = tempfile.mkdtemp(prefix="bs_bench_textures_")
+    for texture_num in range(num_textures):
+        open(os.path.join(textures_folder, f"texture_{texture_num:05d}.jpg"), "wb").close()
+    texture_catalogue = BlenderSynther.BS_TextureCatalogue(textures_folder, sampling_mode,
+                                                           BlenderSynther.BS_ItemRandomness(0))
+
+    def sample_textures():
+        for item_index in range(num_items):
+            texture_catalogue.get_item_texture_path(item_index)
+
+    return sample_textures
+
+
+def bench_item_randomness(num_items):
+    randomness = BlenderSynther.BS_ItemRandomness(0)
+    item_indices = numpy.arange(num_items)
+    return lambda: randomness.uniform(item_indices, "bench", 0.0, 1.0, size=3)
+
+
+# (case id, setup returning the timed function, part of the quick run)
+CASES = [("labeled_objects_setup[objects=10]", lambda: bench_labeled_objects_setup(10), True),
+         ("labeled_objects_setup[objects=1000]", lambda: bench_labeled_objects_setup(1_000), True),
+         ("labeled_objects_setup[objects=100000]", lambda: bench_labeled_objects_setup(100_000), False),
+         ("labeled_objects_setup[objects=10000,chain=1000]", 
+          lambda: bench_labeled_objects_setup(10_000, objects_per_model=1_000, is_chain=True), True),
+         ("bake_animation[objects=40,frames=1000]", lambda: bench_bake_animation(40, 1_000), True),
+         ("bake_animation[objects=40,frames=100000]", lambda: bench_bake_animation(40, 100_000), True),
+         ("bake_animation[objects=40,frames=1000000]", lambda: bench_bake_animation(40, 1_000_000), False),
+         ("bake_animation[objects=4000,frames=1000]", lambda: bench_bake_animation(4_000, 1_000), False),
+         ("apply_item_state[objects=40,items=1000]", lambda: bench_apply_item_state(40, 1_000), True),
+         ("apply_item_state[objects=4000,items=1000]", lambda: bench_apply_item_state(4_000, 1_000), False),
+         ("instance_ids[objects=1000]", lambda: bench_instance_ids(1_000), True),
+         ("instance_ids[objects=100000]", lambda: bench_instance_ids(100_000), False)]
+CASES += [(f"texture_sampling[mode={sampling_mode},items=100000]",
+           lambda sampling_mode=sampling_mode: bench_texture_sampling(sampling_mode, 100_000), True)
+          for sampling_mode in BlenderSynther.BS_TextureCatalogue.sampling_modes]
+CASES += [("item_randomness[items=1000000]", lambda: bench_item_randomness(1_000_000), True)]
+
+
+def calibration_workload():
+    # Interpreter and NumPy work in about the mix of the cases, the case times are given in its time
+    total = 0.0
+    for value in range(20_000):
+        total += value * 0.5
+    values = numpy.arange(50_000, dtype=numpy.float64)[::-1]
+    numpy.sort(numpy.sin(values) + total)
+
+
+def get_num_loops(timed_function, min_run_time):
+    # The fast functions are looped, so a timed run is long enough not to be dominated by the timer noise
+    start_time = time.perf_counter()
+    timed_function()
+    return max(1, int(min_run_time / max(time.perf_counter() - start_time, 1e-9)))
+
+
+def time_loops(timed_function, num_loops):
+    # As in timeit, the garbage collector is off, so the collections triggered by the heap of the
+    # previous cases do not land in the timed runs
+    gc.collect()
+    gc.disable()
+    try:
+        start_time = time.perf_counter()
+        for _ in range(num_loops):
+            timed_function()
+        return (time.perf_counter() - start_time) / num_loops
+    finally:
+        gc.enable()
+
+
+def run_cases(name_filter=None, quick=False, repeats=9, min_run_time=0.1, max_case_time=30.0):
+    # Case times are given in units of the calibration time. Every timed run of the case is paired with
+    # a calibration run just before it and the median of the pair ratios is kept, so a load change during
+    # the case moves both sides of a pair and single disturbed pairs do not move the result
+    results = dict()
+    for case_id, setup_case, is_quick in CASES:
+        if (quick and not is_quick) or (name_filter and name_filter not in case_id):
+            continue
+
+        timed_function = setup_case()
+        num_case_loops = get_num_loops(timed_function, min_run_time)
+        num_calibration_loops = get_num_loops(calibration_workload, min_run_time)
+        calibration_times = [time_loops(calibration_workload, num_calibration_loops)]
+        case_times = [time_loops(timed_function, num_case_loops)]
+        # The short and noisy cases get all the repeats, the long ones as many as fit in max_case_time
+        pair_time = case_times[0] * num_case_loops + calibration_times[0] * num_calibration_loops
+        for _ in range(max(3, min(repeats, int(max_case_time / pair_time))) - 1):
+            calibration_times.append(time_loops(calibration_workload, num_calibration_loops))
+            case_times.append(time_loops(timed_function, num_case_loops))
+        results[case_id] = statistics.median([case_time / calibration_time for case_time, calibration_time
+                                              in zip(case_times, calibration_times)])
+        print(f"{case_id:<56}{statistics.median(case_times) * 1000:>12.2f} ms{results[case_id]:>12.3f} units",
+              flush=True)
+
+    clear_blend_data()
+    return results
@@ -0,0 +1,241 @@
+"""Lightweight stand-in for Blender's bpy module, enough to import BlenderSynther and run
+its scene setup code under plain CPython.
+
+Only the parts of the API the benchmarked code paths use are implemented. Bulk RNA
+accessors (foreach_set/foreach_get) keep NumPy arrays, so the stub adds as little as
+possible to the measured times.
+"""
+import sys
+import types as _module_types
+
+import numpy
+
+
+# bpy.props: property definitions are only declarations in the add-on's class bodies
+props = _module_types.ModuleType("bpy.props")
+for _property_name in ("PointerProperty", "BoolProperty", "StringProperty", "IntProperty",
+                       "FloatProperty", "EnumProperty", "CollectionProperty", "FloatVectorProperty"):
+    setattr(props, _property_name, lambda *args, **kwargs: None)
+
+
+class ID:
+    def __init__(self, name):
+        self.name = name
+        self.animation_data = None
+        self.users = 0
+
+    def animation_data_create(self):
+        self.animation_data = AnimationData()
+        return self.animation_data
+
+    def animation_data_clear(self):
+        self.animation_data = None
+
+    def evaluated_get(self, depsgraph):
+        return self
+
+
+class AnimationData:
+    def __init__(self):
+        self.action = None
+
+
+class KeyframePoints:
+    def __init__(self):
+        self._co = numpy.empty(0, dtype=numpy.float32)
+
+    def __len__(self):
+        return len(self._co) // 2
+
+    def add(self, count):
+        self._co = numpy.concatenate((self._co, numpy.zeros(2 * count, dtype=numpy.float32)))
+
+    def foreach_set(self, attribute, values):
+        if attribute != "co":
+            raise AttributeError(attribute)
+        self._co[:] = values
+
+    def foreach_get(self, attribute, values):
+        if attribute != "co":
+            raise AttributeError(attribute)
+        values[:] = self._co
+
+
+class FCurve:
+    def __init__(self, data_path, index=0):
+        self.data_path = data_path
+        self.array_index = index
+        self.keyframe_points = KeyframePoints()
+
+    def update(self):
+        pass
+
+    def evaluate(self, frame):
+        keyframes_co = self.keyframe_points._co.reshape(-1, 2)
+        return float(keyframes_co[numpy.searchsorted(keyframes_co[:, 0], frame), 1])
+
+
+class FCurves(list):
+    def find(self, data_path, index=0):
+        for fcurve in self:
+            if fcurve.data_path == data_path and fcurve.array_index == index:
+                return fcurve
+        return None
+
+    def new(self, data_path, index=0, action_group=""):
+        fcurve = FCurve(data_path, index)
+        self.append(fcurve)
+        return fcurve
+
+
+class Action(ID):
+    def __init__(self, name):
+        super().__init__(name)
+        self.fcurves = FCurves()
+
+
+class Object(ID):
+    def __init__(self, name, object_data=None):
+        super().__init__(name)
+        self.data = object_data
+        self.type = "EMPTY" if object_data is None else getattr(object_data, "type", "MESH")
+        self.parent = None
+        self.pass_index = 0
+        self.location = [0.0, 0.0, 0.0]
+        self.rotation_euler = [0.0, 0.0, 0.0]
+        self.color = (1.0, 1.0, 1.0, 1.0)
+        self.hide_render = False
+        self.hide_viewport = False
+
+
+class _CollectionObjects(list):
+    def link(self, linked_object):
+        self.append(linked_object)
+
+    def unlink(self, linked_object):
+        self.remove(linked_object)
+
+
+class Collection(ID):
+    def __init__(self, name):
+        super().__init__(name)
+        self.objects = _CollectionObjects()
+        self.children = _CollectionObjects()
+
+    @property
+    def all_objects(self):
+        all_objects = list(self.objects)
+        for child_collection in self.children:
+            all_objects.extend(child_collection.all_objects)
+        return all_objects
+
+
+class BlendDataCollection(dict):
+    def __init__(self, datablock_type):
+        super().__init__()
+        self._datablock_type = datablock_type
+
+    def __iter__(self):
+        return iter(list(self.values()))
+    
+    # Blender finds datablocks by name with a linear search of its list, the stub does the same,
+    # so code looking objects up by name is not measured faster than it is
+    def __getitem__(self, name):
+        for datablock in self.values():
+            if datablock.name == name:
+                return datablock
+        raise KeyError(name)
+    
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def new(self, name, *args, **kwargs):
+        datablock = self._datablock_type(name, *args, **kwargs)
+        self[name] = datablock
+        return datablock
+
+    def remove(self, datablock, **kwargs):
+        self.pop(datablock.name, None)
+
+
+class _BlendData:
+    def __init__(self):
+        self.filepath = ""
+        self.actions = BlendDataCollection(Action)
+        self.objects = BlendDataCollection(Object)
+        self.collections = BlendDataCollection(Collection)
+        self.materials = BlendDataCollection(ID)
+        self.images = BlendDataCollection(ID)
+        self.scenes = BlendDataCollection(ID)
+
+    def clear(self):
+        self.__init__()
+
+
+data = _BlendData()
+
+
+# bpy.types: base classes of the add-on's panels, operators and property groups
+types = _module_types.ModuleType("bpy.types")
+for _type_name in ("Panel", "Operator", "PropertyGroup", "Scene", "Image", "Material"):
+    setattr(types, _type_name, type(_type_name, (), {}))
+types.ID = ID
+types.Object = Object
+types.Collection = Collection
+types.Action = Action
+
+
+class _Handlers:
+    def __init__(self):
+        for handler_name in ("frame_change_pre", "frame_change_post", "render_init", "render_pre", "render_post",
+                             "render_write", "render_complete", "render_cancel"):
+            setattr(self, handler_name, list())
+
+
+class _App:
+    def __init__(self):
+        self.handlers = _Handlers()
+        self.binary_path = ""
+        self.version = (2, 91, 0)
+        self.background = True
+
+
+app = _App()
+
+
+class _Utils:
+    def register_class(self, cls):
+        pass
+
+    def unregister_class(self, cls):
+        pass
+
+
+utils = _Utils()
+
+
+class _Operators:
+    def __getattr__(self, name):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return {"FINISHED"}
+
+
+ops = _Operators()
+
+
+class _Context:
+    def __init__(self):
+        self.scene = None
+        self.view_layer = None
+
+
+context = _Context()
+
+
+sys.modules["bpy.props"] = props
+sys.modules["bpy.types"] = types
@@ -0,0 +1,14 @@
+"""Stand-in for Blender's mathutils module, see bpy.py next to it."""
+
+
+class Vector(tuple):
+    def __new__(cls, values=(0.0, 0.0, 0.0)):
+        return tuple.__new__(cls, values)
+
+
+class Euler(list):
+    pass
+
+
+class Matrix(list):
+    pass
@@ -0,0 +1,141 @@
+"""Runs the BlenderSynther benchmarks and compares them with the stored baselines.
+
+    python benchmarks/run_benchmarks.py [--quick] [--filter TEXT] [--update-baselines]
+
+The cases run under plain CPython against the fake bpy of fake_blender/. When Blender is found
+(--blender, the BLENDER environment variable or PATH), the same cases run inside it as well.
+Times are measured in units of a calibration loop (see cases.run_cases). Exits with 1 when a case is
+slower than its baseline by more than the tolerance; baselines recorded on another machine or in
+another format are reported, but do not fail the run.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+BENCHMARKS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPO_FOLDER = os.path.dirname(BENCHMARKS_FOLDER)
+BASELINES_PATH = os.path.join(BENCHMARKS_FOLDER, "baselines.json")
+BASELINES_UNITS = "calibration"
+
+
+def run_fake_blender_cases(args):
+    sys.path[:0] = [os.path.join(BENCHMARKS_FOLDER, "fake_blender"), REPO_FOLDER, BENCHMARKS_FOLDER]
+    import cases
+
+    return cases.run_cases(args.filter, args.quick, args.repeats)
+
+
+def run_blender_cases(args, blender_path):
+    with tempfile.TemporaryDirectory() as results_folder:
+        results_path = os.path.join(results_folder, "results.json")
+        blender_args = [blender_path, "-b", "--factory-startup", "--python-exit-code", "1",
+                        "--python", os.path.join(BENCHMARKS_FOLDER, "blender_benchmarks.py"), "--",
+                        "--results", results_path, "--repeats", str(args.repeats)]
+        if args.quick:
+            blender_args.append("--quick")
+        if args.filter:
+            blender_args += ["--filter", args.filter]
+        subprocess.run(blender_args, check=True)
+
+        with open(results_path, "r") as rf:
+            return json.load(rf)
+
+
+def find_blender(args):
+    if args.no_blender:
+        return None
+    return args.blender or os.environ.get("BLENDER") or shutil.which("blender")
+
+
+def get_machine():
+    return {"platform": platform.platform(), "processor": platform.processor(), "python": platform.python_version()}
+
+
+def get_foreign_baselines_reason(baselines):
+    if not baselines:
+        return "there are no baselines"
+    if baselines.get("units") != BASELINES_UNITS:
+        return "the baselines are absolute times, run with --update-baselines to record them in calibration units"
+    if baselines.get("machine") != get_machine():
+        return f"the baselines were recorded on another machine: {baselines.get('machine')}"
+    return None
+
+
+def compare_with_baselines(results, baselines, tolerance):
+    regressions = list()
+    for case_id, case_time in results.items():
+        baseline_time = baselines.get(case_id)
+        if baseline_time is None:
+            print(f"{case_id:<56}{'no baseline':>24}")
+            continue
+        change = case_time / baseline_time - 1.0
+        status = "REGRESSION" if change > tolerance else "ok"
+        print(f"{case_id:<56}{change * 100:>+11.1f} %  {status}")
+        if status != "ok":
+            regressions.append(case_id)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BlenderSynther benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Skip the largest cases")
+    parser.add_argument("--filter", default=None, help="Run only the cases which ids contain the text")
+    parser.add_argument("--repeats", type=int, default=9,
+                        help="Timed runs per case, the median is kept; long cases get fewer")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Allowed slowdown against the baseline, 0.5 is 50 percent")
+    parser.add_argument("--update-baselines", action="store_true", help="Store the results as the new baselines")
+    parser.add_argument("--blender", default=None, help="Path to the Blender executable")
+    parser.add_argument("--no-blender", action="store_true", help="Do not run the cases inside Blender")
+    args = parser.parse_args()
+
+    all_results = {"fake_bpy": run_fake_blender_cases(args)}
+    blender_path = find_blender(args)
+    if blender_path:
+        all_results["blender"] = run_blender_cases(args, blender_path)
+
+    baselines = dict()
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH, "r") as bf:
+            baselines = json.load(bf)
+
+    foreign_baselines_reason = get_foreign_baselines_reason(baselines)
+    if baselines.get("units") != BASELINES_UNITS:
+        # Times in other units do not compare with the results, they are not kept either
+        baselines = dict()
+
+    if args.update_baselines:
+        for variant, results in all_results.items():
+            baselines.setdefault(variant, dict()).update(results)
+        baselines["machine"] = get_machine()
+        baselines["units"] = BASELINES_UNITS
+        with open(BASELINES_PATH, "w") as bf:
+            json.dump(baselines, bf, indent=1, sort_keys=True)
+        print(f"Baselines are written to {BASELINES_PATH}")
+        return 0
+
+    if foreign_baselines_reason is not None:
+        print(f"Note: {foreign_baselines_reason}")
+    regressions = list()
+    for variant, results in all_results.items():
+        print(f"\n{variant} against the baselines:")
+        regressions += compare_with_baselines(results, baselines.get(variant, dict()), args.tolerance)
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+        if foreign_baselines_reason is not None:
+            print("Not failing, the baselines are not from this machine")
+            return 0
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())